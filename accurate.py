@@ -12,19 +12,29 @@ import locust.events
 import locust.config
 
 import gevent
+import gevent.event
 
+import arrival
+import async_stats
 import client
 import graphite_client
+import metrics
 import digaas_integration
+import exchange_log
 import persistence
 import insight
+import sharding
+import greenlet_manager
 from greenlet_manager import GreenletManager
+from snapshot import GatherSnapshot
+from token_manager import TokenManager
 from client import DesignateClient
+from fast_http import FastHttpSession
 from web import *
 from datagen import *
 import accurate_config as CONFIG
 
-from tasks.gather import GatherTasks
+from tasks.gather import GatherTasks, gather_all
 from tasks.recordset import RecordsetTasks
 from tasks.zone import ZoneTasks
 from models import Tenant
@@ -36,11 +46,44 @@ setup_authentication(CONFIG.username, CONFIG.password)
 
 # send metrics to a graphite server
 graphite_client.setup_graphite_communication(
-    CONFIG.graphite_host, CONFIG.graphite_port)
+    CONFIG.graphite_host, CONFIG.graphite_port,
+    protocol=CONFIG.graphite_protocol,
+    queue_size=CONFIG.graphite_queue_size,
+    drop_policy=CONFIG.graphite_drop_policy,
+    batch_size=CONFIG.graphite_batch_size)
+
+# send metrics to statsd, influxdb, and/or expose them at /metrics
+metrics.setup_metrics(
+    statsd_host=CONFIG.statsd_host,
+    statsd_port=CONFIG.statsd_port,
+    influxdb_url=CONFIG.influxdb_url,
+    influxdb_database=CONFIG.influxdb_database,
+    prometheus=CONFIG.prometheus_enabled,
+    per_slave=CONFIG.metrics_per_slave,
+    cluster=CONFIG.metrics_cluster,
+    cluster_interval=CONFIG.metrics_cluster_interval)
 
 # save a report when the test finishes
 persistence.setup_persistence()
 
+# collect the measurement bounds of async latencies for the report
+async_stats.setup_async_stats()
+
+# collect how late the open-loop tasks started, for the report
+arrival.setup_arrival()
+
+# report the in-flight async operations to the master, and save them
+greenlet_manager.setup_reporting()
+
+# keep a sample of failed requests, for /failures and the report
+exchange_log.setup_exchange_log(
+    capacity=CONFIG.failed_exchange_capacity,
+    rate=CONFIG.failed_exchange_rate,
+    burst=CONFIG.failed_exchange_burst,
+    sample_rate=CONFIG.failed_exchange_sample_rate,
+    max_body=CONFIG.failed_exchange_max_body,
+)
+
 locust.config.RESET_STATS_AFTER_HATCHING = CONFIG.reset_stats
 
 
@@ -50,7 +93,7 @@ if CONFIG.use_digaas and not insight.is_slave():
     _digaas_client = digaas_integration.DigaasClient(CONFIG.digaas_endpoint)
     digaas_integration.setup(_digaas_client)
 
-if not insight.is_master():
+if not insight.is_master() or CONFIG.shard_tenants:
     # TODO: the tenant id is actually the username. it should be named so.
     SMALL_TENANTS = [Tenant(id=id, api_key=api_key, type=Tenant.SMALL)
                       for id, api_key in CONFIG.small_tenants]
@@ -58,6 +101,35 @@ if not insight.is_master():
                      for id, api_key in CONFIG.large_tenants]
     ALL_TENANTS = SMALL_TENANTS + LARGE_TENANTS
 
+    if CONFIG.shard_tenants and insight.is_slave():
+        # only use (and authenticate) our share of the tenants, once we get
+        # it from the master
+        def use_shard(tenants):
+            ids = set(tenant.id for tenant in tenants)
+            for tenant_list in (SMALL_TENANTS, LARGE_TENANTS, ALL_TENANTS):
+                tenant_list[:] = [t for t in tenant_list if t.id in ids]
+            TokenManager.get().authenticate_all(tenants)
+        sharding.shard_received += use_shard
+    else:
+        # authenticate every tenant before the test starts, reusing tokens
+        # cached by other locust processes on this box
+        TokenManager.get().authenticate_all(ALL_TENANTS)
+
+if insight.is_master() and CONFIG.shard_tenants:
+    # gather once, for all the slaves
+    if CONFIG.http_engine == 'fast':
+        _session = FastHttpSession(CONFIG.designate_host,
+                                   pool_size=CONFIG.http_pool_size,
+                                   timeout=CONFIG.http_timeout)
+    else:
+        _session = HttpSession(CONFIG.designate_host)
+    sharding.start_gathering(
+        DesignateClient(_session,
+                        use_project_id=CONFIG.use_project_id,
+                        tenant_id_in_url=CONFIG.tenant_id_in_url),
+        ALL_TENANTS, gather_all)
+
+if not insight.is_master():
     # the greenlet_manager keeps track of greenlets spawned for polling
     # todo: it's hard to ensure cleanup_greenlets gets run before the stats
     # are persisted to a file...
@@ -69,23 +141,39 @@ if not insight.is_master():
     locust.events.quitting += \
         lambda: GreenletManager.get().cleanup_greenlets()
 
+    # save what's left of the gathered data for the next test. with shards,
+    # the master keeps the snapshot.
+    if (GatherSnapshot.get() is not None
+            and not (CONFIG.shard_tenants and insight.is_slave())):
+        def save_snapshot():
+            if GatherData.has_already_gathered():
+                GatherSnapshot.get().save(ALL_TENANTS)
+        locust.events.locust_stop_hatching += save_snapshot
+        locust.events.quitting += save_snapshot
+
+def weighted_tasks(weights):
+    """Return {task: weight} for a Weights from the config"""
+    return {
+        ZoneTasks.get_domain_by_id:   weights.get_domain_by_id,
+        ZoneTasks.get_domain_by_name: weights.get_domain_by_name,
+        ZoneTasks.list_domains:       weights.list_domain,
+        ZoneTasks.import_zone:        weights.import_zone,
+        ZoneTasks.export_domain:      weights.export_domain,
+        ZoneTasks.create_domain:      weights.create_domain,
+        ZoneTasks.modify_domain:      weights.modify_domain,
+        ZoneTasks.remove_domain:      weights.remove_domain,
+        RecordsetTasks.list_records:  weights.list_records,
+        RecordsetTasks.get_record:    weights.get_record,
+        RecordsetTasks.create_record: weights.create_record,
+        RecordsetTasks.remove_record: weights.remove_record,
+        RecordsetTasks.modify_record: weights.modify_record,
+    }
+
+
 class LargeTasks(ZoneTasks, RecordsetTasks):
 
-    tasks = {
-        ZoneTasks.get_domain_by_id:   CONFIG.large_weights.get_domain_by_id,
-        ZoneTasks.get_domain_by_name: CONFIG.large_weights.get_domain_by_name,
-        ZoneTasks.list_domains:       CONFIG.large_weights.list_domain,
-        ZoneTasks.import_zone:        CONFIG.large_weights.import_zone,
-        ZoneTasks.export_domain:      CONFIG.large_weights.export_domain,
-        ZoneTasks.create_domain:      CONFIG.large_weights.create_domain,
-        ZoneTasks.modify_domain:      CONFIG.large_weights.modify_domain,
-        ZoneTasks.remove_domain:      CONFIG.large_weights.remove_domain,
-        RecordsetTasks.list_records:  CONFIG.large_weights.list_records,
-        RecordsetTasks.get_record:    CONFIG.large_weights.get_record,
-        RecordsetTasks.create_record: CONFIG.large_weights.create_record,
-        RecordsetTasks.remove_record: CONFIG.large_weights.remove_record,
-        RecordsetTasks.modify_record: CONFIG.large_weights.modify_record,
-    }
+    weights = CONFIG.large_weights
+    tasks = weighted_tasks(weights)
 
     def __init__(self, *args, **kwargs):
         super(LargeTasks, self).__init__(LARGE_TENANTS, *args, **kwargs)
@@ -96,21 +184,8 @@ class LargeTasks(ZoneTasks, RecordsetTasks):
 
 class SmallTasks(ZoneTasks, RecordsetTasks):
 
-    tasks = {
-        ZoneTasks.get_domain_by_id:   CONFIG.small_weights.get_domain_by_id,
-        ZoneTasks.get_domain_by_name: CONFIG.small_weights.get_domain_by_name,
-        ZoneTasks.list_domains:       CONFIG.small_weights.list_domain,
-        ZoneTasks.import_zone:        CONFIG.small_weights.import_zone,
-        ZoneTasks.export_domain:      CONFIG.small_weights.export_domain,
-        ZoneTasks.create_domain:      CONFIG.small_weights.create_domain,
-        ZoneTasks.modify_domain:      CONFIG.small_weights.modify_domain,
-        ZoneTasks.remove_domain:      CONFIG.small_weights.remove_domain,
-        RecordsetTasks.list_records:  CONFIG.small_weights.list_records,
-        RecordsetTasks.get_record:    CONFIG.small_weights.get_record,
-        RecordsetTasks.create_record: CONFIG.small_weights.create_record,
-        RecordsetTasks.remove_record: CONFIG.small_weights.remove_record,
-        RecordsetTasks.modify_record: CONFIG.small_weights.modify_record,
-    }
+    weights = CONFIG.small_weights
+    tasks = weighted_tasks(weights)
 
     def __init__(self, *args, **kwargs):
         super(SmallTasks, self).__init__(SMALL_TENANTS, *args, **kwargs)
@@ -125,13 +200,37 @@ class AccurateTaskSet(TaskSet):
         SmallTasks: CONFIG.total_small_weight,
     }
 
+class OpenLoopTasks(TaskSet):
+    """With arrival_rate, the locusts wait once the data is gathered. The
+    tasks are started by the ArrivalScheduler instead, on executors with
+    sessions of their own."""
+
+    def park(self):
+        """Block until the locust is stopped"""
+        gevent.event.Event().wait()
+
+    tasks = [park]
+
+    def start_arrivals(self):
+        def new_executor():
+            # a locust of its own, for an http session of its own
+            executor = Locust()
+            return {LargeTasks: LargeTasks(executor),
+                    SmallTasks: SmallTasks(executor)}
+
+        arrival.start_arrivals(
+            [(tasks, weighted_tasks(tasks.weights))
+             for tasks in (LargeTasks, SmallTasks)],
+            rate=CONFIG.arrival_rate,
+            executors=CONFIG.arrival_executors,
+            new_executor=new_executor)
+
 class GatherShim(GatherTasks):
 
     done_gathering = locust.events.EventHook()
 
     tasks = {
-        GatherTasks.gather_zones: 1,
-        GatherTasks.gather_recordsets: 1,
+        GatherTasks.gather: 1,
     }
 
     def __init__(self, *args, **kwargs):
@@ -204,7 +303,10 @@ class TaskSwitcher(TaskSet):
         # this is a little awkward, but it works. these must be instances
         # of a class that has the task methods as members.
         if TaskSwitcher.regular_tasks is None:
-            TaskSwitcher.regular_tasks = AccurateTaskSet(*args, **kwargs)
+            if CONFIG.arrival_rate:
+                TaskSwitcher.regular_tasks = OpenLoopTasks(*args, **kwargs)
+            else:
+                TaskSwitcher.regular_tasks = AccurateTaskSet(*args, **kwargs)
         if TaskSwitcher.gathering_tasks is None:
             TaskSwitcher.gathering_tasks = GatherData(*args, **kwargs)
 
@@ -213,6 +315,8 @@ class TaskSwitcher(TaskSet):
         def on_hatch_complete(user_count):
             GatherData.set_already_gathered(True)
             self.tasks = self.regular_tasks.tasks
+            if CONFIG.arrival_rate:
+                self.regular_tasks.start_arrivals()
         locust.events.hatch_complete += on_hatch_complete
 
         def on_done_gathering():
@@ -246,3 +350,10 @@ class Locust(HttpLocust):
     max_wait = CONFIG.max_wait
 
     host = CONFIG.designate_host
+
+    def __init__(self):
+        super(Locust, self).__init__()
+        if CONFIG.http_engine == 'fast':
+            self.client = FastHttpSession(self.host,
+                                          pool_size=CONFIG.http_pool_size,
+                                          timeout=CONFIG.http_timeout)
@@ -0,0 +1,236 @@
+"""
+Open-loop load, with tasks started at constant rates.
+
+Normally each locust waits min_wait..max_wait between tasks, so when
+Designate slows down, the locusts start fewer tasks. The load drops just
+when it matters, and the slow requests that would have been made aren't
+measured at all (coordinated omission).
+
+With arrival_rate set, the ArrivalScheduler starts each task at a fixed
+rate instead, whether or not earlier tasks have finished. The total rate is
+split between the tasks by their weights, like the locusts split their
+time. The tasks run on a bounded pool of executor greenlets, each with task
+sets (and so an http session) of its own. When they're all busy, the next
+task starts late, and how late is recorded for each task as its "start
+lateness". Slaves send these to the master with their regular reports, and
+the master saves them in the persisted report, along with the rate each
+task actually started at.
+
+Only the start lateness is tracked. Response times are still measured from
+when each request is sent, so a task that started late has requests that
+look faster than its users would see them; add the task's start lateness
+for that.
+"""
+import heapq
+import logging
+import random
+import sys
+import time
+
+import gevent
+import gevent.pool
+import gevent.queue
+import locust.events
+
+import histogram
+import insight
+import persistence
+
+LOG = logging.getLogger(__name__)
+
+
+class StartLateness(object):
+
+    def __init__(self):
+        # {name: {'lateness': {ms: count}, 'first': time, 'last': time}}
+        self.entries = {}
+
+    def _entry(self, name):
+        entry = self.entries.get(name)
+        if entry is None:
+            entry = self.entries[name] = {
+                'lateness': {}, 'first': None, 'last': None}
+        return entry
+
+    def _add_times(self, entry, first, last):
+        if entry['first'] is None or first < entry['first']:
+            entry['first'] = first
+        if entry['last'] is None or last > entry['last']:
+            entry['last'] = last
+
+    def record(self, name, started, lateness):
+        """Record a task started at `started`, lateness ms after it was due"""
+        entry = self._entry(name)
+        value = histogram.round_response_time(int(lateness))
+        entry['lateness'][value] = entry['lateness'].get(value, 0) + 1
+        self._add_times(entry, started, started)
+
+    def serialize(self):
+        return [{'name': name, 'lateness': entry['lateness'],
+                 'first': entry['first'], 'last': entry['last']}
+                for name, entry in self.entries.iteritems()]
+
+    def merge(self, serialized):
+        for item in serialized:
+            entry = self._entry(item['name'])
+            for value, count in item['lateness'].iteritems():
+                value = int(value)
+                entry['lateness'][value] = \
+                    entry['lateness'].get(value, 0) + count
+            self._add_times(entry, item['first'], item['last'])
+
+    def reset(self):
+        self.entries = {}
+
+    def summary(self):
+        result = []
+        for name, entry in sorted(self.entries.iteritems()):
+            lateness = histogram.summarize(entry['lateness'])
+            duration = entry['last'] - entry['first']
+            result.append({
+                'name': name,
+                'count': lateness['count'],
+                'rate': lateness['count'] / duration if duration else None,
+                'lateness': lateness,
+            })
+        return result
+
+
+class ArrivalScheduler(object):
+    """Starts tasks at fixed rates, on at most `executors` greenlets.
+
+    Usage:
+        scheduler = ArrivalScheduler.from_weights(
+            [(TaskSetClass, {task: weight, ...}), ...], rate=100,
+            executors=200, new_executor=new_executor)
+        scheduler.start()
+        ...
+        scheduler.stop()
+    """
+
+    def __init__(self, schedule, executors, new_executor):
+        """:param schedule: a list of (taskset class, task, rate), where task
+            is called as task(taskset), rate times per second
+        :param new_executor: returns {taskset class: taskset} for a new
+            executor. It's called for up to `executors` executors, which are
+            reused from then on.
+        """
+        self.schedule = [entry for entry in schedule if entry[2] > 0]
+        self.executors = executors
+        self.new_executor = new_executor
+        self.pool = gevent.pool.Pool(executors)
+        # the task sets of the executors that aren't running a task
+        self.idle = gevent.queue.Queue()
+        self.greenlet = None
+
+    @classmethod
+    def from_weights(cls, weighted_tasks, rate, executors, new_executor):
+        """Split the total rate between the tasks by their weights.
+
+        :param weighted_tasks: a list of (taskset class, {task: weight})
+        """
+        total = sum(sum(weights.itervalues())
+                    for _, weights in weighted_tasks)
+        schedule = []
+        if not total:
+            return cls(schedule, executors, new_executor)
+        for taskset_class, weights in weighted_tasks:
+            for task, weight in weights.iteritems():
+                schedule.append(
+                    (taskset_class, task, float(rate) * weight / total))
+        return cls(schedule, executors, new_executor)
+
+    def start(self):
+        if self.greenlet is None or self.greenlet.dead:
+            LOG.info("Starting %s tasks at %.1f per second, on up to %s "
+                     "executors", len(self.schedule),
+                     sum(rate for _, _, rate in self.schedule),
+                     self.executors)
+            self.greenlet = gevent.spawn(self._run)
+
+    def stop(self):
+        if self.greenlet is not None:
+            self.greenlet.kill()
+            self.greenlet = None
+        self.pool.kill()
+
+    def _run(self):
+        intervals = [1.0 / rate for _, _, rate in self.schedule]
+        # stagger each task's first start over its interval, so the tasks
+        # don't all start at once
+        now = time.time()
+        due = [(now + random.uniform(0, interval), i)
+               for i, interval in enumerate(intervals)]
+        heapq.heapify(due)
+        while due:
+            at, i = due[0]
+            delay = at - time.time()
+            if delay > 0:
+                gevent.sleep(delay)
+            heapq.heapreplace(due, (at + intervals[i], i))
+            # a late task is still started, so the rate catches up
+            self.pool.wait_available()
+            taskset_class, task, _ = self.schedule[i]
+            self.pool.spawn(self._execute, taskset_class, task, at)
+
+    def _execute(self, taskset_class, task, due):
+        started = time.time()
+        name = _task_name(taskset_class, task)
+        lateness.record(name, started, (started - due) * 1000)
+        # the pool limits how many executors there are at once
+        try:
+            tasksets = self.idle.get_nowait()
+        except gevent.queue.Empty:
+            tasksets = self.new_executor()
+        taskset = tasksets[taskset_class]
+        try:
+            task(taskset)
+        except gevent.GreenletExit:
+            raise
+        except Exception as e:
+            LOG.exception("Failed to run %s", name)
+            locust.events.locust_error.fire(
+                locust_instance=taskset.locust, exception=e,
+                tb=sys.exc_info()[2])
+        self.idle.put(tasksets)
+
+
+def _task_name(taskset_class, task):
+    return "{0}.{1}".format(taskset_class.__name__, task.__name__)
+
+
+lateness = StartLateness()
+scheduler = None
+
+def start_arrivals(weighted_tasks, rate, executors, new_executor):
+    """Start the open-loop scheduler for this process, or restart it if
+    the test is restarted"""
+    global scheduler
+    if scheduler is None:
+        scheduler = ArrivalScheduler.from_weights(
+            weighted_tasks, rate, executors, new_executor)
+    scheduler.start()
+
+def stop_arrivals():
+    if scheduler is not None:
+        scheduler.stop()
+
+def send_lateness_to_master(client_id, data):
+    data['start_lateness'] = lateness.serialize()
+    lateness.reset()
+
+def merge_slave_lateness(client_id, data):
+    lateness.merge(data.get('start_lateness', []))
+
+def persist_lateness(stats):
+    stats['start_lateness'] = lateness.summary()
+
+def setup_arrival():
+    if not insight.is_master():
+        locust.events.locust_stop_hatching += stop_arrivals
+        locust.events.quitting += stop_arrivals
+    if insight.is_slave():
+        locust.events.report_to_master += send_lateness_to_master
+    else:
+        locust.events.slave_report += merge_slave_lateness
+        persistence.persisting_info += persist_lateness
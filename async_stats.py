@@ -0,0 +1,85 @@
+"""
+Measurement bounds for the latencies of asynchronous operations.
+
+We only learn that an async operation finished when a status check sees it,
+so the true finish time is somewhere between the start of the last check
+that saw it pending and the first check that saw it done. Each measurement
+is recorded as a (lower, upper) pair of latencies. Slaves send these to the
+master with their regular reports, and the master saves percentiles of both
+bounds in the persisted report.
+"""
+import locust.events
+
+import histogram
+import insight
+import persistence
+
+
+class AsyncLatencyBounds(object):
+
+    def __init__(self):
+        # {(method, name): {'lower': {ms: count}, 'upper': {ms: count}}}
+        self.entries = {}
+
+    def _entry(self, method, name):
+        entry = self.entries.get((method, name))
+        if entry is None:
+            entry = self.entries[(method, name)] = {'lower': {}, 'upper': {}}
+        return entry
+
+    def record(self, method, name, lower, upper):
+        """Record a single measurement. lower and upper are in milliseconds"""
+        entry = self._entry(method, name)
+        for key, value in (('lower', lower), ('upper', upper)):
+            value = histogram.round_response_time(int(value))
+            entry[key][value] = entry[key].get(value, 0) + 1
+
+    def serialize(self):
+        return [{'method': method, 'name': name,
+                 'lower': entry['lower'], 'upper': entry['upper']}
+                for (method, name), entry in self.entries.iteritems()]
+
+    def merge(self, serialized):
+        for item in serialized:
+            entry = self._entry(item['method'], item['name'])
+            for key in ('lower', 'upper'):
+                for value, count in item[key].iteritems():
+                    value = int(value)
+                    entry[key][value] = entry[key].get(value, 0) + count
+
+    def reset(self):
+        self.entries = {}
+
+    def summary(self):
+        result = []
+        for (method, name), entry in sorted(self.entries.iteritems()):
+            lower = histogram.summarize(entry['lower'])
+            upper = histogram.summarize(entry['upper'])
+            result.append({
+                'method': method,
+                'name': name,
+                'count': lower['count'],
+                'lower': lower,
+                'upper': upper,
+            })
+        return result
+
+
+bounds = AsyncLatencyBounds()
+
+def send_bounds_to_master(client_id, data):
+    data['async_bounds'] = bounds.serialize()
+    bounds.reset()
+
+def merge_slave_bounds(client_id, data):
+    bounds.merge(data.get('async_bounds', []))
+
+def persist_bounds(stats):
+    stats['async_bounds'] = bounds.summary()
+
+def setup_async_stats():
+    if insight.is_slave():
+        locust.events.report_to_master += send_bounds_to_master
+    else:
+        locust.events.slave_report += merge_slave_bounds
+        persistence.persisting_info += persist_bounds
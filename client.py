@@ -1,6 +1,20 @@
 import logging
+import time
 
 from locust import TaskSet
+import locust.events
+from requests.exceptions import RequestException
+
+import exchange_log
+
+# use a faster json decoder, if there's one installed
+try:
+    import ujson as json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        import json
 
 from requests.packages.urllib3 import disable_warnings
 disable_warnings()
@@ -12,79 +26,222 @@ ROLE_HEADER = 'X-Roles'
 LOG = logging.getLogger(__name__)
 
 
-class DesignateClient(object):
-    """Extends a normal client with Designate specific http requests."""
+class Response(object):
+    """Wraps a response from the http session. The json body is decoded the
+    first time json() is called, and never again. Callers that only look at
+    the status code never pay for decoding.
+
+    Everything else, including the context manager used with
+    catch_response=True, is passed through to the wrapped response.
+    """
+
+    __slots__ = ('_resp', '_json')
+
+    _NOT_DECODED = object()
+
+    def __init__(self, resp):
+        self._resp = resp
+        self._json = self._NOT_DECODED
+
+    def json(self):
+        if self._json is self._NOT_DECODED:
+            self._json = json.loads(self._resp.content)
+        return self._json
+
+    def __getattr__(self, name):
+        return getattr(self._resp, name)
+
+    def __enter__(self):
+        self._resp.__enter__()
+        return self
+
+    def __exit__(self, exc, value, traceback):
+        return self._resp.__exit__(exc, value, traceback)
+
+
+class RequestContext(object):
+    """The parts of a request that only change when the tenant's token does:
+    the headers, and the prefix of the v2 urls. The header dicts are shared by
+    every request made with the context, so they must never be modified."""
 
     _HEADERS = {
         "Content-Type": "application/json",
         "Accept": "application/json",
     }
 
+    def __init__(self, tenant, token, use_project_id, tenant_id_in_url):
+        headers = dict(self._HEADERS)
+        if tenant and use_project_id:
+            headers[PROJECT_ID_HEADER] = tenant.id
+        if token:
+            headers[TOKEN_HEADER] = token
+        self.token = token
+        self.headers = headers
+        self.dns_upload_headers = dict(headers)
+        self.dns_upload_headers['Content-Type'] = 'text/dns'
+        self.dns_download_headers = dict(headers)
+        self.dns_download_headers['Accept'] = 'text/dns'
+
+        self.tenant_id = None
+        self.v2 = "/v2"
+        if tenant and tenant_id_in_url and tenant.tenant_id:
+            self.tenant_id = tenant.tenant_id
+            self.v2 = "/v2/{0}".format(tenant.tenant_id)
+
+    def add_tenant_id(self, url):
+        """Put the tenant id into a raw v2 url, unless it's already there"""
+        if self.tenant_id and self.tenant_id not in url:
+            return url.replace("v2", "v2/{0}".format(self.tenant_id))
+        return url
+
+
+# url builders for each route, relative to the (per-tenant) v2 prefix
+_ZONE = "/zones/{0}".format
+_ZONE_BY_NAME = "/zones?name={0}".format
+_ZONE_IMPORT = "/zones/tasks/imports/{0}".format
+_ZONE_EXPORT_TASK = "/zones/{0}/tasks/export".format
+_ZONE_EXPORT = "/zones/tasks/exports/{0}".format
+_ZONE_EXPORT_FILE = "/zones/tasks/exports/{0}/export".format
+_RECORDSETS = "/zones/{0}/recordsets".format
+_RECORDSET = "/zones/{0}/recordsets/{1}".format
+
+
+class DesignateClient(object):
+    """Extends a normal client with Designate specific http requests.
+
+    The headers and url prefix for the tenant are built once, and rebuilt only
+    when the tenant's token changes. as_user() returns the same client each
+    time for a given tenant.
+    """
+
     def __init__(self, client, tenant=None, use_project_id=False,
                  tenant_id_in_url=True):
         self.client = client
         self.tenant = tenant
         self.use_project_id = use_project_id
         self.tenant_id_in_url = tenant_id_in_url
+        self._context = None
+        # {tenant id: DesignateClient}, shared with the clients from as_user
+        self._users = {}
 
     def as_user(self, tenant):
-        return DesignateClient(
-            client=self.client,
-            tenant=tenant,
-            use_project_id=self.use_project_id,
-            tenant_id_in_url=self.tenant_id_in_url,
-        )
+        user = self._users.get(tenant.id)
+        if user is None or user.tenant is not tenant:
+            user = DesignateClient(
+                client=self.client,
+                tenant=tenant,
+                use_project_id=self.use_project_id,
+                tenant_id_in_url=self.tenant_id_in_url,
+            )
+            user._users = self._users
+            self._users[tenant.id] = user
+        return user
+
+    def _get_context(self):
+        token = None
+        if self.tenant and self.tenant.api_key:
+            token = self.tenant.get_token()
+        context = self._context
+        if context is None or context.token != token:
+            context = self._context = RequestContext(
+                self.tenant, token, self.use_project_id, self.tenant_id_in_url)
+        return context
 
     def _request(self, method, url, *args, **kwargs):
-        # this is horrible. support a flag to disable request logging, but
-        # don't pass that flag to the underlying requests lib
-        no_log_request = kwargs.get('no_log_request', False)
-        if 'no_log_request' in kwargs:
-            del kwargs['no_log_request']
-        self._prepare_headers(kwargs)
-
-        if self.tenant and self.tenant_id_in_url:
-            if self.tenant.tenant_id not in url:
-                url = url.replace("v2", "v2/{0}".format(self.tenant.tenant_id))
-
-        resp = method(url, *args, **kwargs)
+        """Make a request to a raw url (e.g. a 'next' link)"""
+        context = self._get_context()
+        return self._send(method, context.add_tenant_id(url), context.headers,
+                          args, kwargs)
+
+    def _request_v2(self, method, path, *args, **kwargs):
+        """Make a request to a path under the tenant's v2 prefix"""
+        context = self._get_context()
+        return self._send(method, context.v2 + path, context.headers,
+                          args, kwargs)
+
+    def _send(self, method, url, headers, args, kwargs):
+        # support a flag to disable request logging, but don't pass that flag
+        # to the underlying requests lib
+        no_log_request = kwargs.pop('no_log_request', False)
+        extra_headers = kwargs.get('headers')
+        if extra_headers:
+            headers = dict(headers)
+            headers.update(extra_headers)
+        kwargs['headers'] = headers
+
+        if kwargs.get('stream'):
+            return self._download(method, url, args, kwargs)
+
+        resp = Response(method(url, *args, **kwargs))
         if not no_log_request:
-            self._log_if_bad_request(resp)
+            self._log_if_bad_request(resp, kwargs.get('name'))
         return resp
 
-    def _prepare_headers(self, kwargs):
-        """Ensures there are Content-Type and Accept headers,
-        and that the headers are in the kwargs."""
-        new_headers = dict(self._HEADERS)
-        if self.tenant and self.use_project_id:
-            new_headers[PROJECT_ID_HEADER] = self.tenant.id
-        if self.tenant and self.tenant.api_key:
-            new_headers[TOKEN_HEADER] = self.tenant.get_token()
-        new_headers.update(kwargs.get('headers') or {})
-        kwargs['headers'] = new_headers
-
-    def _log_if_bad_request(self, resp):
-        if resp.ok:
-            return
-
-        # format the request
-        msg = "\n{0} {1}".format(resp.request.method, resp.request.url)
-        for k, v in resp.request.headers.items():
-            msg += "\n{0}: {1}".format(k, v)
-        if resp.request.body:
-            msg += "\n{0}".format(resp.request.body)
-        else:
-            msg += "\n<empty-body>"
+    def _download(self, method, url, args, kwargs):
+        """Make a request with stream=True, reading the body in chunks of
+        chunk_size and counting the bytes without keeping them.
+
+        Instead of the usual stats entry, this records two: '<name> - ttfb',
+        the time until the first byte of the body arrived, and
+        '<name> - transfer', the time from then until the last byte, with the
+        number of bytes as the response length. A body that fails part way
+        through is a failed transfer, after a successful ttfb if any of it
+        arrived.
+        """
+        chunk_size = kwargs.pop('chunk_size', 64 * 1024)
+        name = kwargs.get('name') or url
+        # we report the request ourselves, below
+        kwargs['catch_response'] = True
+        start = time.time()
+        resp = Response(method(url, *args, **kwargs))
+
+        try:
+            resp.raise_for_status()
+        except RequestException as e:
+            exchange_log.failed_exchanges.capture(resp, name)
+            resp.close()
+            self._fire(resp, name + ' - ttfb', start, exception=e)
+            return resp
+
+        first_byte_at = None
+        n_bytes = 0
+        try:
+            for chunk in resp.iter_content(chunk_size):
+                if first_byte_at is None:
+                    first_byte_at = time.time()
+                n_bytes += len(chunk)
+        except Exception as e:
+            if first_byte_at is not None:
+                self._fire(resp, name + ' - ttfb', start, end=first_byte_at)
+            self._fire(resp, name + ' - transfer', first_byte_at or start,
+                       exception=e)
+            return resp
+        finally:
+            resp.close()
+
+        end = time.time()
+        first_byte_at = first_byte_at or end
+        self._fire(resp, name + ' - ttfb', start, end=first_byte_at)
+        self._fire(resp, name + ' - transfer', first_byte_at, end=end,
+                   response_length=n_bytes)
+        return resp
 
-        msg += "\n"
+    def _fire(self, resp, name, start, end=None, response_length=0,
+              exception=None):
+        kwargs = dict(
+            request_type=resp.request.method,
+            name=name,
+            response_time=int(((end or time.time()) - start) * 1000),
+        )
+        if exception is None:
+            locust.events.request_success.fire(
+                response_length=response_length, **kwargs)
+        else:
+            locust.events.request_failure.fire(exception=exception, **kwargs)
 
-        # format the response
-        msg += "\n{0} {1}".format(resp.status_code, resp.reason)
-        for k, v in resp.headers.items():
-            msg += "\n{0}: {1}".format(k, v)
-        msg += "\n{0}".format(resp.text)
-        msg = "\n  ".join(msg.split('\n'))
-        LOG.info(msg)
+    def _log_if_bad_request(self, resp, name=None):
+        if not resp.ok:
+            exchange_log.failed_exchanges.capture(resp, name)
 
     #############################################
     # Server calls
@@ -103,74 +260,78 @@ class DesignateClient(object):
     # Zone calls
     #############################################
     def get_zone(self, zone_id, *args, **kwargs):
-        url = "/v2/zones/{0}".format(zone_id)
-        return self._request(self.client.get, url, *args, **kwargs)
+        return self._request_v2(self.client.get, _ZONE(zone_id), *args, **kwargs)
 
     def get_zone_by_name(self, zone_name, *args, **kwargs):
-        url = "/v2/zones?name={0}".format(zone_name)
-        return self._request(self.client.get, url, *args, **kwargs)
+        return self._request_v2(self.client.get, _ZONE_BY_NAME(zone_name),
+                                *args, **kwargs)
 
     def list_zones(self, *args, **kwargs):
-        return self._request(self.client.get, "/v2/zones", *args, **kwargs)
+        return self._request_v2(self.client.get, "/zones", *args, **kwargs)
 
     def post_zone(self, *args, **kwargs):
-        return self._request(self.client.post, "/v2/zones", *args, **kwargs)
+        return self._request_v2(self.client.post, "/zones", *args, **kwargs)
 
     def patch_zone(self, zone_id, *args, **kwargs):
-        url = "/v2/zones/{0}".format(zone_id)
-        return self._request(self.client.patch, url, *args, **kwargs)
+        return self._request_v2(self.client.patch, _ZONE(zone_id),
+                                *args, **kwargs)
 
     def delete_zone(self, zone_id, *args, **kwargs):
-        url = "/v2/zones/{0}".format(zone_id)
-        return self._request(self.client.delete, url, *args, **kwargs)
+        return self._request_v2(self.client.delete, _ZONE(zone_id),
+                                *args, **kwargs)
 
     def import_zone(self, data, *args, **kwargs):
-        """data should be the text from a zone file."""
-        self._prepare_headers(kwargs)
-        kwargs["headers"]["Content-Type"] = "text/dns"
-        return self._request(self.client.post, "/v2/zones/tasks/imports",
-                             *args, data=data, **kwargs)
+        """data should be the text from a zone file, or an iterable of chunks
+        of it (e.g. a RandomZoneFile), which is uploaded as it is read."""
+        context = self._get_context()
+        kwargs['data'] = data
+        return self._send(self.client.post,
+                          context.v2 + "/zones/tasks/imports",
+                          context.dns_upload_headers, args, kwargs)
 
     def get_zone_import(self, import_id, *args, **kwargs):
-        url = "/v2/zones/tasks/imports/{0}".format(import_id)
-        return self._request(self.client.get, url, *args, **kwargs)
+        return self._request_v2(self.client.get, _ZONE_IMPORT(import_id),
+                                *args, **kwargs)
 
     def post_zone_export(self, zone_id, *args, **kwargs):
-        url = "/v2/zones/{0}/tasks/export".format(zone_id)
-        return self._request(self.client.post, url, *args, **kwargs)
+        return self._request_v2(self.client.post, _ZONE_EXPORT_TASK(zone_id),
+                                *args, **kwargs)
 
     def get_zone_export(self, export_id, *args, **kwargs):
-        url = "/v2/zones/tasks/exports/{0}".format(export_id)
-        return self._request(self.client.get, url, *args, **kwargs)
+        return self._request_v2(self.client.get, _ZONE_EXPORT(export_id),
+                                *args, **kwargs)
 
     def get_exported_zone_file(self, export_id, *args, **kwargs):
-        self._prepare_headers(kwargs)
-        kwargs['headers']['Accept'] = 'text/dns'
-        url = "/v2/zones/tasks/exports/{0}/export".format(export_id)
-        return self._request(self.client.get, url, *args, **kwargs)
+        context = self._get_context()
+        return self._send(self.client.get,
+                          context.v2 + _ZONE_EXPORT_FILE(export_id),
+                          context.dns_download_headers, args, kwargs)
 
     #############################################
     # Recordset calls
     #############################################
     def list_recordsets(self, zone_id, *args, **kwargs):
-        url = "/v2/zones/{0}/recordsets".format(zone_id)
-        return self._request(self.client.get, url, *args, **kwargs)
+        return self._request_v2(self.client.get, _RECORDSETS(zone_id),
+                                *args, **kwargs)
 
     def get_recordset(self, zone_id, recordset_id, *args, **kwargs):
-        url = "/v2/zones/{0}/recordsets/{1}".format(zone_id, recordset_id)
-        return self._request(self.client.get, url, *args, **kwargs)
+        return self._request_v2(self.client.get,
+                                _RECORDSET(zone_id, recordset_id),
+                                *args, **kwargs)
 
     def post_recordset(self, zone_id, *args, **kwargs):
-        url = "/v2/zones/{0}/recordsets".format(zone_id)
-        return self._request(self.client.post, url, *args, **kwargs)
+        return self._request_v2(self.client.post, _RECORDSETS(zone_id),
+                                *args, **kwargs)
 
     def put_recordset(self, zone_id, recordset_id, *args, **kwargs):
-        url = "/v2/zones/{0}/recordsets/{1}".format(zone_id, recordset_id)
-        return self._request(self.client.put, url, *args, **kwargs)
+        return self._request_v2(self.client.put,
+                                _RECORDSET(zone_id, recordset_id),
+                                *args, **kwargs)
 
     def delete_recordset(self, zone_id, recordset_id, *args, **kwargs):
-        url = "/v2/zones/{0}/recordsets/{1}".format(zone_id, recordset_id)
-        return self._request(self.client.delete, url, *args, **kwargs)
+        return self._request_v2(self.client.delete,
+                                _RECORDSET(zone_id, recordset_id),
+                                *args, **kwargs)
 
     #############################################
     # Proxy methods for raw http requests
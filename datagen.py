@@ -1,10 +1,21 @@
+import itertools
+import json
+import logging
 import random
+import socket
+import struct
+import uuid
+from collections import deque
+
+import gevent
+
+LOG = logging.getLogger(__name__)
 
 def randomize(string):
     return "{0}{1}".format(string, random.randint(1000000000, 9999999999))
 
 def random_ip():
-    return ".".join(str(random.randint(0, 255)) for _ in range(4))
+    return socket.inet_ntoa(struct.pack('>I', random.getrandbits(32)))
 
 def random_zone_email(name='random_zone', user='rando'):
     name = randomize(randomize(name))
@@ -12,6 +23,127 @@ def random_zone_email(name='random_zone', user='rando'):
     email = "{0}@{1}".format(user, zone).strip('.')
     return zone, email
 
+
+class PayloadPool(object):
+    """A queue of items made in batches of batch_size. When it's half empty,
+    it's refilled by a background greenlet, so the tasks taking items
+    usually don't pay for making them.
+
+    The refill makes slice_size items at a time, yielding to the other
+    greenlets in between, so it doesn't hold up the requests in flight. If
+    the pool runs dry before the refill catches up, items are made one at a
+    time as they're taken.
+    """
+
+    slice_size = 50
+
+    def __init__(self, make, batch_size=1000):
+        self.make = make
+        self.batch_size = batch_size
+        self.items = deque()
+        self.refilling = False
+
+    def take(self):
+        if not self.refilling and len(self.items) <= self.batch_size // 2:
+            self.refilling = True
+            gevent.spawn(self._refill)
+        if not self.items:
+            return self.make()
+        return self.items.popleft()
+
+    def _refill(self):
+        make = self.make
+        try:
+            for start in xrange(0, self.batch_size, self.slice_size):
+                size = min(self.slice_size, self.batch_size - start)
+                self.items.extend(make() for _ in xrange(size))
+                gevent.sleep(0)
+        finally:
+            self.refilling = False
+
+
+class DataGenerator(object):
+    """Hands out names that are unique across slaves and runs, and the json
+    payloads for creating/updating zones and recordsets, serialized ahead of
+    time in batches.
+
+    Every name starts with '<prefix>-<tag>-<n>', where tag is random for each
+    process and n counts up, so names never collide (no more 409s), and
+    everything a test created can be found with a name filter like
+    ?name=<prefix>-*
+    """
+
+    @classmethod
+    def get(cls, _instance=[]):
+        if not _instance:
+            # prepare-tenant.py runs without an accurate_config
+            try:
+                import accurate_config as CONFIG
+                _instance.append(DataGenerator(
+                    prefix=CONFIG.datagen_prefix,
+                    batch_size=CONFIG.datagen_batch_size))
+            except ImportError:
+                _instance.append(DataGenerator())
+        return _instance[0]
+
+    def __init__(self, prefix='locust', batch_size=1000, user='rando'):
+        self.prefix = "{0}-{1}-".format(prefix, uuid.uuid4().hex[:8])
+        self.user = user
+        self.counter = itertools.count()
+        LOG.info("Generated names start with %s", self.prefix)
+
+        self.zones = PayloadPool(self._make_zone, batch_size)
+        self.recordsets = PayloadPool(self._make_recordset, batch_size)
+        self.recordset_updates = PayloadPool(self._make_recordset_update,
+                                             batch_size)
+        self.zone_updates = PayloadPool(self._make_zone_update, batch_size)
+
+    def next_label(self):
+        return "{0}{1}".format(self.prefix, next(self.counter))
+
+    def zone_name(self):
+        return "{0}.com.".format(self.next_label())
+
+    def _make_zone(self):
+        zone_name = self.zone_name()
+        email = "{0}@{1}".format(self.user, zone_name).strip('.')
+        payload = json.dumps({"name": zone_name, "email": email, "ttl": 7200})
+        return zone_name, payload
+
+    def _make_recordset(self):
+        # everything but the end of the name, which depends on the zone
+        label = self.next_label()
+        head = '{{"type": "A", "ttl": 3600, "records": ["{0}"], ' \
+               '"name": "{1}.'.format(random_ip(), label)
+        return label, head
+
+    def _make_recordset_update(self):
+        return json.dumps({"records": [random_ip()],
+                           "ttl": random.randint(2400, 7200)})
+
+    def _make_zone_update(self):
+        return '"ttl": {0}}}'.format(random.randint(2400, 7200))
+
+    def zone(self):
+        """Return (zone name, POST /zones payload)"""
+        return self.zones.take()
+
+    def recordset(self, zone_name):
+        """Return (recordset name, POST /zones/ID/recordsets payload) for an
+        A recordset in the zone"""
+        label, head = self.recordsets.take()
+        return "{0}.{1}".format(label, zone_name), head + zone_name + '"}'
+
+    def recordset_update(self):
+        """Return a PUT /zones/ID/recordsets/ID payload"""
+        return self.recordset_updates.take()
+
+    def zone_update(self, zone_name):
+        """Return a PATCH /zones/ID payload"""
+        return '{{"name": "{0}", "email": "update@{1}", {2}'.format(
+            zone_name, zone_name.strip('.'), self.zone_updates.take())
+
+
 def select_random_item(vals):
     """Return a random item in this list, or None if empty."""
     if vals:
@@ -23,18 +155,69 @@ def pop_random_item(vals):
         i = random.randrange(0, len(vals))
         return vals.pop(i)
 
-def random_zone_file(name='random_import', user='rando'):
+def random_zone_file(name='random_import', user='rando', n_records=2,
+                     zone_name=None):
     """Returns a RandomZoneFile"""
-    return RandomZoneFile(name=name, user=user)
+    return RandomZoneFile(name=name, user=user, n_records=n_records,
+                          zone_name=zone_name)
+
+def random_zone_size(distribution):
+    """Pick a number of records from a list of (n_records, weight)"""
+    total = sum(weight for _, weight in distribution)
+    x = random.uniform(0, total)
+    for n_records, weight in distribution:
+        x -= weight
+        if x <= 0:
+            return n_records
+    return distribution[-1][0]
+
+def random_ipv6():
+    return ":".join("%x" % random.randint(0, 0xffff) for _ in range(8))
+
+# the mix of record types in generated zone files, as (type, weight). every
+# record gets its own owner name, so CNAMEs never clash with other records.
+RECORD_TYPE_MIX = (
+    ('A', 50),
+    ('AAAA', 20),
+    ('CNAME', 15),
+    ('MX', 5),
+    ('TXT', 10),
+)
+
+def _record_line(rtype, owner, zone_name):
+    if rtype == 'A':
+        return "%s IN A %s\n" % (owner, random_ip())
+    elif rtype == 'AAAA':
+        return "%s IN AAAA %s\n" % (owner, random_ipv6())
+    elif rtype == 'CNAME':
+        return "%s IN CNAME ns.%s\n" % (owner, zone_name)
+    elif rtype == 'MX':
+        return "%s IN MX %s mail.%s\n" % (
+            owner, random.randint(1, 50), zone_name)
+    return '%s IN TXT "%s"\n' % (owner, randomize("v=txt"))
 
 class RandomZoneFile(object):
+    """A zone file with an SOA, an NS, and n_records other records: the A
+    records for ns. and mail., and then records of mixed types.
+
+    Iterating over it yields the text in chunks of about CHUNK_SIZE bytes,
+    generated as they're needed. Pass it as the body of a request to upload
+    a large zone without ever holding all of it in memory.
+    """
+
+    CHUNK_SIZE = 64 * 1024
 
-    def __init__(self, name='random_import', user='rando'):
-        name = randomize(randomize(name))
-        self.zone_name = "{0}.com.".format(name)
+    def __init__(self, name='random_import', user='rando', n_records=2,
+                 type_mix=RECORD_TYPE_MIX, zone_name=None):
+        """The zone is named zone_name, or else a randomized name"""
+        if zone_name is None:
+            zone_name = "{0}.com.".format(randomize(randomize(name)))
+        self.zone_name = zone_name
         self.email = "{0}.{1}".format(user, self.zone_name)
+        self.n_records = n_records
+        self.type_mix = type_mix
 
-    def __str__(self):
+    def _header(self):
         result = ""
         result += "$ORIGIN %s\n" % self.zone_name
         result += "$TTL 300\n"
@@ -45,5 +228,35 @@ class RandomZoneFile(object):
         result += "mail.%s IN A %s\n" % (self.zone_name, random_ip())
         return result
 
+    def _record_types(self):
+        """Yield the types of the records beyond ns. and mail."""
+        types = []
+        for rtype, weight in self.type_mix:
+            types.extend([rtype] * weight)
+        for _ in xrange(self.n_records - 2):
+            yield random.choice(types)
+
+    def iter_chunks(self, chunk_size=None):
+        chunk_size = chunk_size or self.CHUNK_SIZE
+        lines = [self._header()]
+        size = len(lines[0])
+        zone_name = self.zone_name
+        for i, rtype in enumerate(self._record_types()):
+            line = _record_line(rtype, "r%s.%s" % (i, zone_name), zone_name)
+            lines.append(line)
+            size += len(line)
+            if size >= chunk_size:
+                yield "".join(lines)
+                lines = []
+                size = 0
+        if lines:
+            yield "".join(lines)
+
+    def __iter__(self):
+        return self.iter_chunks()
+
+    def __str__(self):
+        return "".join(self.iter_chunks())
+
     def get_zone_file_text(self):
         return str(self)
@@ -21,6 +21,7 @@ import requests
 from requests.exceptions import RequestException
 import gevent
 
+import exchange_log
 import persistence
 import accurate_config as CONFIG
 
@@ -28,27 +29,6 @@ LOG = logging.getLogger(__name__)
 EPOCH_START = datetime.datetime(1970, 1, 1)
 
 
-def resp_to_string(resp):
-    # format the request
-    msg = "\n{0} {1}".format(resp.request.method, resp.request.url)
-    for k, v in resp.request.headers.items():
-        msg += "\n{0}: {1}".format(k, v)
-    if resp.request.body:
-        msg += "\n{0}".format(resp.request.body)
-    else:
-        msg += "\n<empty-body>"
-
-    msg += "\n"
-
-    # format the response
-    msg += "\n{0} {1}".format(resp.status_code, resp.reason)
-    for k, v in resp.headers.items():
-        msg += "\n{0}: {1}".format(k, v)
-    msg += "\n{0}".format(resp.text)
-    msg = "\n  ".join(msg.split('\n'))
-    return msg
-
-
 class DigaasClient(object):
 
     ZONE_CREATE = 'ZONE_CREATE'
@@ -75,7 +55,7 @@ class DigaasClient(object):
             resp = requests.get(self.endpoint)
             if not resp.ok:
                 LOG.error("Failed to connect to digaas")
-                LOG.error(resp_to_string(resp))
+                LOG.error(exchange_log.format_response(resp))
                 return False
         except RequestException as e:
             LOG.error("Failed to connect to digaas")
@@ -163,10 +143,8 @@ class DigaasBehaviors(object):
         return datetime.datetime.strptime(created_at, '%Y-%m-%dT%H:%M:%S.%f')
 
     def _debug_resp(self, resp):
-        if resp.ok:
-            return
-        msg = resp_to_string(resp)
-        LOG.debug(msg)
+        if not resp.ok:
+            exchange_log.failed_exchanges.capture(resp, 'digaas observer')
 
     def observe_zone_create(self, resp, start_time, name=None):
         """
@@ -189,8 +167,9 @@ class DigaasBehaviors(object):
             self._debug_resp(r)
 
     def observe_zone_update(self, resp, start_time):
-        name = resp.json()['name']
-        serial = resp.json()['serial']
+        body = resp.json()
+        name = body['name']
+        serial = body['serial']
         for nameserver in self.config.nameservers:
             r = self.client.post_observer(
                 name=name,
@@ -216,9 +195,10 @@ class DigaasBehaviors(object):
             self._debug_resp(r)
 
     def observe_record_create(self, resp, start_time):
-        name = resp.json()["name"]
-        rdata = resp.json()["records"][0]
-        rdatatype = resp.json()["type"]
+        body = resp.json()
+        name = body["name"]
+        rdata = body["records"][0]
+        rdatatype = body["type"]
 
         for nameserver in self.config.nameservers:
             r = self.client.post_observer(
@@ -234,9 +214,10 @@ class DigaasBehaviors(object):
             self._debug_resp(r)
 
     def observe_record_update(self, resp, start_time):
-        name = resp.json()["name"]
-        rdata = resp.json()["records"][0]
-        rdatatype = resp.json()["type"]
+        body = resp.json()
+        name = body["name"]
+        rdata = body["records"][0]
+        rdatatype = body["type"]
 
         for nameserver in self.config.nameservers:
             r = self.client.post_observer(
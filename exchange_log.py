@@ -0,0 +1,221 @@
+"""
+Keeps a sample of failed request/response exchanges for debugging.
+
+Formatting every failed exchange into the log is expensive, and during an
+outage every request fails, so it slows the load generator down exactly when
+we want accurate numbers. Instead, the raw exchanges go into a bounded ring
+buffer. Each (method, name, status) key is rate limited by a token bucket,
+and can also be randomly sampled, so a flood of identical failures keeps only
+a few examples. Nothing is formatted until someone looks:
+
+    - the master serves the latest exchanges at /failures
+    - when the test stops, they are dumped to a file next to the report
+
+Slaves send the exchanges they captured to the master with each report.
+"""
+import random
+import time
+from collections import deque, namedtuple
+
+import locust.events
+
+import insight
+import persistence
+
+# headers we don't want to show up in the dumps
+REDACTED_HEADERS = ('x-auth-token',)
+
+Exchange = namedtuple('Exchange', [
+    'timestamp', 'source', 'name', 'method', 'url', 'request_headers',
+    'request_body', 'status_code', 'reason', 'response_headers',
+    'response_body'])
+
+
+class ExchangeLog(object):
+
+    def __init__(self, capacity=1000, rate=1.0, burst=5, sample_rate=1.0,
+                 max_body=4096):
+        """
+        :param capacity: the max number of exchanges to keep
+        :param rate: the number of exchanges per second to keep for each
+            (method, name, status)
+        :param burst: the number of exchanges to keep for a key before the
+            rate limit kicks in
+        :param sample_rate: the fraction of failures considered for capture
+        :param max_body: bodies are truncated to this many bytes
+        """
+        self.exchanges = deque(maxlen=capacity)
+        self.rate = rate
+        self.burst = burst
+        self.sample_rate = sample_rate
+        self.max_body = max_body
+        # {(method, name, status): [tokens, last refill time]}
+        self.buckets = {}
+        # {(method, name, status): [failures seen, exchanges captured]}
+        self.counts = {}
+        # exchanges captured since the last report to the master
+        self.unreported = []
+
+    def _admit(self, key, now):
+        counts = self.counts.get(key)
+        if counts is None:
+            counts = self.counts[key] = [0, 0]
+        counts[0] += 1
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return False
+
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [self.burst, now]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        counts[1] += 1
+        return True
+
+    def capture(self, resp, name=None):
+        """Keep the failed exchange, if its key isn't over the rate limit.
+        This only keeps references to the request and response parts."""
+        request = resp.request
+        name = name or request.path_url
+        now = time.time()
+        if not self._admit((request.method, name, resp.status_code), now):
+            return
+        self._add(Exchange(
+            timestamp=now,
+            source=None,
+            name=name,
+            method=request.method,
+            url=request.url,
+            request_headers=request.headers,
+            request_body=_request_body(request.body),
+            status_code=resp.status_code,
+            reason=resp.reason,
+            response_headers=resp.headers,
+            response_body=(resp.content or '')[:self.max_body],
+        ))
+
+    def _add(self, exchange):
+        self.exchanges.append(exchange)
+        self.unreported.append(exchange)
+        # don't hold onto more than we could keep if the master is slow
+        if len(self.unreported) > self.exchanges.maxlen:
+            del self.unreported[0]
+
+    def serialize_unreported(self):
+        """Return the exchanges captured since the last call, in a form that
+        can be sent to the master"""
+        result = [dict(exchange._asdict(),
+                       request_headers=_header_items(exchange.request_headers),
+                       response_headers=_header_items(exchange.response_headers))
+                  for exchange in self.unreported]
+        self.unreported = []
+        return result
+
+    def merge(self, client_id, serialized):
+        for item in serialized:
+            item['source'] = client_id
+            self.exchanges.append(Exchange(**item))
+
+    def latest(self, limit=None):
+        """Return the most recent exchanges, newest first"""
+        exchanges = list(reversed(self.exchanges))
+        return exchanges[:limit] if limit else exchanges
+
+    def dump(self, limit=None):
+        return u"\n\n".join(format_exchange(e) for e in self.latest(limit))
+
+
+def _header_items(headers):
+    if headers is None:
+        return []
+    return [[k, v] for k, v in headers.items()]
+
+
+def _request_body(body):
+    """Don't keep streamed request bodies, which have already been sent"""
+    if body is None or isinstance(body, basestring):
+        return body
+    return "<streamed-body>"
+
+
+def _text(value):
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return unicode(value)
+
+
+def _format_headers(lines, headers):
+    items = headers.items() if hasattr(headers, 'items') else headers
+    for k, v in items:
+        if k.lower() in REDACTED_HEADERS:
+            v = '<redacted>'
+        lines.append(u"{0}: {1}".format(_text(k), _text(v)))
+
+
+def format_exchange(exchange):
+    lines = [u"[{0}] {1}{2}".format(
+        time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(exchange.timestamp)),
+        _text(exchange.name),
+        u" from {0}".format(exchange.source) if exchange.source else u"")]
+    lines.append(u"{0} {1}".format(exchange.method, _text(exchange.url)))
+    _format_headers(lines, exchange.request_headers or [])
+    lines.append(_text(exchange.request_body or "<empty-body>"))
+    lines.append(u"")
+    lines.append(u"{0} {1}".format(exchange.status_code, _text(exchange.reason)))
+    _format_headers(lines, exchange.response_headers or [])
+    lines.append(_text(exchange.response_body or "<empty-body>"))
+    return u"\n  ".join(lines)
+
+
+def format_response(resp):
+    """Format a single response right away. Only use this where the failure
+    is fatal anyway, e.g. before raising an exception."""
+    request = resp.request
+    return u"\n  " + format_exchange(Exchange(
+        timestamp=time.time(),
+        source=None,
+        name=request.path_url,
+        method=request.method,
+        url=request.url,
+        request_headers=request.headers,
+        request_body=_request_body(request.body),
+        status_code=resp.status_code,
+        reason=resp.reason,
+        response_headers=resp.headers,
+        response_body=resp.text,
+    ))
+
+
+failed_exchanges = ExchangeLog()
+
+def send_exchanges_to_master(client_id, data):
+    data['failed_exchanges'] = failed_exchanges.serialize_unreported()
+
+def merge_slave_exchanges(client_id, data):
+    failed_exchanges.merge(client_id, data.get('failed_exchanges', []))
+
+def persist_exchanges(stats):
+    """Dump the exchanges to a file in the persistence dir, which the report
+    links to"""
+    stats['failed_exchanges'] = {
+        'kept': len(failed_exchanges.exchanges),
+    }
+    if not failed_exchanges.exchanges:
+        return
+    filename = 'failed_exchanges{0}.txt'.format(int(time.time()))
+    with open('{0}/{1}'.format(persistence.persistence_dir, filename), 'w') as f:
+        f.write(failed_exchanges.dump().encode('utf-8', 'replace'))
+    stats['failed_exchanges']['file'] = filename
+
+def setup_exchange_log(capacity, rate, burst, sample_rate, max_body):
+    global failed_exchanges
+    failed_exchanges = ExchangeLog(capacity, rate, burst, sample_rate, max_body)
+    if insight.is_slave():
+        locust.events.report_to_master += send_exchanges_to_master
+    else:
+        locust.events.slave_report += merge_slave_exchanges
+        persistence.persisting_info += persist_exchanges
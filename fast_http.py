@@ -0,0 +1,384 @@
+"""
+An alternative to Locust's HttpSession, built on geventhttpclient.
+
+HttpSession is python-requests underneath, which spends a lot of CPU on each
+request. FastHttpSession supports the parts of the HttpSession API that the
+DesignateClient uses (get/post/put/patch/delete with name, catch_response,
+params, data, headers and stream) and fires the same request_success/request_failure
+events, with the same names, so the stats look the same with either engine.
+
+Like requests, data may be an iterable of strings instead of a string, in
+which case the body is sent with chunked transfer encoding, on a new
+connection. Such a body can only be read once, so unlike other requests, it
+isn't resent if the connection drops; the request fails instead.
+
+Failed requests fire request_failure with the same exception types as
+HttpSession: ConnectionError when there's no response, HTTPError for an
+error status, and ChunkedEncodingError when a body is cut short.
+
+Connections are kept alive in a pool per host, shared by every session in
+the process, with at most http_pool_size connections to each host.
+
+Set http_engine = 'fast' in the config to use it.
+"""
+import json
+import time
+import urllib
+from urlparse import urlsplit
+
+import requests
+from requests.exceptions import (ChunkedEncodingError, ConnectionError,
+                                 RequestException)
+from requests.structures import CaseInsensitiveDict
+import locust.events
+from locust.exception import CatchResponseError, ResponseError
+
+import gevent.socket
+import gevent.ssl
+try:
+    from geventhttpclient import HTTPClient
+    from geventhttpclient.response import HTTPSocketResponse
+except ImportError:
+    HTTPClient = None
+
+# {(scheme, host, port): HTTPClient}
+pools = {}
+
+
+def get_pool(scheme, host, port, size, timeout):
+    key = (scheme, host, port)
+    pool = pools.get(key)
+    if pool is None:
+        pool = pools[key] = HTTPClient(
+            host, port,
+            concurrency=size,
+            connection_timeout=timeout,
+            network_timeout=timeout,
+            ssl=(scheme == 'https'),
+            insecure=True,
+        )
+    return pool
+
+
+class ChunkedBody(object):
+    """A file-like object that reads an iterable of strings with chunked
+    transfer encoding, so a body can be uploaded as it's generated"""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.done = False
+
+    def read(self, size=-1):
+        if self.done:
+            return ''
+        for chunk in self.chunks:
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode('utf-8')
+            if chunk:
+                return '%x\r\n%s\r\n' % (len(chunk), chunk)
+        self.done = True
+        return '0\r\n\r\n'
+
+
+def send_streamed(scheme, host, port, timeout, method, path_url, body,
+                  headers):
+    """Send a request with a ChunkedBody on a new connection, and return the
+    response.
+
+    The pools' HTTPClients send a request again when the connection drops,
+    reading the body again, but a ChunkedBody has already been read, so the
+    server would get an empty or truncated body. That happens whenever the
+    server has closed a pooled connection while it was idle. A new connection
+    can't be stale, so the request is only sent once.
+    """
+    sock = gevent.socket.create_connection((host, port), timeout=timeout)
+    try:
+        if scheme == 'https':
+            context = gevent.ssl.create_default_context()
+            context.check_hostname = False
+            context.verify_mode = gevent.ssl.CERT_NONE
+            sock = context.wrap_socket(sock, server_hostname=host)
+        default_port = 443 if scheme == 'https' else 80
+        lines = ['{0} {1} HTTP/1.1'.format(method.upper(), path_url),
+                 'Host: {0}'.format(host if port == default_port
+                                    else '{0}:{1}'.format(host, port)),
+                 'Connection: close']
+        lines.extend('{0}: {1}'.format(name, value)
+                     for name, value in headers.iteritems())
+        sock.sendall('\r\n'.join(lines) + '\r\n\r\n')
+        while True:
+            chunk = body.read()
+            if not chunk:
+                break
+            sock.sendall(chunk)
+        return HTTPSocketResponse(sock, method=method.upper())
+    except Exception:
+        sock.close()
+        raise
+
+
+def body_error(e):
+    """Return the exception HttpSession raises when reading a body fails
+    with e"""
+    if isinstance(e, RequestException):
+        return e
+    if isinstance(e, gevent.socket.timeout):
+        return ConnectionError(e)
+    return ChunkedEncodingError(e)
+
+
+class FastRequest(object):
+    """The parts of a requests.PreparedRequest used when logging a request"""
+
+    def __init__(self, method, url, path_url, headers, body):
+        self.method = method
+        self.url = url
+        self.path_url = path_url
+        self.headers = headers
+        self.body = body
+
+
+class FastResponse(object):
+    """The parts of a requests.Response that we use"""
+
+    def __init__(self, request, status_code=0, reason=None, raw_headers=(),
+                 content=None, error=None, raw=None):
+        self.request = request
+        self.url = request.url
+        self.status_code = status_code
+        self.reason = reason
+        self.content = content
+        self.error = error
+        self._raw_headers = raw_headers
+        self._headers = None
+        # the unread geventhttpclient response, when streaming
+        self._raw = raw
+
+    @property
+    def headers(self):
+        if self._headers is None:
+            self._headers = CaseInsensitiveDict(self._raw_headers)
+        return self._headers
+
+    @property
+    def text(self):
+        if self.content is None:
+            return u''
+        return self.content.decode('utf-8', 'replace')
+
+    @property
+    def ok(self):
+        try:
+            self.raise_for_status()
+        except RequestException:
+            return False
+        return True
+
+    def json(self, **kwargs):
+        return json.loads(self.content, **kwargs)
+
+    def iter_content(self, chunk_size=1):
+        """Yield the body in chunks, without keeping it. Only for responses
+        to requests made with stream=True."""
+        if self._raw is None:
+            if self.content:
+                yield self.content
+            return
+        # geventhttpclient waits for a whole chunk, so the first byte is
+        # read on its own, to see when the body starts to arrive
+        size = 1
+        try:
+            while True:
+                try:
+                    chunk = self._raw.read(size)
+                except Exception as e:
+                    raise body_error(e)
+                if not chunk:
+                    break
+                yield chunk
+                size = chunk_size
+        finally:
+            self.close()
+
+    def close(self):
+        if self._raw is not None:
+            self._raw.release()
+            self._raw = None
+
+    def raise_for_status(self):
+        if self.error is not None:
+            raise self.error
+        if self.status_code >= 400:
+            # let requests build the exception, so the error messages are the
+            # same as with locust's HttpSession
+            resp = requests.Response()
+            resp.status_code = self.status_code
+            resp.reason = self.reason
+            resp.url = self.url
+            resp.raise_for_status()
+
+
+class FastResponseContextManager(FastResponse):
+    """Lets the caller decide whether a response is a success or a failure,
+    like locust's ResponseContextManager"""
+
+    _is_reported = False
+
+    def __init__(self, response, request_meta):
+        self.__dict__ = response.__dict__
+        self.locust_request_meta = request_meta
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc, value, traceback):
+        if self._is_reported:
+            return exc is None
+
+        if exc:
+            if isinstance(value, ResponseError):
+                self.failure(value)
+            else:
+                return False
+        else:
+            try:
+                self.raise_for_status()
+            except RequestException as e:
+                self.failure(e)
+            else:
+                self.success()
+        return True
+
+    def success(self):
+        locust.events.request_success.fire(
+            request_type=self.locust_request_meta["method"],
+            name=self.locust_request_meta["name"],
+            response_time=self.locust_request_meta["response_time"],
+            response_length=self.locust_request_meta["content_size"],
+        )
+        self._is_reported = True
+
+    def failure(self, exc):
+        if isinstance(exc, basestring):
+            exc = CatchResponseError(exc)
+        locust.events.request_failure.fire(
+            request_type=self.locust_request_meta["method"],
+            name=self.locust_request_meta["name"],
+            response_time=self.locust_request_meta["response_time"],
+            exception=exc,
+        )
+        self._is_reported = True
+
+
+class FastHttpSession(object):
+
+    def __init__(self, base_url, pool_size=10, timeout=60):
+        if HTTPClient is None:
+            raise Exception("http_engine = 'fast' requires geventhttpclient "
+                            "(pip install geventhttpclient)")
+        self.base_url = base_url.rstrip('/')
+        self.pool_size = pool_size
+        self.timeout = timeout
+
+    def request(self, method, url, name=None, catch_response=False,
+                params=None, data=None, headers=None, stream=False, **kwargs):
+        if not url.startswith('http://') and not url.startswith('https://'):
+            url = self.base_url + url
+        scheme, netloc, path, query, _ = urlsplit(url)
+        if params:
+            extra = urllib.urlencode(params, doseq=True)
+            query = query + '&' + extra if query else extra
+            url = url.split('?', 1)[0] + '?' + query
+        path_url = path + '?' + query if query else path
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        request = FastRequest(method, url, path_url, headers or {}, data)
+
+        start_time = time.time()
+        response = self._send(request, scheme, netloc, stream)
+        request_meta = {
+            "method": method,
+            "name": name or path_url,
+            "response_time": int((time.time() - start_time) * 1000),
+        }
+        # like locust, don't read a streamed body just to find its size
+        if stream:
+            request_meta["content_size"] = int(
+                response.headers.get("content-length") or 0)
+        else:
+            request_meta["content_size"] = len(response.content or "")
+
+        if catch_response:
+            return FastResponseContextManager(response, request_meta)
+        try:
+            response.raise_for_status()
+        except RequestException as e:
+            locust.events.request_failure.fire(
+                request_type=request_meta["method"],
+                name=request_meta["name"],
+                response_time=request_meta["response_time"],
+                exception=e,
+            )
+        else:
+            locust.events.request_success.fire(
+                request_type=request_meta["method"],
+                name=request_meta["name"],
+                response_time=request_meta["response_time"],
+                response_length=request_meta["content_size"],
+            )
+        return response
+
+    def _send(self, request, scheme, netloc, stream=False):
+        host, _, port = netloc.partition(':')
+        port = int(port) if port else (443 if scheme == 'https' else 80)
+        try:
+            body, headers = request.body or '', request.headers
+            if not isinstance(body, basestring):
+                # an iterable, like a generated zone file
+                headers = dict(headers, **{'Transfer-Encoding': 'chunked'})
+                resp = send_streamed(scheme, host, port, self.timeout,
+                                     request.method, request.path_url,
+                                     ChunkedBody(body), headers)
+            else:
+                pool = get_pool(scheme, host, port, self.pool_size,
+                                self.timeout)
+                resp = pool.request(request.method, request.path_url,
+                                    body=body, headers=headers)
+            if stream:
+                return FastResponse(
+                    request,
+                    status_code=resp.status_code,
+                    reason=resp.status_message,
+                    raw_headers=resp.items(),
+                    raw=resp,
+                )
+        except Exception as e:
+            return FastResponse(request, error=ConnectionError(e))
+        try:
+            content = resp.read()
+        except Exception as e:
+            return FastResponse(request, error=body_error(e))
+        finally:
+            resp.release()
+        return FastResponse(
+            request,
+            status_code=resp.status_code,
+            reason=resp.status_message,
+            raw_headers=resp.items(),
+            content=content,
+        )
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self.request('POST', url, data=data, **kwargs)
+
+    def put(self, url, data=None, **kwargs):
+        return self.request('PUT', url, data=data, **kwargs)
+
+    def patch(self, url, data=None, **kwargs):
+        return self.request('PATCH', url, data=data, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
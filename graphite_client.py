@@ -1,77 +1,110 @@
+import cPickle as pickle
+import struct
 import sys
 import logging
 
-import locust
-import gevent
-from gevent.socket import socket
-from gevent.queue import Queue
+from gevent import select, socket
 
 import insight
+import metrics
 
 LOG = logging.getLogger(__name__)
 
-graphite_queue = Queue()
+PLAINTEXT = 'plaintext'
+PICKLE = 'pickle'
 
 def _escape_metric_name(name):
     """Graphite does not allow spaces or slashes"""
     return name.replace(' ', '_').replace('/', '-')
 
-def graphite_worker(host, port):
-    """The worker pops each item off the queue and sends it to graphite."""
-    sock = socket()
-    try:
-        sock.connect((host, port))
-    except Exception as e:
-        LOG.error("Failed to connect to Graphite at {0}:{1}".format(host, port))
-        LOG.error("{0}".format(e))
-        return
 
-    LOG.info("Connected to graphite at {0}:{1}".format(host, port))
-
-    while True:
-        data = graphite_queue.get()
-        # print "graphite_worker: got data {0!r}".format(data)
-        sock.sendall(data)
-
-def _get_requests_per_second_graphite_message(stat, client_id):
-    request = stat['method'] + stat['name'].replace('/', '-')
-
-    graphite_key = "locust.{0}.reqs_per_sec.{1}".format(request, client_id)
-    graphite_data = "".join(
-        "{0} {1} {2}\n".format(graphite_key, count, epoch_time)
-        for epoch_time, count in stat['num_reqs_per_sec'].iteritems())
-    return graphite_data
-
-def _get_response_time_graphite_message(stat, client_id):
-    request = stat['method'] + stat['name'].replace('/', '-')
-    request = _escape_metric_name(request)
-
-    graphite_key = "locust.{0}.response_time.{1}".format(request, client_id)
-    epoch_time = int(stat['start_time'])
-
-    # flatten a dictionary of {time: count} to [time, time, time, ...]
-    response_times = []
-    for t, count in stat['response_times'].iteritems():
-        for _ in xrange(count):
-            response_times.append(t)
-
-    graphite_data = "".join(
-        "{0} {1} {2}\n".format(graphite_key, response_time, epoch_time)
-        for response_time in response_times)
-    return graphite_data
-
-def graphite_producer(client_id, data):
-    """This takes a Locust client_id and some data, as given to
-    locust.event.slave_report handlers."""
-    #print "Got data: ", data, 'from client', client_id
-    for stat in data['stats']:
-        graphite_data = (
-            _get_response_time_graphite_message(stat, client_id)
-            + _get_requests_per_second_graphite_message(stat, client_id))
-        graphite_queue.put(graphite_data)
-
-def setup_graphite_communication(graphite_host, graphite_port):
+class GraphiteSink(metrics.BufferedSink):
+    """Sends batches of metrics to carbon, using either the pickle protocol or
+    plaintext lines. Metric paths look like:
+
+        locust.<request>.<name>.<client_id>
+        locust.cluster.<request>.<name>
+
+    The cluster-wide metrics get their own prefix so that wildcards across
+    slaves (e.g. locust.<request>.reqs_per_sec.*) don't count them twice.
+    """
+
+    def __init__(self, host, port, protocol=PICKLE, **kwargs):
+        super(GraphiteSink, self).__init__(**kwargs)
+        if protocol not in (PLAINTEXT, PICKLE):
+            raise ValueError("Unknown graphite protocol %r" % protocol)
+        self.name = 'graphite://{0}:{1}'.format(host, port)
+        self.host = host
+        self.port = port
+        self.protocol = protocol
+        self.sock = None
+        self.connects = 0
+
+    @classmethod
+    def path(cls, metric):
+        if metric.source == metrics.CLUSTER_SOURCE:
+            return "locust.{0}.{1}.{2}".format(
+                metric.source, _escape_metric_name(metric.request), metric.name)
+        return "locust.{0}.{1}.{2}".format(
+            _escape_metric_name(metric.request), metric.name, metric.source)
+
+    def serialize(self, batch):
+        if self.protocol == PICKLE:
+            payload = pickle.dumps(
+                [(self.path(m), (m.timestamp, m.value)) for m in batch],
+                protocol=2)
+            return struct.pack('!L', len(payload)) + payload
+        return "".join("{0} {1} {2}\n".format(self.path(m), m.value, m.timestamp)
+                       for m in batch)
+
+    def _closed_by_carbon(self):
+        """Carbon never sends anything back, so if the connection is readable,
+        carbon has closed it. A batch sent on it would be lost, though
+        sendall() would succeed."""
+        readable, _, _ = select.select([self.sock], [], [], 0)
+        if not readable:
+            return False
+        try:
+            return not self.sock.recv(4096)
+        except socket.error:
+            return True
+
+    def write(self, batch):
+        if self.sock is not None and self._closed_by_carbon():
+            LOG.warning("Graphite at {0}:{1} closed the connection".format(
+                self.host, self.port))
+            self.disconnect()
+        if self.sock is None:
+            sock = socket.socket()
+            try:
+                sock.connect((self.host, self.port))
+            except socket.error:
+                sock.close()
+                raise
+            self.sock = sock
+            self.connects += 1
+            LOG.info("Connected to graphite at {0}:{1}".format(
+                self.host, self.port))
+        self.sock.sendall(self.serialize(batch))
+
+    def disconnect(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def counters(self):
+        result = super(GraphiteSink, self).counters()
+        result['connects'] = self.connects
+        return result
+
+
+def setup_graphite_communication(graphite_host, graphite_port, **kwargs):
+    """kwargs are passed through to the GraphiteSink"""
+    if not graphite_host:
+        LOG.warning("no graphite host configured -- not sending metrics")
+        return
     # only the master sends data to graphite
     if not insight.is_slave():
-        gevent.spawn(graphite_worker, graphite_host, graphite_port)
-        locust.events.slave_report += graphite_producer
+        sink = GraphiteSink(graphite_host, graphite_port, **kwargs)
+        sink.start()
+        metrics.add_sink(sink)
@@ -1,8 +1,14 @@
 import time
 import logging
+from collections import namedtuple
 
 import gevent
+from gevent.lock import BoundedSemaphore
+import locust.events
 
+import histogram
+import insight
+import persistence
 import accurate_config as CONFIG
 
 GREENLET_TIMEOUT = CONFIG.async_timeout + CONFIG.async_interval + 120
@@ -12,55 +18,232 @@ LOG.info("Async timeout = %s seconds", CONFIG.async_timeout)
 LOG.info("Async interval = %s seconds", CONFIG.async_interval)
 LOG.info("Greenlet timeout is %s seconds", GREENLET_TIMEOUT)
 
+# what spawn() does when an operation type is at its in-flight limit
+BLOCK = 'block'
+DROP = 'drop'
+SHED = 'shed'
 
-class GreenletManager(list):
+
+# the operation a tracked greenlet is running, and when it was spawned
+TrackedOp = namedtuple('TrackedOp', ['op', 'start_time'])
+
+
+class AdmissionError(Exception):
+    def __init__(self, msg):
+        super(AdmissionError, self).__init__(msg)
+
+
+class GreenletKilled(Exception):
+    def __init__(self, msg):
+        super(GreenletKilled, self).__init__(msg)
+
+
+class GreenletManager(object):
+    """Keeps track of the greenlets running asynchronous operations, and
+    limits how many of each type of operation are in flight.
+
+    Usage:
+        # run do_thing in a greenlet
+        greenlet_manager.spawn('create_domain', lambda: do_thing(arg, arg))
+
+        # give the remaining greenlets 5 seconds to finish up. Then kill them.
+        greenlet_manager.cleanup_greenlets(timeout=5)
+    """
 
     @classmethod
     def get(cls, _instance=[]):
         if not _instance:
-            _instance.append(GreenletManager())
+            _instance.append(GreenletManager(
+                max_in_flight=CONFIG.async_max_in_flight,
+                limits=CONFIG.async_max_in_flight_per_op,
+                policy=CONFIG.async_admission_policy,
+            ))
         return _instance[0]
 
-    def tracked_greenlet(self, f):
-        """A wrapper function that stores the current greenlet in list in order
-        to keep track of our asynchronous request 'threads'. The greenlet
-        remains in the list until it terminates, or until an explicit cleanup.
-
-        There is an implicit timeout on the runtime of greenlets. It is
-        computed automatically, and is guaranteed to be sufficiently longer
-        than than the async_timeout + async_interval.
-
-        Usage:
-            for _ in xrange(...):
-                # spawn
-                gevent.spawn(
-                    greenlet_manager.tracked_greenlet,
-                    lambda: do_thing(arg, arg)
-                )
-
-            # wait for greenlets to do a thing
-            # if they terminate, they'll remove themselves from this list
-            # if not, they remain in the list
-            gevent.sleep(5)
-
-            # give the remaining greenlets 5 seconds to finish up. Then kill them.
-            greenlet_manager.cleanup_greenlets(timeout=5)
+    def __init__(self, max_in_flight=None, limits=None, policy=BLOCK):
         """
+        :param max_in_flight: the default limit on the number of in-flight
+            operations of each type, or None for no limit
+        :param limits: a dict of {op: limit} overriding the default
+        :param policy: what spawn() does when an op is at its limit:
+            BLOCK - wait for a slot. This blocks the calling locust, which
+                reduces the offered load while Designate is slow.
+            DROP - don't run the operation
+            SHED - don't run the operation, and record a failure for it
+        """
+        if policy not in (BLOCK, DROP, SHED):
+            raise ValueError("Unknown admission policy %r" % policy)
+        self.max_in_flight = max_in_flight
+        self.limits = limits or {}
+        self.policy = policy
+        self.semaphores = {}
+        self.in_flight = {}
+        self.waiting = {}
+        self.dropped = {}
+        self.shed = {}
+        # {greenlet: TrackedOp} for every greenlet that hasn't finished
+        self.tracked = {}
+        # {op: {age_ms: count}} for greenlets killed by a timeout or cleanup
+        self.killed = {}
+
+    def __len__(self):
+        return len(self.tracked)
+
+    def _semaphore(self, op):
+        if op not in self.semaphores:
+            limit = self.limits.get(op, self.max_in_flight)
+            self.semaphores[op] = BoundedSemaphore(limit) if limit else None
+            for counts in (self.in_flight, self.waiting, self.dropped, self.shed):
+                counts[op] = 0
+        return self.semaphores[op]
+
+    def spawn(self, op, f):
+        """Run f in a tracked greenlet, subject to the in-flight limit for op
+        (e.g. 'create_domain'). Return the greenlet, or None if the operation
+        was dropped or shed."""
+        semaphore = self._semaphore(op)
+        if semaphore is not None:
+            if semaphore.locked() and self.policy != BLOCK:
+                self._reject(op)
+                return None
+            self.waiting[op] += 1
+            try:
+                semaphore.acquire()
+            finally:
+                self.waiting[op] -= 1
+
+        self.in_flight[op] += 1
+        greenlet = gevent.spawn(self.tracked_greenlet, f)
+        self.tracked[greenlet] = TrackedOp(op, time.time())
+
+        # links run even if the greenlet is killed before it starts
+        def _done(_):
+            del self.tracked[greenlet]
+            self.in_flight[op] -= 1
+            if semaphore is not None:
+                semaphore.release()
+        greenlet.rawlink(_done)
+        return greenlet
+
+    def _reject(self, op):
+        if self.policy == DROP:
+            self.dropped[op] += 1
+            return
+        self.shed[op] += 1
+        locust.events.request_failure.fire(
+            request_type='ASYNC',
+            name=op,
+            response_time=0,
+            exception=AdmissionError(
+                "Shed - too many %s operations in flight" % op),
+        )
+
+    def snapshot(self):
+        """Return {op: {gauge: value}} for each op. The gauges are the number
+        of operations in_flight, waiting for a slot, dropped, shed and killed,
+        and the age_p50, age_p99 and age_max (in ms) of those in flight."""
+        now = time.time()
+        ages = {}
+        for tracked in self.tracked.itervalues():
+            age = histogram.round_response_time(
+                int((now - tracked.start_time) * 1000))
+            op_ages = ages.setdefault(tracked.op, {})
+            op_ages[age] = op_ages.get(age, 0) + 1
+
+        result = {}
+        for op in self.semaphores:
+            summary = histogram.summarize(ages.get(op, {})) or {}
+            result[op] = {
+                'in_flight': self.in_flight[op],
+                'waiting': self.waiting[op],
+                'dropped': self.dropped[op],
+                'shed': self.shed[op],
+                'killed': sum(self.killed.get(op, {}).itervalues()),
+                'age_p50': summary.get('p50', 0),
+                'age_p99': summary.get('p99', 0),
+                'age_max': summary.get('max', 0),
+            }
+        return result
+
+    def report_to_master(self, client_id, data):
+        """A locust.events.report_to_master handler that sends the snapshot to
+        the master with each slave report"""
+        data['async_ops'] = self.snapshot()
+
+    def _record_killed(self, tracked, now, message):
+        """Record a greenlet killed before it finished as a failure of its
+        operation, with its age as the response time"""
+        age = int((now - tracked.start_time) * 1000)
+        op_ages = self.killed.setdefault(tracked.op, {})
+        rounded = histogram.round_response_time(age)
+        op_ages[rounded] = op_ages.get(rounded, 0) + 1
+        locust.events.request_failure.fire(
+            request_type='ASYNC',
+            name=tracked.op,
+            response_time=age,
+            exception=GreenletKilled(message),
+        )
+
+    def tracked_greenlet(self, f):
+        """Run f, with an implicit timeout. The timeout is computed
+        automatically, and is guaranteed to be sufficiently longer than the
+        async_timeout + async_interval. Greenlets that time out are recorded
+        as killed."""
+        timeout = gevent.Timeout(GREENLET_TIMEOUT)
+        timeout.start()
         try:
-            current_greenlet = gevent.getcurrent()
-            self.append(current_greenlet)
-            with gevent.Timeout(seconds=GREENLET_TIMEOUT):
-                f()
-        except gevent.Timeout:
+            f()
+        except gevent.Timeout as e:
             # if the greenlet is killed externally don't print the exception
-            pass
+            if e is timeout:
+                tracked = self.tracked.get(gevent.getcurrent())
+                if tracked is not None:
+                    self._record_killed(tracked, time.time(),
+                                        "Timed out after %s seconds"
+                                        % GREENLET_TIMEOUT)
         finally:
-            self.remove(current_greenlet)
+            timeout.cancel()
 
     def cleanup_greenlets(self, timeout=None):
-        """Allow the greenlets stored in this list timeout seconds to finish.
-        After the timeout, kill the remaining greenlets."""
+        """Allow the tracked greenlets timeout seconds to finish. After the
+        timeout, kill the remaining greenlets, recording each one as a failure
+        of its operation."""
         LOG.info("Cleaning up greenlets")
         if timeout:
-            gevent.joinall(self, timeout=timeout)
-        gevent.killall(self, exception=gevent.Timeout)
+            gevent.joinall(self.tracked.keys(), timeout=timeout)
+
+        now = time.time()
+        remaining = self.tracked.items()
+        oldest = {}
+        for greenlet, tracked in remaining:
+            self._record_killed(tracked, now, "Killed during cleanup")
+            oldest[tracked.op] = max(oldest.get(tracked.op, 0),
+                                     now - tracked.start_time)
+        for op, age in sorted(oldest.iteritems()):
+            LOG.info("Killing %s in-flight %s operations (oldest %.1f seconds)",
+                     sum(1 for _, t in remaining if t.op == op), op, age)
+        gevent.killall([greenlet for greenlet, _ in remaining],
+                       exception=gevent.Timeout)
+
+
+# the latest snapshot from each slave, on the master
+slave_snapshots = {}
+
+def store_slave_snapshot(client_id, data):
+    if 'async_ops' in data:
+        slave_snapshots[client_id] = data['async_ops']
+
+def persist_snapshots(stats):
+    if insight.is_master():
+        stats['async_ops'] = slave_snapshots
+    else:
+        stats['async_ops'] = {'local': GreenletManager.get().snapshot()}
+
+def setup_reporting():
+    """Slaves send a snapshot to the master with every report, and the
+    master saves the latest snapshot from each slave in the report"""
+    if insight.is_slave():
+        locust.events.report_to_master += GreenletManager.get().report_to_master
+    else:
+        locust.events.slave_report += store_slave_snapshot
+        persistence.persisting_info += persist_snapshots
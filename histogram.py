@@ -0,0 +1,65 @@
+"""
+Helpers for Locust's response time histograms. Locust keeps response times
+as a dictionary of {response_time: count}, and that is what the slaves send
+to the master in each report. Everything here works on that dictionary
+directly, without expanding it into a list of individual response times.
+"""
+import math
+
+# the percentiles we report, along with their metric names. graphite uses dots
+# as path separators, so the 99.9th percentile is named p999.
+PERCENTILES = (
+    (0.5, 'p50'),
+    (0.9, 'p90'),
+    (0.95, 'p95'),
+    (0.99, 'p99'),
+    (0.999, 'p999'),
+)
+
+
+def round_response_time(t):
+    """Round a response time (in ms) the same way Locust does before storing
+    it, which keeps the number of distinct keys in a histogram small"""
+    if t < 100:
+        return t
+    elif t < 1000:
+        return int(round(t, -1))
+    elif t < 10000:
+        return int(round(t, -2))
+    return int(round(t, -3))
+
+
+def summarize(response_times, percentiles=PERCENTILES):
+    """Return a dict with the count, min, max, mean and percentiles of a
+    {response_time: count} histogram, or None if the histogram is empty.
+
+    Percentiles use the nearest-rank method, so each value is a response time
+    that actually occurred.
+    """
+    count = sum(response_times.itervalues())
+    if not count:
+        return None
+
+    times = sorted(response_times)
+    total = sum(t * c for t, c in response_times.iteritems())
+    result = {
+        'count': count,
+        'min': times[0],
+        'max': times[-1],
+        'mean': float(total) / count,
+    }
+
+    # walk the sorted times once, filling in each percentile as its rank is
+    # passed. the percentiles are ordered, so their ranks are too.
+    ranks = [(max(1, int(math.ceil(p * count))), name)
+             for p, name in percentiles]
+    i = 0
+    seen = 0
+    for t in times:
+        seen += response_times[t]
+        while i < len(ranks) and ranks[i][0] <= seen:
+            result[ranks[i][1]] = t
+            i += 1
+        if i == len(ranks):
+            break
+    return result
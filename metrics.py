@@ -0,0 +1,501 @@
+"""
+Realtime metrics on the master. Each slave report is converted into a list
+of Metrics once, and then handed to every registered sink. The reports are
+also merged into cluster-wide metrics by a ClusterAggregator. A sink only
+needs a send(metrics) method and a counters() method:
+
+    metrics.add_sink(StatsdSink('localhost', 8125))
+
+The sinks here are:
+    StatsdSink - fire-and-forget UDP packets
+    InfluxDBSink - batched HTTP writes using the line protocol
+    PrometheusSink - keeps the latest values, for the /metrics web route
+The graphite sink lives in graphite_client.py.
+"""
+import logging
+import time
+from collections import namedtuple
+
+import locust
+import gevent
+from gevent import socket
+from gevent.queue import Queue, Full, Empty
+import requests
+
+import histogram
+import insight
+import persistence
+
+LOG = logging.getLogger(__name__)
+
+# name is something like 'reqs_per_sec' or 'response_time.p99', request is the
+# method + name of the stats entry, and source is the slave's client_id (or
+# CLUSTER_SOURCE for metrics merged across all slaves)
+Metric = namedtuple('Metric', ['name', 'request', 'source', 'value', 'timestamp'])
+
+# what to do with a metric when a BufferedSink's queue is full
+DROP_NEWEST = 'drop_newest'
+DROP_OLDEST = 'drop_oldest'
+BLOCK = 'block'
+
+CLUSTER_SOURCE = 'cluster'
+# the request name used for the total across all requests
+ALL_REQUESTS = 'all'
+
+sinks = []
+
+# whether to publish metrics for each slave report, and the aggregator that
+# publishes metrics merged across slaves. see setup_metrics
+per_slave_metrics = True
+cluster_aggregator = None
+
+# the sink backing the /metrics web route, if enabled
+prometheus_sink = None
+
+
+def requests_per_second_metrics(stat, source):
+    request = stat['method'] + stat['name']
+    return [Metric('reqs_per_sec', request, source, count, int(epoch_time))
+            for epoch_time, count in stat['num_reqs_per_sec'].iteritems()]
+
+def response_time_metrics(stat, source):
+    """Summarize the response time histogram from a single slave report into
+    a handful of metrics (count, min, max, mean, percentiles), rather than
+    one metric per request."""
+    summary = histogram.summarize(stat['response_times'])
+    if summary is None:
+        return []
+    request = stat['method'] + stat['name']
+    epoch_time = int(stat['start_time'])
+    return [Metric('response_time.' + name, request, source, value, epoch_time)
+            for name, value in summary.iteritems()]
+
+def async_op_metrics(async_ops, source, timestamp):
+    """Convert the GreenletManager gauges from a slave report, which look like
+    {op: {'in_flight': 10, 'waiting': 0, ...}}, into metrics"""
+    return [Metric('async_ops.' + gauge, op, source, value, timestamp)
+            for op, gauges in async_ops.iteritems()
+            for gauge, value in gauges.iteritems()]
+
+def report_to_metrics(client_id, data):
+    result = []
+    for stat in data['stats']:
+        result.extend(response_time_metrics(stat, client_id))
+        result.extend(requests_per_second_metrics(stat, client_id))
+    result.extend(async_op_metrics(
+        data.get('async_ops', {}), client_id, int(time.time())))
+    return result
+
+def metrics_producer(client_id, data):
+    """This takes a Locust client_id and some data, as given to
+    locust.event.slave_report handlers."""
+    if cluster_aggregator is not None:
+        cluster_aggregator.add_report(client_id, data)
+    if per_slave_metrics:
+        publish(report_to_metrics(client_id, data))
+
+def publish(metrics):
+    for sink in sinks:
+        sink.send(metrics)
+
+def persist_sink_counters(stats):
+    stats['metrics_sinks'] = dict(
+        (sink.name, sink.counters()) for sink in sinks)
+
+def add_sink(sink):
+    if not sinks:
+        locust.events.slave_report += metrics_producer
+        persistence.persisting_info += persist_sink_counters
+    LOG.info("Sending metrics to %s", sink.name)
+    sinks.append(sink)
+
+
+class ClusterAggregator(object):
+    """Merges slave reports into cluster-wide metrics, so dashboards don't
+    need to sum across every slave's series.
+
+    Reports are folded in as they arrive. Every interval seconds, the merged
+    response time histograms are summarized per request, and the requests per
+    second are summed per request and across all requests. Slaves report
+    every few seconds, so a given second's request counts are held back for
+    settle_time seconds before they are published, to give every slave a
+    chance to report that second. Counts for a second that has already been
+    published are dropped (and logged), rather than published again as a
+    partial count. The async operation gauges are summed across the latest
+    report from each slave (or the max, for ages), leaving out slaves that
+    haven't reported for stale_after seconds.
+    """
+
+    def __init__(self, interval=3, settle_time=None, stale_after=None):
+        self.interval = interval
+        self.settle_time = settle_time if settle_time is not None else 2 * interval
+        self.stale_after = stale_after if stale_after is not None else 5 * interval
+        # {request: {response_time: count}}
+        self.response_times = {}
+        # {request: {epoch_second: count}}
+        self.reqs_per_sec = {}
+        # the seconds before this have been published
+        self.published_before = None
+        # requests reported for seconds that were already published
+        self.late_requests = 0
+        # {client_id: (time received, {op: {gauge: value}})}
+        self.async_ops = {}
+        self.window_start = time.time()
+
+    def add_report(self, client_id, data, now=None):
+        if 'async_ops' in data:
+            self.async_ops[client_id] = (now or time.time(), data['async_ops'])
+        for stat in data['stats']:
+            request = stat['method'] + stat['name']
+            merged = self.response_times.get(request)
+            if merged is None:
+                merged = self.response_times[request] = {}
+            for t, count in stat['response_times'].iteritems():
+                merged[t] = merged.get(t, 0) + count
+
+            merged = self.reqs_per_sec.get(request)
+            if merged is None:
+                merged = self.reqs_per_sec[request] = {}
+            for second, count in stat['num_reqs_per_sec'].iteritems():
+                second = int(second)
+                if (self.published_before is not None
+                        and second < self.published_before):
+                    self.late_requests += count
+                    continue
+                merged[second] = merged.get(second, 0) + count
+
+    def flush(self, now=None):
+        """Return the cluster metrics for everything merged so far, and start
+        a new window"""
+        now = now or time.time()
+        result = []
+
+        epoch_time = int(self.window_start)
+        response_times, self.response_times = self.response_times, {}
+        self.window_start = now
+        for request, merged in response_times.iteritems():
+            summary = histogram.summarize(merged)
+            if summary is None:
+                continue
+            result.extend(
+                Metric('response_time.' + name, request, CLUSTER_SOURCE,
+                       value, epoch_time)
+                for name, value in summary.iteritems())
+
+        if self.late_requests:
+            LOG.warning("Dropped %s requests reported more than %s seconds "
+                        "late", self.late_requests, self.settle_time)
+            self.late_requests = 0
+        cutoff = int(now - self.settle_time)
+        self.published_before = max(cutoff, self.published_before)
+        totals = {}
+        for request, merged in self.reqs_per_sec.iteritems():
+            for second in [s for s in merged if s < cutoff]:
+                count = merged.pop(second)
+                totals[second] = totals.get(second, 0) + count
+                result.append(Metric('reqs_per_sec', request, CLUSTER_SOURCE,
+                                     count, second))
+        result.extend(
+            Metric('reqs_per_sec', ALL_REQUESTS, CLUSTER_SOURCE, count, second)
+            for second, count in totals.iteritems())
+
+        # forget slaves that have stopped reporting
+        for client_id, (received, _) in self.async_ops.items():
+            if now - received > self.stale_after:
+                LOG.info("Slave %s hasn't reported for %s seconds",
+                         client_id, self.stale_after)
+                del self.async_ops[client_id]
+        async_ops = {}
+        for _, slave_ops in self.async_ops.itervalues():
+            for op, gauges in slave_ops.iteritems():
+                summed = async_ops.setdefault(op, {})
+                for gauge, value in gauges.iteritems():
+                    # ages don't add up across slaves. use the oldest.
+                    if gauge.startswith('age_'):
+                        summed[gauge] = max(summed.get(gauge, 0), value)
+                    else:
+                        summed[gauge] = summed.get(gauge, 0) + value
+        result.extend(async_op_metrics(async_ops, CLUSTER_SOURCE, int(now)))
+        return result
+
+    def run(self):
+        while True:
+            gevent.sleep(self.interval)
+            publish(self.flush())
+
+
+class BufferedSink(object):
+    """A base class for sinks that write batches of metrics over a connection
+    from a bounded queue.
+
+    A single worker greenlet drains the queue, taking up to batch_size metrics
+    per write(). If a write fails, the worker calls disconnect(), backs off
+    exponentially, and retries the same batch, up to max_retries times. Then
+    the batch is dropped, so one that can never be written doesn't hold up
+    the rest.
+
+    When the queue is full, the drop_policy decides what happens:
+        DROP_OLDEST - discard the oldest queued metric to make room
+        DROP_NEWEST - discard the incoming metric
+        BLOCK - block the producer until there's room. On the master, this
+            blocks the greenlet that handles slave reports.
+    """
+
+    name = None
+
+    def __init__(self, queue_size=100000, drop_policy=DROP_OLDEST,
+                 batch_size=500, min_backoff=1, max_backoff=60,
+                 max_retries=5):
+        if drop_policy not in (DROP_NEWEST, DROP_OLDEST, BLOCK):
+            raise ValueError("Unknown drop policy %r" % drop_policy)
+        self.drop_policy = drop_policy
+        self.batch_size = batch_size
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.max_retries = max_retries
+        self.queue = Queue(maxsize=queue_size)
+
+        self.sent = 0
+        self.dropped = 0
+        self.send_errors = 0
+
+    def write(self, batch):
+        raise NotImplementedError
+
+    def disconnect(self):
+        pass
+
+    def start(self):
+        return gevent.spawn(self._run)
+
+    def send(self, metrics):
+        for metric in metrics:
+            self._put(metric)
+
+    def _put(self, metric):
+        if self.drop_policy == BLOCK:
+            self.queue.put(metric)
+            return
+        try:
+            self.queue.put_nowait(metric)
+            return
+        except Full:
+            pass
+
+        self.dropped += 1
+        if self.drop_policy == DROP_OLDEST:
+            try:
+                self.queue.get_nowait()
+                self.queue.put_nowait(metric)
+            except (Empty, Full):
+                pass
+
+    def counters(self):
+        return {
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'queued': self.queue.qsize(),
+            'send_errors': self.send_errors,
+        }
+
+    def _next_batch(self):
+        """Block until there is at least one metric, then take whatever
+        else is queued, up to the batch size."""
+        batch = [self.queue.get()]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def _run(self):
+        batch = None
+        backoff = self.min_backoff
+        retries = 0
+        while True:
+            if batch is None:
+                batch = self._next_batch()
+            try:
+                self.write(batch)
+            except Exception as e:
+                self.send_errors += 1
+                self.disconnect()
+                if retries >= self.max_retries:
+                    LOG.error("Failed to send metrics to {0} ({1}). Dropping "
+                              "{2} metrics after {3} retries".format(
+                                  self.name, e, len(batch), retries))
+                    self.dropped += len(batch)
+                else:
+                    # keep the batch, so it is sent again on the next attempt
+                    LOG.error("Failed to send metrics to {0} ({1}). Retrying "
+                              "in {2} seconds".format(self.name, e, backoff))
+                    retries += 1
+                    gevent.sleep(backoff)
+                    backoff = min(backoff * 2, self.max_backoff)
+                    continue
+            else:
+                self.sent += len(batch)
+            batch = None
+            backoff = self.min_backoff
+            retries = 0
+
+
+class StatsdSink(object):
+    """Sends metrics to statsd as gauges over UDP. The socket is non-blocking,
+    so sends never wait, and packets that can't be sent right away (EAGAIN,
+    ENOBUFS) are dropped. Statsd stamps metrics with their arrival time, so
+    report timestamps are not sent."""
+
+    # keep packets under a typical MTU
+    MAX_PACKET_SIZE = 1400
+
+    def __init__(self, host, port, prefix='locust'):
+        self.name = 'statsd://{0}:{1}'.format(host, port)
+        self.address = (host, port)
+        self.prefix = prefix
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # gevent waits for a blocking socket to be writable
+        self.sock.setblocking(False)
+        self.sent = 0
+        self.dropped = 0
+
+    def format(self, metric):
+        request = metric.request.replace(' ', '_').replace('/', '-') \
+                                .replace(':', '_').replace('|', '_')
+        if metric.source == CLUSTER_SOURCE:
+            return "{0}.{1}.{2}.{3}:{4}|g".format(
+                self.prefix, metric.source, request, metric.name, metric.value)
+        return "{0}.{1}.{2}.{3}:{4}|g".format(
+            self.prefix, request, metric.name, metric.source, metric.value)
+
+    def send(self, metrics):
+        packet = []
+        size = 0
+        for metric in metrics:
+            line = self.format(metric)
+            if packet and size + len(line) + 1 > self.MAX_PACKET_SIZE:
+                self._send_packet(packet)
+                packet = []
+                size = 0
+            packet.append(line)
+            size += len(line) + 1
+        if packet:
+            self._send_packet(packet)
+
+    def _send_packet(self, lines):
+        try:
+            self.sock.sendto("\n".join(lines), self.address)
+            self.sent += len(lines)
+        except socket.error:
+            self.dropped += len(lines)
+
+    def counters(self):
+        return {'sent': self.sent, 'dropped': self.dropped}
+
+
+class InfluxDBSink(BufferedSink):
+    """Writes batches of metrics to InfluxDB's HTTP API using the line
+    protocol. Each metric is a measurement (e.g. response_time_p99) with
+    request and source tags, and a single field named value."""
+
+    def __init__(self, url, database, **kwargs):
+        super(InfluxDBSink, self).__init__(**kwargs)
+        self.name = url
+        self.write_url = "{0}/write".format(url.rstrip('/'))
+        self.params = {'db': database, 'precision': 's'}
+        self.session = requests.Session()
+
+    @classmethod
+    def _escape_tag(cls, value):
+        return value.replace('\\', '\\\\').replace(' ', '\\ ') \
+                    .replace(',', '\\,').replace('=', '\\=')
+
+    def serialize(self, batch):
+        return "\n".join(
+            "{0},request={1},source={2} value={3} {4}".format(
+                metric.name.replace('.', '_'),
+                self._escape_tag(metric.request),
+                self._escape_tag(metric.source),
+                metric.value, metric.timestamp)
+            for metric in batch)
+
+    def write(self, batch):
+        resp = self.session.post(self.write_url, params=self.params,
+                                 data=self.serialize(batch))
+        if not resp.ok:
+            raise Exception("{0} {1}".format(resp.status_code, resp.text))
+
+    def disconnect(self):
+        self.session.close()
+        self.session = requests.Session()
+
+
+class PrometheusSink(object):
+    """Keeps the most recent value of each metric, and renders them in
+    Prometheus' text exposition format for the /metrics web route."""
+
+    name = 'prometheus'
+
+    def __init__(self, prefix='locust'):
+        self.prefix = prefix
+        # {(name, request, source): (value, timestamp)}
+        self.values = {}
+
+    @classmethod
+    def _escape_label(cls, value):
+        return value.replace('\\', '\\\\').replace('"', '\\"') \
+                    .replace('\n', '\\n')
+
+    def send(self, metrics):
+        for metric in metrics:
+            key = (metric.name, metric.request, metric.source)
+            current = self.values.get(key)
+            if current is None or current[1] <= metric.timestamp:
+                self.values[key] = (metric.value, metric.timestamp)
+
+    def counters(self):
+        return {'series': len(self.values)}
+
+    def render(self):
+        lines = []
+        last_name = None
+        for (name, request, source), (value, _) in sorted(self.values.iteritems()):
+            metric_name = "{0}_{1}".format(self.prefix, name.replace('.', '_'))
+            if metric_name != last_name:
+                lines.append("# TYPE {0} gauge".format(metric_name))
+                last_name = metric_name
+            lines.append('{0}{{request="{1}",source="{2}"}} {3}'.format(
+                metric_name, self._escape_label(request),
+                self._escape_label(source), value))
+        lines.append("")
+        return "\n".join(lines)
+
+
+def setup_metrics(statsd_host=None, statsd_port=8125, influxdb_url=None,
+                  influxdb_database='locust', prometheus=False, per_slave=True,
+                  cluster=True, cluster_interval=3):
+    """Register the configured sinks. Only the master sends metrics.
+
+    :param per_slave: publish metrics for each slave's reports
+    :param cluster: publish metrics merged across all slaves every
+        cluster_interval seconds
+    """
+    global prometheus_sink, per_slave_metrics, cluster_aggregator
+    if insight.is_slave():
+        return
+
+    per_slave_metrics = per_slave
+    if cluster:
+        cluster_aggregator = ClusterAggregator(interval=cluster_interval)
+        gevent.spawn(cluster_aggregator.run)
+
+    if statsd_host:
+        add_sink(StatsdSink(statsd_host, statsd_port))
+    if influxdb_url:
+        sink = InfluxDBSink(influxdb_url, influxdb_database)
+        sink.start()
+        add_sink(sink)
+    if prometheus:
+        prometheus_sink = PrometheusSink()
+        add_sink(prometheus_sink)
@@ -1,21 +1,26 @@
+import calendar
 import datetime
 import logging
+import time
 
-from datagen import select_random_item, pop_random_item
-from collections import namedtuple
 from auth_client import AuthClient
+from pools import Zone, Recordset, ZonePool, RecordsetPool
+from token_manager import TokenManager
 
 LOG = logging.getLogger(__name__)
 
-Zone = namedtuple('Zone', ['id', 'name'])
-Recordset = namedtuple('Recordset', ['zone', 'id', 'data', 'type'])
-
 
 class Tenant(object):
 
     SMALL = 'small'
     LARGE = 'large'
 
+    # the format of token expiry times from the auth service
+    TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+    # renew tokens this many seconds before they expire
+    RENEWAL_MARGIN = 6 * 60 * 60
+
     def __init__(self, id, api_key, type, auth_endpoint=None):
         self.id = id
         self.api_key = api_key
@@ -28,45 +33,108 @@ class Tenant(object):
         self._token = None
         self._expiry = None
         self.tenant_id = None
+        # the expiry (and when to renew) as epoch times, which are cheaper to
+        # check on every request than datetimes
+        self._expires_at = None
+        self._renew_at = None
 
     def get_token(self):
-        if not self._token or self.is_expired():
-            self.renew_token()
-        return self._token
+        return TokenManager.get().get_token(self)
 
-    def renew_token(self):
-        """Revoke the current token and then renew it.
+    def renew_token(self, revoke=True):
+        """Get a new token and start using it, then revoke the old one.
+        Return the auth response.
 
         This makes sure the token we have is good for (roughly) 24 hours.
+        Use get_token() instead, which avoids concurrent renewals.
+
+        The auth service hands back the same token until it's revoked. In
+        that case, we stop using the token before we revoke it, so that
+        get_token() waits for the new one rather than handing out a revoked
+        token.
+
+        :param revoke: False if other processes may be using the token (see
+            TokenCache). The old token isn't revoked, and if the auth service
+            hands it back, we keep it until it actually expires.
         """
         auth_client = AuthClient(self.auth_endpoint)
-
-        if self._token:
-            revoke_resp = auth_client.revoke_token(self._token)
+        old_token = self._token
 
         auth_resp = auth_client.get_token(self.id, self.api_key)
+        if (auth_resp.ok and old_token and not revoke
+                and self._token_id(auth_resp) == old_token):
+            # a new token is issued once this one expires
+            self._use_token(auth_resp)
+            self._renew_at = self._expires_at
+            return auth_resp
+        if auth_resp.ok and old_token and self._token_id(auth_resp) == old_token:
+            self._token = None
+            self._set_expiry(None)
+            auth_client.revoke_token(old_token)
+            old_token = None
+            auth_resp = auth_client.get_token(self.id, self.api_key)
+
         if auth_resp.ok:
-            self._token = auth_resp.json()['access']['token']['id']
-            self._expiry = self._parse_time(auth_resp.json()['access']['token']['expires'])
-            self.tenant_id = auth_resp.json()['access']['token']['tenant']['id']
+            self._use_token(auth_resp)
+            if revoke and old_token and old_token != self._token:
+                auth_client.revoke_token(old_token)
         else:
             LOG.error("Failed to auth %s" % self)
             LOG.error("%s" % auth_resp.text)
+        return auth_resp
+
+    @staticmethod
+    def _token_id(auth_resp):
+        return auth_resp.json()['access']['token']['id']
+
+    def _use_token(self, auth_resp):
+        token = auth_resp.json()['access']['token']
+        self._token = token['id']
+        self._set_expiry(self._parse_time(token['expires']))
+        self.tenant_id = token['tenant']['id']
+
+    def token_entry(self):
+        """Return [token, expires, tenant_id], for the token cache"""
+        expires = None
+        if self._expiry is not None:
+            expires = self._expiry.strftime(self.TIME_FORMAT)
+        return [self._token, expires, self.tenant_id]
+
+    def set_token_entry(self, entry):
+        """Use a token from the token cache"""
+        token, expires, self.tenant_id = entry
+        self._token = token
+        self._set_expiry(self._parse_time(expires) if expires else None)
+
+    def _set_expiry(self, expiry):
+        self._expiry = expiry
+        if expiry is None:
+            self._expires_at = self._renew_at = None
+        else:
+            self._expires_at = (calendar.timegm(expiry.utctimetuple())
+                                + expiry.microsecond / 1e6)
+            self._renew_at = self._expires_at - self.RENEWAL_MARGIN
+
+    def has_valid_token(self):
+        """Return True if we have a token, and it hasn't actually expired"""
+        if not self._token:
+            return False
+        elif self._expires_at is not None:
+            return time.time() < self._expires_at
+        return True
 
     def is_expired(self):
         """Return True if we deem the token to be expired.
 
         The token is expired if we're within 6 hours of the actual expiry time.
         """
-        if self._expiry is not None:
-            now = datetime.datetime.utcnow()
-            expiry = self._expiry - datetime.timedelta(hours=6)
-            return now >= expiry
+        if self._renew_at is not None:
+            return time.time() >= self._renew_at
         return False
 
     @classmethod
     def _parse_time(cls, time_str):
-        return datetime.datetime.strptime(time_str, '%Y-%m-%dT%H:%M:%S.%fZ')
+        return datetime.datetime.strptime(time_str, cls.TIME_FORMAT)
 
     def __str__(self):
         if not self.api_key:
@@ -80,11 +148,27 @@ class Tenant(object):
 
 class TenantData(object):
 
+    ZONE_POOLS = ('zones_for_get', 'zones_for_delete')
+    RECORDSET_POOLS = ('recordsets_for_get', 'recordsets_for_delete')
+
     def __init__(self):
-        self.zones_for_get = []
-        self.zones_for_delete = []
-        self.recordsets_for_get = []
-        self.recordsets_for_delete = []
+        self.zones_for_get = ZonePool()
+        self.zones_for_delete = ZonePool()
+        self.recordsets_for_get = RecordsetPool()
+        self.recordsets_for_delete = RecordsetPool()
+
+    def to_dict(self):
+        return dict((name, getattr(self, name).to_dict())
+                    for name in self.ZONE_POOLS + self.RECORDSET_POOLS)
+
+    @classmethod
+    def from_dict(cls, d):
+        data = cls()
+        for name in cls.ZONE_POOLS:
+            setattr(data, name, ZonePool.from_dict(d[name]))
+        for name in cls.RECORDSET_POOLS:
+            setattr(data, name, RecordsetPool.from_dict(d[name]))
+        return data
 
     def zone_count(self):
         return len(self.zones_for_get) + len(self.zones_for_delete)
@@ -93,16 +177,16 @@ class TenantData(object):
         return len(self.recordsets_for_get) + len(self.recordsets_for_delete)
 
     def select_zone_for_get(self):
-        return select_random_item(self.zones_for_get)
+        return self.zones_for_get.select_random()
 
     def select_recordset_for_get(self):
-        return select_random_item(self.recordsets_for_get)
+        return self.recordsets_for_get.select_random()
 
     def pop_zone_for_delete(self):
-        return pop_random_item(self.zones_for_delete)
+        return self.zones_for_delete.pop_random()
 
     def pop_recordset_for_delete(self):
-        return pop_random_item(self.recordsets_for_delete)
+        return self.recordsets_for_delete.pop_random()
 
     def exceeds_quotas(self, n_get_zones, n_delete_zones, n_get_recordsets,
                        n_delete_recordsets):
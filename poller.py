@@ -0,0 +1,287 @@
+"""
+A per-process scheduler for status polling of asynchronous operations.
+
+Instead of every async operation running its own sleep-and-GET loop, each
+operation registers a Watch and waits for it to resolve. A single driver
+greenlet advances a timer wheel, and checks the watches that are due.
+
+Watches on the same tenant's zones (or the same zone's recordsets) can be
+coalesced: rather than N individual GETs, the scheduler lists the PENDING
+resources once. Watched resources that are still on that list are
+rescheduled. The rest get an individual GET to find their final status.
+
+Each watch starts polling quickly, and backs off exponentially (with jitter)
+up to a maximum interval. A watch remembers when the last check that saw the
+operation pending was started, and when it first saw the operation done.
+Those bound the true completion time (see async_stats.py).
+"""
+import math
+import random
+import sys
+import time
+import logging
+
+import gevent
+import gevent.pool
+from gevent.event import AsyncResult
+import locust.events
+
+import accurate_config as CONFIG
+
+LOG = logging.getLogger(__name__)
+
+
+class TimerWheel(object):
+    """A hashed timer wheel. Scheduling and advancing are O(1) per item,
+    regardless of how many items are scheduled."""
+
+    def __init__(self, tick, n_slots=1024):
+        self.tick = tick
+        self.slots = [[] for _ in xrange(n_slots)]
+        self.current = 0
+
+    def schedule(self, item, delay):
+        """Schedule the item to be returned by advance() after delay seconds,
+        rounded up to the next tick"""
+        n_slots = len(self.slots)
+        ticks = max(1, int(math.ceil(delay / self.tick)))
+        slot = (self.current + ticks) % n_slots
+        # the number of full turns of the wheel to wait before the item is due
+        rounds = (ticks - 1) // n_slots
+        self.slots[slot].append([rounds, item])
+
+    def advance(self):
+        """Move to the next tick, and return the items that are due"""
+        self.current = (self.current + 1) % len(self.slots)
+        due = []
+        remaining = []
+        for entry in self.slots[self.current]:
+            if entry[0] <= 0:
+                due.append(entry[1])
+            else:
+                entry[0] -= 1
+                remaining.append(entry)
+        self.slots[self.current] = remaining
+        return due
+
+
+class Watch(object):
+    """An async operation we're polling until it has the expected status (or
+    until a 404, if until_404 is set). Exactly one of success_function() or
+    failure_function(message) is called when the watch resolves. The
+    success_function is passed the watch, for its last_pending_at and done_at
+    times.
+
+    :param check: a function that makes the status check request
+    :param min_interval: the delay before the second check. the first check
+        happens on the scheduler's next tick.
+    :param max_interval: the cap on the delay between checks
+    :param group: optional, a group used to coalesce status checks
+    :param resource_id: the id of the resource in the group's listing
+    :param owner: the locust TaskSet, for reporting errors
+    """
+
+    def __init__(self, check, success_function, failure_function,
+                 status_function=None, expected='ACTIVE', until_404=False,
+                 min_interval=CONFIG.async_min_interval,
+                 max_interval=CONFIG.async_interval,
+                 timeout=CONFIG.async_timeout,
+                 group=None, resource_id=None, owner=None):
+        self.check = check
+        self.success_function = success_function
+        self.failure_function = failure_function
+        self.status_function = status_function
+        self.expected = expected
+        self.until_404 = until_404
+        self.delay = min_interval
+        self.max_interval = max_interval
+        self.timeout = timeout
+        self.deadline = time.time() + timeout
+        self.group = group
+        self.resource_id = resource_id
+        self.owner = owner
+        self.cancelled = False
+        # when the last check that saw the operation pending was started, and
+        # when a check first saw it done
+        self.last_pending_at = None
+        self.done_at = None
+        # set to the final response on success, or None on failure
+        self.result = AsyncResult()
+
+    def next_delay(self):
+        """Back off exponentially, with jitter, up to the max_interval"""
+        delay = self.delay
+        self.delay = min(delay * 2, self.max_interval)
+        return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+    def succeed(self, resp):
+        if self.done_at is None:
+            self.done_at = time.time()
+        try:
+            self.success_function(self)
+        finally:
+            self.result.set(resp)
+
+    def fail(self, message):
+        try:
+            self.failure_function(message)
+        finally:
+            self.result.set(None)
+
+
+class ZoneStatusGroup(object):
+    """Coalesces status checks on a tenant's zones"""
+
+    def __init__(self, client):
+        """:param client: a DesignateClient for the tenant"""
+        self.client = client
+        self.key = ('zones', client.tenant.id)
+
+    def pending_ids(self):
+        resp = self.client.list_zones(
+            params={'status': 'PENDING', 'limit': CONFIG.poll_list_limit},
+            name='/v2/zones?status=PENDING - status check')
+        if not resp.ok:
+            return None
+        return set(z['id'] for z in resp.json()['zones'])
+
+
+class RecordsetStatusGroup(object):
+    """Coalesces status checks on a zone's recordsets"""
+
+    def __init__(self, client, zone_id):
+        """:param client: a DesignateClient for the tenant"""
+        self.client = client
+        self.zone_id = zone_id
+        self.key = ('recordsets', client.tenant.id, zone_id)
+
+    def pending_ids(self):
+        resp = self.client.list_recordsets(
+            self.zone_id,
+            params={'status': 'PENDING', 'limit': CONFIG.poll_list_limit},
+            name='/v2/zones/ID/recordsets?status=PENDING - status check')
+        if not resp.ok:
+            return None
+        return set(r['id'] for r in resp.json()['recordsets'])
+
+
+class PollScheduler(object):
+
+    @classmethod
+    def get(cls, _instance=[]):
+        if not _instance:
+            _instance.append(PollScheduler(
+                tick=CONFIG.poll_tick,
+                concurrency=CONFIG.poll_concurrency,
+                coalesce=CONFIG.poll_coalesce))
+        return _instance[0]
+
+    def __init__(self, tick, concurrency, coalesce=True):
+        self.wheel = TimerWheel(tick)
+        self.pool = gevent.pool.Pool(concurrency)
+        self.coalesce = coalesce
+        self.driver = None
+
+    def wait(self, watch):
+        """Schedule the watch's first check for the next tick, and block until
+        the watch resolves. Return the final response on success, or None.
+
+        If the waiting greenlet is killed, the watch is cancelled.
+        """
+        self.schedule(watch, 0)
+        try:
+            return watch.result.get()
+        except BaseException:
+            watch.cancelled = True
+            raise
+
+    def schedule(self, watch, delay):
+        if self.driver is None or self.driver.dead:
+            self.driver = gevent.spawn(self._run)
+        self.wheel.schedule(watch, delay)
+
+    def _run(self):
+        tick = self.wheel.tick
+        next_tick = time.time() + tick
+        while True:
+            gevent.sleep(max(0, next_tick - time.time()))
+            # if we fall behind, catch up on the ticks we missed
+            while next_tick <= time.time():
+                next_tick += tick
+                due = self.wheel.advance()
+                if due:
+                    self._dispatch(due)
+
+    def _dispatch(self, due):
+        now = time.time()
+        groups = {}
+        for watch in due:
+            if watch.cancelled:
+                continue
+            elif now >= watch.deadline:
+                self.pool.spawn(watch.fail, "Failed - timed out after %s seconds"
+                                % watch.timeout)
+            elif self.coalesce and watch.group is not None:
+                groups.setdefault(watch.group.key, []).append(watch)
+            else:
+                self.pool.spawn(self._check, watch)
+
+        for watches in groups.itervalues():
+            if len(watches) == 1:
+                self.pool.spawn(self._check, watches[0])
+            else:
+                self.pool.spawn(self._check_group, watches)
+
+    def _check_group(self, watches):
+        """List the group's pending resources once. Anything still pending is
+        rescheduled, and everything else gets an individual check."""
+        started_at = time.time()
+        try:
+            pending = watches[0].group.pending_ids()
+        except Exception as e:
+            self._report_error(watches[0], e)
+            pending = None
+
+        for watch in watches:
+            if pending is not None and watch.resource_id in pending:
+                watch.last_pending_at = started_at
+                self.schedule(watch, watch.next_delay())
+            else:
+                self._check(watch)
+
+    def _check(self, watch):
+        started_at = time.time()
+        try:
+            if watch.until_404:
+                with watch.check() as resp:
+                    received_at = time.time()
+                    if resp.status_code == 404:
+                        watch.done_at = received_at
+                        # ensure the 404 isn't marked as a failure in the report
+                        resp.success()
+                        watch.succeed(resp)
+                        return
+                    elif resp.ok:
+                        watch.last_pending_at = started_at
+            else:
+                resp = watch.check()
+                received_at = time.time()
+                if resp.ok:
+                    status = watch.status_function(resp)
+                    if status == watch.expected:
+                        watch.done_at = received_at
+                        watch.succeed(resp)
+                        return
+                    elif status == 'ERROR':
+                        watch.fail("Failed - saw ERROR status")
+                        return
+                    watch.last_pending_at = started_at
+        except Exception as e:
+            self._report_error(watch, e)
+        if not watch.result.ready():
+            self.schedule(watch, watch.next_delay())
+
+    def _report_error(self, watch, e):
+        locust.events.locust_error.fire(
+            locust_instance=watch.owner, exception=e, tb=sys.exc_info()[2]
+        )
@@ -0,0 +1,248 @@
+"""
+Compact pools of the zones and recordsets a tenant has, for picking random
+ones to get or delete.
+
+A list of Zone/Recordset namedtuples costs hundreds of bytes per entry, and
+removing a random entry from a list is O(n). The pools keep each field in a
+flat array instead (uuids as 16 bytes, IPv4 addresses as 4 bytes, and
+references into small tables of interned values), and remove an entry by
+moving the last entry into its slot. Selecting and removing a random entry
+are both O(1). Zone/Recordset objects are only built for the entries that
+are handed out.
+
+The pools support append, len, indexing and pop, so they can be used where
+the lists were.
+"""
+import base64
+import random
+import socket
+import struct
+from array import array
+from binascii import hexlify, unhexlify
+from collections import namedtuple
+
+Zone = namedtuple('Zone', ['id', 'name'])
+Recordset = namedtuple('Recordset', ['zone', 'id', 'data', 'type'])
+
+UUID_SIZE = 16
+
+
+def pack_uuid(value):
+    return unhexlify(value.replace('-', ''))
+
+
+def unpack_uuid(packed):
+    h = hexlify(packed)
+    return '%s-%s-%s-%s-%s' % (h[:8], h[8:12], h[12:16], h[16:20], h[20:])
+
+
+def pack_ipv4(value):
+    return struct.unpack('=I', socket.inet_aton(value))[0]
+
+
+def unpack_ipv4(packed):
+    return socket.inet_ntoa(struct.pack('=I', packed))
+
+
+def dump_array(values):
+    return base64.b64encode(values.tostring())
+
+
+def load_array(typecode, encoded):
+    values = array(typecode)
+    values.fromstring(base64.b64decode(encoded))
+    return values
+
+
+class InternTable(object):
+    """Maps values to small integers, so each distinct value is kept once"""
+
+    def __init__(self):
+        self.values = []
+        self.indexes = {}
+
+    def index(self, value):
+        i = self.indexes.get(value)
+        if i is None:
+            i = self.indexes[value] = len(self.values)
+            self.values.append(value)
+        return i
+
+    def __getitem__(self, i):
+        return self.values[i]
+
+    @classmethod
+    def from_values(cls, values):
+        table = cls()
+        for value in values:
+            table.index(value)
+        return table
+
+
+class UUIDArray(object):
+    """A growable array of uuids, packed into 16 bytes each"""
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def __len__(self):
+        return len(self.data) // UUID_SIZE
+
+    def append(self, value):
+        self.data += pack_uuid(value)
+
+    def __getitem__(self, i):
+        start = i * UUID_SIZE
+        return unpack_uuid(self.data[start:start + UUID_SIZE])
+
+    def dumps(self):
+        return base64.b64encode(str(self.data))
+
+    @classmethod
+    def loads(cls, encoded):
+        uuids = cls()
+        uuids.data = bytearray(base64.b64decode(encoded))
+        return uuids
+
+    def swap_remove(self, i):
+        """Move the last uuid into slot i, and drop the last slot"""
+        last = len(self.data) - UUID_SIZE
+        start = i * UUID_SIZE
+        if start != last:
+            self.data[start:start + UUID_SIZE] = self.data[last:]
+        del self.data[last:]
+
+
+class Pool(object):
+    """The O(1) random select and remove shared by the pools"""
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __nonzero__(self):
+        return len(self.ids) > 0
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("pool index out of range")
+        return self._get(i)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self._get(i)
+
+    def select_random(self):
+        """Return a random entry, or None if empty"""
+        if len(self):
+            return self._get(random.randrange(len(self)))
+
+    def pop_random(self):
+        """Remove and return a random entry, or None if empty"""
+        if len(self):
+            return self.pop(random.randrange(len(self)))
+
+    def pop(self, i=-1):
+        """Remove and return entry i. The last entry takes its place."""
+        item = self[i]
+        self._remove(i % len(self))
+        return item
+
+
+class ZonePool(Pool):
+
+    def __init__(self, zones=()):
+        self.ids = UUIDArray()
+        self.names = []
+        for zone in zones:
+            self.append(zone)
+
+    def append(self, zone):
+        self.ids.append(zone.id)
+        # zone names are unique, so there's nothing to gain from interning.
+        # they're ascii, and a str is a quarter of the size of a unicode.
+        name = zone.name
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        self.names.append(name)
+
+    def _get(self, i):
+        return Zone(self.ids[i], self.names[i])
+
+    def to_dict(self):
+        """Return the pool in a form that can be saved as json"""
+        return {'ids': self.ids.dumps(), 'names': self.names}
+
+    @classmethod
+    def from_dict(cls, d):
+        pool = cls()
+        pool.ids = UUIDArray.loads(d['ids'])
+        pool.names = [name.encode('utf-8') for name in d['names']]
+        return pool
+
+    def _remove(self, i):
+        self.ids.swap_remove(i)
+        self.names[i] = self.names[-1]
+        self.names.pop()
+
+
+class RecordsetPool(Pool):
+    """A pool of A recordsets with a single record each, which is the only
+    kind of recordset the tests create or gather"""
+
+    def __init__(self, recordsets=()):
+        self.ids = UUIDArray()
+        # indexes into the zone and type tables
+        self.zone_refs = array('I')
+        self.type_refs = array('B')
+        self.ips = array('I')
+        self.zones = InternTable()
+        self.types = InternTable()
+        for recordset in recordsets:
+            self.append(recordset)
+
+    def append(self, recordset):
+        if recordset.type != 'A':
+            raise ValueError("Only A recordsets can be pooled, not %s"
+                             % recordset.type)
+        ip = pack_ipv4(recordset.data)
+        self.ids.append(recordset.id)
+        self.zone_refs.append(self.zones.index(recordset.zone))
+        self.type_refs.append(self.types.index(recordset.type))
+        self.ips.append(ip)
+
+    def _get(self, i):
+        return Recordset(self.zones.values[self.zone_refs[i]], self.ids[i],
+                         unpack_ipv4(self.ips[i]),
+                         self.types.values[self.type_refs[i]])
+
+    def to_dict(self):
+        """Return the pool in a form that can be saved as json. Arrays are in
+        this machine's byte order."""
+        return {
+            'ids': self.ids.dumps(),
+            'zone_refs': dump_array(self.zone_refs),
+            'type_refs': dump_array(self.type_refs),
+            'ips': dump_array(self.ips),
+            'zones': [list(zone) for zone in self.zones.values],
+            'types': self.types.values,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        pool = cls()
+        pool.ids = UUIDArray.loads(d['ids'])
+        pool.zone_refs = load_array('I', d['zone_refs'])
+        pool.type_refs = load_array('B', d['type_refs'])
+        pool.ips = load_array('I', d['ips'])
+        pool.zones = InternTable.from_values(
+            Zone(id, name) for id, name in d['zones'])
+        pool.types = InternTable.from_values(d['types'])
+        return pool
+
+    def _remove(self, i):
+        self.ids.swap_remove(i)
+        for values in (self.zone_refs, self.type_refs, self.ips):
+            values[i] = values[-1]
+            values.pop()
@@ -1,7 +1,15 @@
 import argparse
 import json
 import logging
+import os
+import random
+import time
 
+import gevent
+import gevent.pool
+from gevent.lock import BoundedSemaphore
+
+from requests.adapters import HTTPAdapter
 from requests.packages.urllib3 import disable_warnings
 disable_warnings()
 
@@ -9,8 +17,9 @@ from locust.clients import HttpSession
 
 from client import DesignateClient
 from models import Tenant, Zone, Recordset
-from datagen import random_zone_email, randomize, random_ip
+from datagen import DataGenerator, RandomZoneFile
 from auth_client import AuthClient
+from exchange_log import format_response
 from tasks.paginator import PaginationFrontier
 
 # logging.basicConfig(level=logging.DEBUG)
@@ -19,17 +28,43 @@ def parse_args():
     p = argparse.ArgumentParser(description=
         "Create a specific number of zones for a tenant and a specific number "
         "of recordsets per zone. This will try to be intelligent enough to "
-        "avoid creating a whole bunch of additional zones")
+        "avoid creating a whole bunch of additional zones. With --manifest, "
+        "many tenants are prepared at once.")
 
     p.add_argument("-e", "--endpoint", required=True,
         help="The address of a Designate API (e.g. http://192.168.33.20:9001)")
     p.add_argument("-a", "--auth-endpoint", required=True)
-    p.add_argument("-u", "--username", required=True)
-    p.add_argument("-k", "--api-key", required=True)
-    p.add_argument("-z", "--n-zones", required=True, type=int,
+    p.add_argument("-u", "--username",
+        help="The tenant to prepare (unless --manifest is given)")
+    p.add_argument("-k", "--api-key")
+    p.add_argument("-z", "--n-zones", type=int,
         help="The number of zones this tenant needs to have")
-    p.add_argument("-r", "--n-recordsets-per-zone", required=True, type=int,
+    p.add_argument("-r", "--n-recordsets-per-zone", type=int,
         help="The number of recordsets each zone should have")
+    p.add_argument("-m", "--manifest",
+        help="A json file with a list of tenants to prepare, like "
+             '[{"username": "...", "api_key": "...", "n_zones": 100, '
+             '"n_recordsets_per_zone": 50}]. The counts default to -z and -r')
+    p.add_argument("-c", "--concurrency", type=int, default=50,
+        help="The most requests in flight at once, across all tenants "
+             "(default: 50)")
+    p.add_argument("--tenant-concurrency", type=int, default=10,
+        help="The most zones each tenant works on at once (default: 10)")
+    p.add_argument("--rate", type=float, default=20,
+        help="The most requests per second for each tenant, or 0 for no "
+             "limit (default: 20)")
+    p.add_argument("--import", dest="use_imports", action="store_true",
+        help="Create each new zone, with all its recordsets, by importing a "
+             "zone file. Recordsets are only POSTed to top up existing zones")
+    p.add_argument("--imports-in-flight", type=int, default=20,
+        help="The most imports each tenant waits on at once (default: 20)")
+    p.add_argument("--import-timeout", type=float, default=600,
+        help="Seconds to wait for an import to complete (default: 600)")
+    p.add_argument("--checkpoint", default="prepare-tenant-checkpoint.json",
+        help="Where to save progress, so an interrupted run can resume "
+             "without listing everything again (default: %(default)s)")
+    p.add_argument("--report-interval", type=float, default=10,
+        help="Seconds between progress reports and checkpoints (default: 10)")
     p.add_argument("--no-tenant-id-in-url", action='store_true',
         help="Don't put the tenant id in the url")
     p.add_argument("--use-project-id-header", action='store_true',
@@ -37,35 +72,206 @@ def parse_args():
     p.add_argument("--no-repose", action="store_true",
                    help="Run against designate in noauth mode")
 
-    return p.parse_args()
+    args = p.parse_args()
+    if not args.manifest and not (args.username and args.api_key
+                                  and args.n_zones is not None
+                                  and args.n_recordsets_per_zone is not None):
+        p.error("either --manifest, or all of -u, -k, -z and -r are required")
+    return args
 
 
-class TenantPrepper(object):
+def load_targets(args):
+    """Return a list of (tenant, n_zones, n_recordsets_per_zone)"""
+    if args.manifest:
+        with open(args.manifest) as f:
+            entries = json.load(f)
+    else:
+        entries = [{'username': args.username, 'api_key': args.api_key}]
 
-    def __init__(self, args):
-        self.args = args
-        self.tenant = Tenant(
-            self.args.username,
-            self.args.api_key,
+    targets = []
+    for entry in entries:
+        tenant = Tenant(
+            entry['username'],
+            entry['api_key'],
             Tenant.SMALL,  # this doesn't mean anything for our purposes
-            self.args.auth_endpoint,
+            args.auth_endpoint,
         )
+        n_zones = entry.get('n_zones', args.n_zones)
+        n_recordsets = entry.get('n_recordsets_per_zone',
+                                 args.n_recordsets_per_zone)
+        if n_zones is None or n_recordsets is None:
+            raise Exception("No zone or recordset count for %s in %s"
+                            % (tenant.id, args.manifest))
+        targets.append((tenant, n_zones, n_recordsets))
+    return targets
+
+
+class RateLimiter(object):
+    """Spaces out calls to wait() so there are at most `rate` per second"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_time = 0
+
+    def wait(self):
+        if not self.interval:
+            return
+        now = time.time()
+        at = max(now, self.next_time)
+        self.next_time = at + self.interval
+        if at > now:
+            gevent.sleep(at - now)
+
+
+# zone files for imports have only A records, like the recordsets we POST
+A_RECORDS_ONLY = (('A', 1),)
+
+
+class PrepCheckpoint(object):
+    """Saves what we know about each tenant's zones, so a run can resume
+    where an earlier one stopped.
+
+    For each tenant, it has whether its zones have been listed, and each
+    zone as [id, name, number of A recordsets], where the number is None
+    until the zone's recordsets are listed. The checkpoint is saved every
+    --report-interval, so anything created since the last save is created
+    again on resume (there may be a few more zones or recordsets than
+    needed, but never fewer).
+    """
+
+    VERSION = 1
+
+    def __init__(self, path, endpoint):
+        self.path = path
+        self.endpoint = endpoint
+
+    def load(self):
+        """Return {tenant id: state}"""
+        try:
+            with open(self.path) as f:
+                checkpoint = json.load(f)
+        except IOError:
+            return {}
+        if (checkpoint.get('version') != self.VERSION
+                or checkpoint.get('endpoint') != self.endpoint):
+            print "Ignoring the checkpoint %s for a different endpoint" % (
+                self.path)
+            return {}
+        return checkpoint['tenants']
+
+    def save(self, states):
+        checkpoint = {
+            'version': self.VERSION,
+            'endpoint': self.endpoint,
+            'tenants': states,
+        }
+        # write and rename, so an interrupted save doesn't lose the old one
+        tmp_path = '%s.%s' % (self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(checkpoint, f)
+        os.rename(tmp_path, self.path)
+
+
+class PrepStats(object):
+
+    def __init__(self, total):
+        # the zones and recordsets we want, and how many exist so far
+        self.total = total
+        self.done = 0
+        self.done_at_start = None
+        self.start_time = None
+        self.requests = 0
+        self.zones_created = 0
+        self.recordsets_created = 0
+        self.errors = 0
+
+    def start(self):
+        self.done_at_start = self.done
+        self.start_time = time.time()
+
+    def report(self):
+        elapsed = time.time() - self.start_time
+        rate = (self.done - self.done_at_start) / elapsed if elapsed else 0
+        remaining = self.total - self.done
+        if remaining <= 0:
+            eta = "done"
+        elif rate > 0:
+            eta = "ETA %.0f seconds" % (remaining / rate)
+        else:
+            eta = "ETA unknown"
+        print ("%.0f seconds: created %s zones and %s recordsets, %s requests "
+               "(%.1f/sec), %s errors, %.1f%% done, %s" % (
+                   elapsed, self.zones_created, self.recordsets_created,
+                   self.requests, self.requests / elapsed if elapsed else 0,
+                   self.errors, 100.0 * self.done / self.total
+                   if self.total else 100, eta))
 
-        self.tenant.get_token()
 
-        print "%s has token %s" % (self.tenant.id, self.tenant.get_token())
+class TenantPrepper(object):
+    """Brings one tenant up to n_zones zones, each with n_recordsets_per_zone
+    A recordsets. It works on up to tenant_concurrency zones at once, and its
+    requests wait on its rate limiter and on the shared `slots`, which bound
+    the requests in flight across all tenants.
+
+    With use_imports, new zones are imported with all their recordsets, and
+    up to imports_in_flight imports are polled at once.
+    """
+
+    # the delays between polls of an import, which back off exponentially
+    IMPORT_MIN_INTERVAL = 1
+    IMPORT_MAX_INTERVAL = 10
+
+    def __init__(self, client, tenant, n_zones, n_recordsets_per_zone, state,
+                 slots, stats, rate=0, tenant_concurrency=10,
+                 use_imports=False, imports_in_flight=20,
+                 import_timeout=600):
+        self.tenant = tenant
+        self.client = client.as_user(tenant)
+        self.n_zones = n_zones
+        self.n_recordsets_per_zone = n_recordsets_per_zone
+        # see PrepCheckpoint
+        self.state = state
+        self.state.setdefault('zones_listed', False)
+        self.state.setdefault('zones', [])
+        self.slots = slots
+        self.stats = stats
+        self.limiter = RateLimiter(rate)
+        self.tenant_concurrency = tenant_concurrency
+        self.use_imports = use_imports
+        self.imports = gevent.pool.Pool(imports_in_flight)
+        self.import_timeout = import_timeout
+        self.datagen = DataGenerator.get()
+
+        stats.total += n_zones * (1 + n_recordsets_per_zone)
+        for entry in self.state['zones'][:n_zones]:
+            self._found_zone(entry)
+
+    def _request(self, f, *args, **kwargs):
+        self.limiter.wait()
+        with self.slots:
+            self.stats.requests += 1
+            resp = f(*args, **kwargs)
+        check_resp(resp)
+        return resp
 
-        self.client = DesignateClient(
-            client=HttpSession(self.args.endpoint),
-            tenant=self.tenant,
-            use_project_id=self.args.no_repose,
-            tenant_id_in_url=not self.args.no_repose,
-        )
+    def _found_zone(self, entry):
+        self.stats.done += 1 + min(entry[2] or 0, self.n_recordsets_per_zone)
+
+    def _found_recordsets(self, entry, n):
+        before = min(entry[2] or 0, self.n_recordsets_per_zone)
+        entry[2] = (entry[2] or 0) + n
+        after = min(entry[2], self.n_recordsets_per_zone)
+        self.stats.done += after - before
 
     def run(self):
-        # self.increase_quotas()
-        zones = self.ensure_zones_are_created()
-        recordsets = self.ensure_recordsets_are_created(zones)
+        try:
+            self.tenant.get_token()
+            print "%s has token %s" % (self.tenant.id, self.tenant.get_token())
+            # self.increase_quotas()
+            self.ensure_zones_are_created()
+        except Exception as e:
+            self.stats.errors += 1
+            print "%s: failed - %s" % (self.tenant.id, e)
 
     def increase_quotas(self):
         payload = {
@@ -76,83 +282,127 @@ class TenantPrepper(object):
                 "zone_recordsets": 99999999,
             }
         }
-        resp = self.client.patch_quotas(self.tenant.tenant_id, json.dumps(payload))
-        check_resp(resp)
+        self._request(self.client.patch_quotas, self.tenant.tenant_id,
+                      json.dumps(payload))
         print '%s increased quotas' % self.tenant.tenant_id
 
     def ensure_zones_are_created(self):
-        # try to fetch the number of zones we need
-        zones = self.list_zones(limit=self.args.n_zones)
+        if not self.state['zones_listed']:
+            # try to fetch the number of zones we need
+            for zone in self.list_zones(limit=self.n_zones):
+                entry = [zone.id, zone.name, None]
+                self.state['zones'].append(entry)
+                self._found_zone(entry)
+            self.state['zones_listed'] = True
+        zones = self.state['zones'][:self.n_zones]
         print "%s has at least %s zones already (need %s total)" % (
-            self.tenant.id, len(zones), self.args.n_zones)
+            self.tenant.id, len(zones), self.n_zones)
+
+        pool = gevent.pool.Pool(self.tenant_concurrency)
+        for entry in zones:
+            if entry[2] is None or entry[2] < self.n_recordsets_per_zone:
+                pool.spawn(self._run_job,
+                           self.ensure_recordsets_are_created_for_zone, entry)
 
         # if we don't have enough zones, create some more
-        if len(zones) < self.args.n_zones:
-            n_missing_zones = self.args.n_zones - len(zones)
+        n_missing_zones = self.n_zones - len(zones)
+        if n_missing_zones > 0:
             print "%s is creating %s additional zones" % (
                 self.tenant.id, n_missing_zones)
-            additional_zones = self.create_zones(number=n_missing_zones)
-            zones.extend(additional_zones)
-
-        return zones
-
-    def ensure_recordsets_are_created(self, zones):
-        recordsets = []
-        for zone in zones:
-            records_for_zone = self.ensure_recordsets_are_created_for_zone(zone)
-            recordsets.extend(records_for_zone)
-        return recordsets
-
-    def ensure_recordsets_are_created_for_zone(self, zone):
-        # try to fetch the number of recordsets we want
-        recordsets = self.list_a_recordsets(zone, limit=self.args.n_recordsets_per_zone)
-        print "%s: zone %s already has at least %s A recordsets (need %s)" % (
-            self.tenant.id, zone.name, len(recordsets), self.args.n_recordsets_per_zone)
+        create = (self.import_zone if self.use_imports
+                  else self.create_zone_with_recordsets)
+        for _ in xrange(n_missing_zones):
+            pool.spawn(self._run_job, create)
+        pool.join()
+        self.imports.join()
+
+    def _run_job(self, f, *args):
+        try:
+            f(*args)
+        except Exception as e:
+            self.stats.errors += 1
+            print "%s: %s" % (self.tenant.id, e)
+
+    def create_zone_with_recordsets(self):
+        zone = self.create_zone()
+        # a new zone has no recordsets to list
+        entry = [zone.id, zone.name, 0]
+        self.state['zones'].append(entry)
+        self._found_zone(entry)
+        self.ensure_recordsets_are_created_for_zone(entry)
+
+    def ensure_recordsets_are_created_for_zone(self, entry):
+        if entry[2] is None:
+            # try to fetch the number of recordsets we want
+            zone = Zone(entry[0], entry[1])
+            recordsets = self.list_a_recordsets(
+                zone, limit=self.n_recordsets_per_zone)
+            self._found_recordsets(entry, len(recordsets))
 
         # if not enough recordsets, create some more
-        if len(recordsets) < self.args.n_recordsets_per_zone:
-            n_missing_recordsets = self.args.n_recordsets_per_zone - len(recordsets)
-            print "%s is creating %s additional recordsets on zone %s" % (
-                self.tenant.id, n_missing_recordsets, zone.name)
-            additional_recordsets = self.create_recordsets(zone, number=n_missing_recordsets)
-            print 'created %s additional_recordets' % len(additional_recordsets)
-            recordsets.extend(additional_recordsets)
-
-        return recordsets
-
-    def create_zones(self, number):
-        return [self.create_zone() for _ in xrange(number)]
+        n_missing_recordsets = self.n_recordsets_per_zone - entry[2]
+        if n_missing_recordsets > 0:
+            zone = Zone(entry[0], entry[1])
+            for _ in xrange(n_missing_recordsets):
+                self.create_recordset(zone)
+                self._found_recordsets(entry, 1)
 
     def create_zone(self):
-        zone_name, email = random_zone_email()
-        payload = { "name": zone_name, "email": email, "ttl": 7200 }
-
-        resp = self.client.post_zone(data=json.dumps(payload))
-        check_resp(resp)
+        zone_name, payload = self.datagen.zone()
+        resp = self._request(self.client.post_zone, data=payload)
 
         zone = Zone(resp.json()['id'], resp.json()['name'])
-        print '%s: Created zone %s' % (self.tenant.id, zone.name)
+        self.stats.zones_created += 1
         return zone
 
-    def create_recordsets(self, zone, number):
-        return [self.create_recordset(zone) for _ in xrange(number)]
+    def import_zone(self):
+        """Start importing a zone with all its recordsets, and leave it to
+        a greenlet in self.imports to wait for the import"""
+        # the ns. and mail. A records are always in the file
+        n_records = max(self.n_recordsets_per_zone, 2)
+        zone_file = RandomZoneFile(zone_name=self.datagen.zone_name(),
+                                   n_records=n_records,
+                                   type_mix=A_RECORDS_ONLY)
+        resp = self._request(self.client.import_zone, data=zone_file)
+        import_id = resp.json()['id']
+        # this blocks while the tenant has too many imports in flight
+        self.imports.spawn(self._run_job, self.wait_for_import, import_id,
+                           zone_file.zone_name, n_records)
+
+    def wait_for_import(self, import_id, zone_name, n_records):
+        deadline = time.time() + self.import_timeout
+        delay = self.IMPORT_MIN_INTERVAL
+        while True:
+            gevent.sleep(delay / 2.0 + random.uniform(0, delay / 2.0))
+            delay = min(delay * 2, self.IMPORT_MAX_INTERVAL)
+
+            resp = self._request(self.client.get_zone_import, import_id)
+            status = resp.json()['status']
+            if status == 'COMPLETE':
+                break
+            elif status == 'ERROR':
+                raise Exception("Failed to import zone %s: %s" % (
+                    zone_name, resp.json().get('message')))
+            elif time.time() > deadline:
+                raise Exception("Timed out waiting for the import of zone %s"
+                                % zone_name)
+
+        entry = [resp.json()['zone_id'], zone_name, n_records]
+        self.state['zones'].append(entry)
+        self._found_zone(entry)
+        self.stats.zones_created += 1
+        self.stats.recordsets_created += n_records
 
     def create_recordset(self, zone):
-        record_name = "{0}.{1}".format(randomize("record"), zone.name)
-        payload = { "name" : record_name,
-                    "type" : "A",
-                    "ttl" : 3600,
-                    "records" : [ random_ip() ] }
-
-        resp = self.client.post_recordset(zone.id, data=json.dumps(payload))
-        check_resp(resp)
+        record_name, payload = self.datagen.recordset(zone.name)
+        resp = self._request(self.client.post_recordset, zone.id, data=payload)
 
         recordset = Recordset(
             zone = zone,
             id = resp.json()['id'],
             data = resp.json()['records'][0],
             type = resp.json()['type'])
-        print '%s: Created recordset %s' % (self.tenant.id, record_name)
+        self.stats.recordsets_created += 1
         return recordset
 
     def list_zones(self, limit):
@@ -168,8 +418,7 @@ class TenantPrepper(object):
             params['sort_key'] = 'id'
 
             print "%s: GET %s" % (self.tenant.id, link)
-            resp = self.client.get(path, params=params)
-            check_resp(resp)
+            resp = self._request(self.client.get, path, params=params)
 
             zones = resp.json()['zones']
             links = resp.json()['links']
@@ -201,9 +450,7 @@ class TenantPrepper(object):
             path, params = frontier.parse_url(link)
             params['sort_key'] = 'id'
 
-            print "%s: GET %s" % (self.tenant.id, link)
-            resp = self.client.get(path, params=params)
-            check_resp(resp)
+            resp = self._request(self.client.get, path, params=params)
 
             recordsets = resp.json()['recordsets']
             links = resp.json()['links']
@@ -224,32 +471,67 @@ class TenantPrepper(object):
         return found_recordsets
 
 
-def check_resp(resp):
-    if not resp.ok:
-        raise Exception("Bad response!\n%s" % resp_to_string(resp))
+class PrepEngine(object):
+    """Prepares all the tenants at once, with at most `concurrency` requests
+    in flight, reporting progress and saving a checkpoint every
+    report_interval seconds"""
 
+    def __init__(self, args, targets):
+        self.args = args
+        self.checkpoint = PrepCheckpoint(args.checkpoint, args.endpoint)
+        self.states = self.checkpoint.load()
+        self.stats = PrepStats(total=0)
+        self.slots = BoundedSemaphore(args.concurrency)
+
+        session = HttpSession(args.endpoint)
+        # keep a connection for each request in flight
+        adapter = HTTPAdapter(pool_maxsize=args.concurrency)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        client = DesignateClient(
+            client=session,
+            use_project_id=args.no_repose,
+            tenant_id_in_url=not args.no_repose,
+        )
 
-def resp_to_string(resp):
-    # format the request
-    msg = "\n{0} {1}".format(resp.request.method, resp.request.url)
-    for k, v in resp.request.headers.items():
-        msg += "\n{0}: {1}".format(k, v)
-    if resp.request.body:
-        msg += "\n{0}".format(resp.request.body)
-    else:
-        msg += "\n<empty-body>"
+        self.preppers = []
+        for tenant, n_zones, n_recordsets in targets:
+            state = self.states.setdefault(tenant.id, {})
+            self.preppers.append(TenantPrepper(
+                client, tenant, n_zones, n_recordsets, state, self.slots,
+                self.stats, rate=args.rate,
+                tenant_concurrency=args.tenant_concurrency,
+                use_imports=args.use_imports,
+                imports_in_flight=args.imports_in_flight,
+                import_timeout=args.import_timeout))
 
-    msg += "\n"
+    def run(self):
+        print "Preparing %s tenants (%s of %s zones and recordsets exist as " \
+              "of the checkpoint)" % (len(self.preppers), self.stats.done,
+                                      self.stats.total)
+        self.stats.start()
+        reporter = gevent.spawn(self._report_progress)
+        try:
+            gevent.joinall([gevent.spawn(prepper.run)
+                            for prepper in self.preppers])
+        finally:
+            reporter.kill()
+            self.checkpoint.save(self.states)
+            self.stats.report()
+
+    def _report_progress(self):
+        while True:
+            gevent.sleep(self.args.report_interval)
+            self.stats.report()
+            self.checkpoint.save(self.states)
 
-    # format the response
-    msg += "\n{0} {1}".format(resp.status_code, resp.reason)
-    for k, v in resp.headers.items():
-        msg += "\n{0}: {1}".format(k, v)
-    msg += "\n{0}".format(resp.text)
-    msg = "\n  ".join(msg.split('\n'))
-    return msg
+
+def check_resp(resp):
+    if not resp.ok:
+        raise Exception("Bad response!\n%s" % format_response(resp))
 
 
 if __name__ == '__main__':
-    prepper = TenantPrepper(parse_args())
-    prepper.run()
+    args = parse_args()
+    engine = PrepEngine(args, load_targets(args))
+    engine.run()
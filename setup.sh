@@ -16,7 +16,7 @@ pip install -U --force --no-use-wheel pip
 hash -r
 pip install -U --force --no-use-wheel setuptools
 pip install -U distribute
-pip install pyzmq Flask-HTTPAuth
+pip install pyzmq Flask-HTTPAuth geventhttpclient
 
 git clone https://github.com/pglass/locust.git
 cd locust
@@ -0,0 +1,161 @@
+"""
+Splits the tenants between the slaves, so that the data is gathered once
+rather than once per slave.
+
+With shard_tenants, the master gathers (or loads from the snapshot) the data
+for every tenant at startup. When a slave starts gathering, it fetches its
+shard from the master instead: its share of the tenants, with their data.
+The slave then only authenticates and runs tasks for those tenants.
+
+Locust's master/slave messages are fixed (the master sends the same 'hatch'
+message to every slave), so there's no way to send a slave its own data
+with them. Instead, the master serves each slave's shard over http at
+/shard/<slave's client id>, and the slave polls that until the master is
+done gathering.
+
+The tenants are split between the slaves connected when the test first
+starts hatching, and the split is kept from then on, so every slave's shard
+is disjoint from the others' however the slaves come and go. Shards are
+served only once the split is made (503 until then), and a slave that
+connects after that gets a 409, since its tenants are already another
+slave's. To add slaves, restart the master.
+"""
+import json
+import logging
+import sys
+import time
+
+import gevent
+import locust.events
+import locust.runners
+import requests
+
+from models import TenantData
+
+LOG = logging.getLogger(__name__)
+
+# fired on a slave with tenants=<the tenants in its shard>
+shard_received = locust.events.EventHook()
+
+# on the master, the greenlet gathering for all the tenants, and the tenants
+gathering = None
+all_tenants = []
+# on the master, {client id: shard number} for the slaves connected when the
+# test first started, or None until then
+assignment = None
+
+
+class ShardError(Exception):
+    def __init__(self, msg):
+        super(ShardError, self).__init__(msg)
+
+
+def start_gathering(designate_client, tenants, gather):
+    """On the master, start gathering for all the tenants with
+    gather(designate_client, tenants)"""
+    global gathering, all_tenants
+    all_tenants = list(tenants)
+
+    def _gather():
+        start = time.time()
+        gather(designate_client, all_tenants)
+        # the master's own requests shouldn't show up in the test's stats
+        if locust.runners.locust_runner is not None:
+            locust.runners.locust_runner.stats.reset_all()
+        LOG.info("Gathered for %s tenants in %.1f seconds, ready to serve "
+                 "shards", len(all_tenants), time.time() - start)
+    gathering = gevent.spawn(_gather)
+    locust.events.master_start_hatching += assign_shards
+
+
+def assign_shards():
+    """Split the tenants between the connected slaves, the first time the
+    test starts"""
+    global assignment
+    if assignment is not None:
+        return
+    slaves = sorted(locust.runners.locust_runner.clients.keys())
+    assignment = dict((client_id, i) for i, client_id in enumerate(slaves))
+    LOG.info("Split %s tenants between %s slaves", len(all_tenants),
+             len(slaves))
+
+
+def shard_for(client_id):
+    """Return the slave's share of the tenants, or None if it wasn't
+    connected when the tenants were split"""
+    index = assignment.get(client_id)
+    if index is None:
+        return None
+    return all_tenants[index::len(assignment)]
+
+
+def serve_shard(client_id):
+    """Return (status code, body) for the slave's request for its shard"""
+    if gathering is None:
+        return 404, "The master isn't gathering (shard_tenants is off)"
+    if not gathering.ready():
+        return 503, "Still gathering"
+    if not gathering.successful():
+        return 500, "Gathering failed: %r" % gathering.exception
+    if assignment is None:
+        return 503, "Waiting for the test to start"
+    tenants = shard_for(client_id)
+    if tenants is None:
+        return 409, ("Slave %s connected after the tenants were split "
+                     "between the other slaves. Restart the master to add "
+                     "slaves." % client_id)
+    LOG.info("Sending %s tenants to slave %s", len(tenants), client_id)
+    return 200, json.dumps({
+        'byteorder': sys.byteorder,
+        'tenants': [{'id': tenant.id, 'data': tenant.data.to_dict()}
+                    for tenant in tenants],
+    })
+
+
+def fetch_shard(tenants, master_url=None, auth=None, retry_interval=5):
+    """On a slave, fetch its shard from the master, waiting for the master to
+    finish gathering. The slave's tenants get the data in the shard, and
+    shard_received is fired with them. Return them.
+
+    :param master_url: the master's web ui. By default, port 8089 on the
+        --master-host
+    :param auth: a (username, password) for the master's web ui
+    """
+    runner = locust.runners.locust_runner
+    client_id = runner.client_id
+    if master_url is None:
+        master_url = 'http://{0}:8089'.format(runner.master_host)
+    url = '{0}/shard/{1}'.format(master_url.rstrip('/'), client_id)
+    while True:
+        try:
+            resp = requests.get(url, auth=auth)
+        except requests.RequestException as e:
+            LOG.warning("Failed to reach the master for our shard: %s", e)
+        else:
+            if resp.status_code == 200:
+                break
+            elif resp.status_code != 503:
+                raise ShardError("Failed to get our shard from %s - %s %s"
+                                 % (url, resp.status_code, resp.text))
+        gevent.sleep(retry_interval)
+
+    shard = resp.json()
+    if shard['byteorder'] != sys.byteorder:
+        raise ShardError("The master's byte order is %s, not %s"
+                         % (shard['byteorder'], sys.byteorder))
+    by_id = dict((tenant.id, tenant) for tenant in tenants)
+    received = []
+    for entry in shard['tenants']:
+        tenant = by_id.get(entry['id'])
+        if tenant is None:
+            LOG.warning("Ignoring tenant %s, which isn't in our config",
+                        entry['id'])
+            continue
+        tenant.data = TenantData.from_dict(entry['data'])
+        received.append(tenant)
+    LOG.info("Got %s of %s tenants from the master", len(received),
+             len(tenants))
+    if not received:
+        LOG.warning("Our shard is empty. Are there more slaves than tenants?")
+    shard_received.fire(tenants=received)
+    return received
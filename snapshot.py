@@ -0,0 +1,176 @@
+"""
+Saves the zones and recordsets gathered for each tenant, so that the next
+test against the same Designate can skip most of the gathering.
+
+A snapshot is a json file for each Designate endpoint, with each tenant's
+TenantData keyed by the tenant's id. The pools are saved as base64 encoded
+arrays (see pools.py), so a snapshot is about as compact as the data in
+memory.
+
+A snapshot can be out of date, e.g. if zones were deleted by a test or by
+hand. At startup, spot_check() looks up a random sample of each tenant's
+zones and recordsets, and only the tenants that fail the check (or don't
+have enough data) are gathered again.
+
+The snapshot is saved once gathering is done, and again when the test
+stops, so it doesn't include the zones and recordsets the test deleted.
+"""
+import json
+import logging
+import os
+import random
+import re
+import sys
+import time
+
+import gevent.pool
+
+from models import TenantData
+
+LOG = logging.getLogger(__name__)
+
+# the snapshot format. older snapshots are ignored.
+VERSION = 1
+
+
+class GatherSnapshot(object):
+
+    @classmethod
+    def get(cls, _instance=[]):
+        """Return the snapshot for the configured Designate, or None if
+        snapshots are disabled"""
+        if not _instance:
+            import accurate_config as CONFIG
+            snapshot = None
+            if CONFIG.gather_snapshot_dir:
+                snapshot = GatherSnapshot(CONFIG.gather_snapshot_dir,
+                                          CONFIG.designate_host)
+            _instance.append(snapshot)
+        return _instance[0]
+
+    def __init__(self, directory, endpoint):
+        self.directory = directory
+        self.endpoint = endpoint
+        filename = 'gather-{0}.json'.format(
+            re.sub(r'[^A-Za-z0-9.-]+', '_', endpoint))
+        self.path = os.path.join(directory, filename)
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                snapshot = json.load(f)
+        except IOError:
+            return {}
+        except ValueError:
+            LOG.warning("Ignoring a corrupt snapshot %s", self.path)
+            return {}
+        if (snapshot.get('version') != VERSION
+                or snapshot.get('endpoint') != self.endpoint
+                or snapshot.get('byteorder') != sys.byteorder):
+            LOG.warning("Ignoring the snapshot %s, which was saved in a "
+                        "different format or for a different endpoint",
+                        self.path)
+            return {}
+        return snapshot['tenants']
+
+    def load(self, tenants):
+        """Replace each tenant's data with the data in the snapshot, if any.
+        Return the tenants that were in the snapshot."""
+        entries = self._read()
+        loaded = []
+        for tenant in tenants:
+            entry = entries.get(tenant.id)
+            if entry is None:
+                continue
+            try:
+                tenant.data = TenantData.from_dict(entry)
+            except (KeyError, TypeError, ValueError):
+                LOG.warning("Ignoring the bad snapshot of %s", tenant)
+                continue
+            loaded.append(tenant)
+        LOG.info("Loaded %s of %s tenants from %s", len(loaded), len(tenants),
+                 self.path)
+        return loaded
+
+    def save(self, tenants):
+        """Save the tenants' data, keeping any other tenants in the file"""
+        start = time.time()
+        entries = self._read()
+        for tenant in tenants:
+            entries[tenant.id] = tenant.data.to_dict()
+        snapshot = {
+            'version': VERSION,
+            'endpoint': self.endpoint,
+            'byteorder': sys.byteorder,
+            'tenants': entries,
+        }
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        # write and rename, so a reader never sees a partial file
+        tmp_path = '%s.%s' % (self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(snapshot, f)
+        os.rename(tmp_path, self.path)
+        LOG.info("Saved %s tenants to %s in %.1f seconds", len(tenants),
+                 self.path, time.time() - start)
+
+
+def _sample(pool, n):
+    return [pool[i] for i in random.sample(xrange(len(pool)),
+                                           min(n, len(pool)))]
+
+
+def _check_tenant(designate_client, tenant, sample_size):
+    """Return True if every zone and recordset in a random sample of the
+    tenant's data still exists"""
+    client = designate_client.as_user(tenant)
+    data = tenant.data
+    for name in TenantData.ZONE_POOLS:
+        for zone in _sample(getattr(data, name), sample_size):
+            resp = client.get_zone(zone.id, name='/v2/zones/ID - snapshot check',
+                                   no_log_request=True)
+            if not resp.ok:
+                LOG.info("%s: zone %s from the snapshot is gone (%s)",
+                         tenant, zone.id, resp.status_code)
+                return False
+    for name in TenantData.RECORDSET_POOLS:
+        for recordset in _sample(getattr(data, name), sample_size):
+            resp = client.get_recordset(
+                recordset.zone.id, recordset.id,
+                name='/v2/zones/ID/recordsets/ID - snapshot check',
+                no_log_request=True)
+            if not resp.ok:
+                LOG.info("%s: recordset %s from the snapshot is gone (%s)",
+                         tenant, recordset.id, resp.status_code)
+                return False
+    return True
+
+
+def spot_check(designate_client, tenants, is_complete, sample_size=5,
+               concurrency=20):
+    """Check a sample of each tenant's zones and recordsets. A tenant that
+    fails the check, or isn't complete (according to is_complete(tenant)),
+    has its data cleared, so that it's gathered again from scratch. Return
+    the tenants that passed."""
+    start = time.time()
+    pool = gevent.pool.Pool(concurrency)
+    passed = []
+
+    def check(tenant):
+        try:
+            ok = is_complete(tenant) and _check_tenant(
+                designate_client, tenant, sample_size)
+        except Exception:
+            LOG.exception("Failed to check the snapshot of %s", tenant)
+            ok = False
+        if ok:
+            passed.append(tenant)
+        else:
+            tenant.data = TenantData()
+
+    for tenant in tenants:
+        pool.spawn(check, tenant)
+    pool.join()
+    LOG.info("%s of %s tenants from the snapshot passed the spot check in "
+             "%.1f seconds", len(passed), len(tenants), time.time() - start)
+    return passed
@@ -6,8 +6,10 @@ from locust import TaskSet
 import locust.events
 import gevent
 
+import async_stats
 import digaas_integration
 import client
+from poller import PollScheduler, Watch
 import accurate_config as CONFIG
 from datagen import select_random_item
 
@@ -40,54 +42,67 @@ class BaseTaskSet(TaskSet):
     def _poll_until_active_or_error(self, api_call, status_function,
                                     success_function, failure_function,
                                     expected='ACTIVE',
-                                    interval=CONFIG.async_interval,
-                                    timeout=CONFIG.async_timeout):
-        start = time.time()
-        end_time = time.time() + timeout
-        while time.time() < end_time:
-            try:
-                resp = api_call()
-                if resp.ok and status_function(resp) == expected:
-                    success_function()
-                    return
-                elif resp.ok and status_function(resp) == 'ERROR':
-                    failure_function("Failed - saw ERROR status")
-                    return
-            except Exception as e:
-                locust.events.locust_error.fire(
-                    locust_instance=self, exception=e, tb=sys.exc_info()[2]
-                )
-            gevent.sleep(interval)
-        failure_function("Failed - timed out after %s seconds" % timeout)
+                                    timeout=CONFIG.async_timeout,
+                                    group=None, resource_id=None):
+        """Wait until the status is the expected one, or ERROR, or we time
+        out. The polling is done by the PollScheduler, which can coalesce
+        checks on resources in the same group (see poller.py).
+
+        The success_function is passed the Watch, which should be handed to
+        async_success to record the measurement bounds.
+
+        Return the response with the expected status, or None on failure.
+        """
+        watch = Watch(
+            check=api_call,
+            success_function=success_function,
+            failure_function=failure_function,
+            status_function=status_function,
+            expected=expected,
+            timeout=timeout,
+            group=group,
+            resource_id=resource_id,
+            owner=self,
+        )
+        return PollScheduler.get().wait(watch)
 
     def _poll_until_404(self, api_call, success_function, failure_function,
-                        interval=CONFIG.async_interval,
-                        timeout=CONFIG.async_timeout):
-        end_time = time.time() + timeout
-        while time.time() < end_time:
-            try:
-                with api_call() as resp:
-                    if resp.status_code == 404:
-                        # ensure the 404 isn't marked as a failure in the report
-                        resp.success()
-                        # mark the original (delete) request as a success
-                        success_function()
-                        return
-            except Exception as e:
-                locust.events.locust_error.fire(
-                    locust_instance=self, exception=e, tb=sys.exc_info()[2]
-                )
-            gevent.sleep(interval)
-        failure_function("Failed - timed out afer %s seconds" % timeout)
-
-    def async_success(self, resp, start_time, name):
+                        timeout=CONFIG.async_timeout,
+                        group=None, resource_id=None):
+        """The api_call must use catch_response=True, so that the 404 isn't
+        marked as a failure in the report."""
+        watch = Watch(
+            check=api_call,
+            success_function=success_function,
+            failure_function=failure_function,
+            until_404=True,
+            timeout=timeout,
+            group=group,
+            resource_id=resource_id,
+            owner=self,
+        )
+        return PollScheduler.get().wait(watch)
+
+    def async_success(self, resp, start_time, name, watch=None):
         """When polling for an ACTIVE status, we want the response time to be
         the time until we saw the ACTIVE status. This is used to do that
-        in combination with catch_response"""
+        in combination with catch_response.
+
+        If the watch is given, the response time is when the watch first saw
+        the operation done, and the lower bound (the last time it was seen
+        pending) is recorded alongside it.
+        """
+        end_time = time.time()
+        if watch is not None:
+            end_time = watch.done_at
+            lower = (watch.last_pending_at or start_time) - start_time
+            upper = end_time - start_time
+            async_stats.bounds.record(
+                resp.request.method, name, lower * 1000, upper * 1000)
         locust.events.request_success.fire(
             request_type=resp.request.method,
             name=name,
-            response_time=int((time.time() - start_time) * 1000),
+            response_time=int((end_time - start_time) * 1000),
             response_length=len(resp.content),
 
         )
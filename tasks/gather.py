@@ -1,61 +1,199 @@
 import logging
-import urlparse
+import random
+import time
 
+import gevent
+import gevent.event
+import gevent.pool
 import locust.events
 import locust.runners
 
 from base import BaseTaskSet
+import insight
+import sharding
 from models import Zone, Recordset
 from paginator import PaginationFrontier
+import snapshot
+from snapshot import GatherSnapshot
 import accurate_config as CONFIG
 
 LOG = logging.getLogger(__name__)
 
+_ZONE_RECORDSETS = "/v2/zones/{0}/recordsets".format
 
-class GatherTasks(BaseTaskSet):
 
-    frontier = None
+def enough_data(tenant):
+    return tenant.data.exceeds_quotas(
+        n_get_zones = CONFIG.n_zones_for_get_per_tenant,
+        n_delete_zones = CONFIG.n_zones_for_delete_per_tenant,
+        n_get_recordsets = CONFIG.n_recordsets_for_get_per_tenant,
+        n_delete_recordsets = CONFIG.n_recordsets_for_delete_per_tenant)
 
-    def _log_tenants(self):
-        LOG.info("---- tenants -----")
-        for t in self.tenant_list:
-            LOG.info(str(t))
 
-    def on_start(self):
-        LOG.debug("GatherTasks.on_start()")
-        self._log_tenants()
-        if not GatherTasks.frontier:
-            GatherTasks.frontier = PaginationFrontier(self.tenant_list)
-
-    def done(self):
-        for tenant in self.frontier.tenant_list:
-            enough_zones_and_recordsets = tenant.data.exceeds_quotas(
-                n_get_zones = CONFIG.n_zones_for_get_per_tenant,
-                n_delete_zones = CONFIG.n_zones_for_delete_per_tenant,
-                n_get_recordsets = CONFIG.n_recordsets_for_get_per_tenant,
-                n_delete_recordsets = CONFIG.n_recordsets_for_delete_per_tenant)
-
-            if enough_zones_and_recordsets:
-                LOG.info("%s has enough stuff!" % tenant)
+def gathered_fraction(tenant):
+    """Return how much of the data we want for the tenant we have, from 0
+    to 1"""
+    data = tenant.data
+    have_and_want = (
+        (len(data.zones_for_get), CONFIG.n_zones_for_get_per_tenant),
+        (len(data.zones_for_delete), CONFIG.n_zones_for_delete_per_tenant),
+        (len(data.recordsets_for_get), CONFIG.n_recordsets_for_get_per_tenant),
+        (len(data.recordsets_for_delete),
+         CONFIG.n_recordsets_for_delete_per_tenant),
+    )
+    want = sum(w for _, w in have_and_want)
+    if not want:
+        return 1.0
+    return sum(min(h, w) for h, w in have_and_want) / float(want)
+
+
+class GatherDriver(object):
+    """Follows the pages of zones and recordsets for all tenants at once,
+    with at most `concurrency` pages in flight, until every tenant has
+    enough data or runs out of pages. Progress is logged every
+    report_interval seconds, with the pages per second and an ETA.
+
+    Usage:
+        driver = GatherDriver(designate_client, tenants, concurrency=20)
+        driver.start()
+        driver.join()
+    """
+
+    # the number of items per list request, or None for designate's default
+    page_size = None
+
+    def __init__(self, designate_client, tenants, concurrency=20,
+                 report_interval=10):
+        self.designate_client = designate_client
+        self.all_tenants = list(tenants)
+        self.frontier = PaginationFrontier(self.all_tenants)
+        self.concurrency = concurrency
+        self.report_interval = report_interval
+        self.pool = gevent.pool.Pool(concurrency)
+        # set whenever a page is done
+        self.page_done = gevent.event.Event()
+        self.in_flight = 0
+        # {tenant: number of its pages in flight}
+        self.busy = {}
+        self.pages = 0
+        self.start_time = None
+        self.greenlet = None
+
+        # tenants may already have enough data, e.g. from a snapshot
+        for tenant in self.all_tenants:
+            if enough_data(tenant):
                 self.frontier.remove_tenant(tenant)
-                LOG.debug("Tenants left: {0}".format(self.frontier.tenant_list))
 
-        return self.frontier.is_empty()
+    def start(self):
+        if self.greenlet is None:
+            self.greenlet = gevent.spawn(self.run)
+        return self.greenlet
 
-    def gather_zones(self):
-        if self.done():
-            LOG.debug("we're done!")
-            self.done_gathering.fire()
-            return
+    def join(self):
+        self.start().join()
+
+    def run(self):
+        self.start_time = time.time()
+        LOG.info("Gathering data for %s tenants, %s pages at a time",
+                 len(self.frontier.tenants), self.concurrency)
+        reporter = gevent.spawn(self._report_progress)
+        try:
+            turn = 0
+            while not self.frontier.is_empty() or self.in_flight:
+                # take turns between zone and recordset pages
+                turn += 1
+                if turn % 2:
+                    job = self._next_zone_page() or self._next_recordset_page()
+                else:
+                    job = self._next_recordset_page() or self._next_zone_page()
 
-        # grab a list zones link from our 'frontier' of links
+                if job is not None:
+                    tenant = job[-1]
+                    self.in_flight += 1
+                    self.busy[tenant] = self.busy.get(tenant, 0) + 1
+                    self.pool.spawn(self._run_page, *job)
+                else:
+                    # the next links come back with the pages in flight
+                    self.page_done.clear()
+                    self.page_done.wait()
+        finally:
+            reporter.kill()
+        self._log_progress()
+        for tenant in self.all_tenants:
+            if not enough_data(tenant):
+                LOG.warning("%s ran out of pages with only %s zones and %s "
+                            "recordsets", tenant, tenant.data.zone_count(),
+                            tenant.data.recordset_count())
+
+    def _next_zone_page(self):
         link, tenant = self.frontier.pop_next_zone_link()
-        if not link:
-            return
+        if link:
+            return self._gather_zones, link, tenant
+
+    def _next_recordset_page(self):
+        zone, link, tenant = self.frontier.pop_next_recordset_link()
+        if link:
+            return self._gather_recordsets, zone, link, tenant
+
+    def _run_page(self, f, *args):
+        tenant = args[-1]
+        try:
+            try:
+                f(*args)
+                self.pages += 1
+            finally:
+                self.in_flight -= 1
+                self.busy[tenant] -= 1
+            self._tenant_page_done(tenant)
+        except Exception:
+            LOG.exception("Failed to gather a page for %s", tenant)
+        finally:
+            self.page_done.set()
+
+    def _tenant_page_done(self, tenant):
+        if enough_data(tenant):
+            LOG.info("%s has enough stuff!", tenant)
+            self.frontier.remove_tenant(tenant)
+
+    def progress(self):
+        """Return the fraction of the gathering that's done, from 0 to 1"""
+        if not self.all_tenants:
+            return 1.0
+        total = 0.0
+        for tenant in self.all_tenants:
+            if (tenant not in self.frontier.tenants
+                    or not self.frontier.has_links(tenant)):
+                total += 1
+            else:
+                total += gathered_fraction(tenant)
+        return total / len(self.all_tenants)
+
+    def _log_progress(self):
+        elapsed = time.time() - self.start_time
+        rate = self.pages / elapsed if elapsed else 0
+        progress = self.progress()
+        if progress >= 1:
+            eta = "done"
+        elif progress > 0:
+            eta = "ETA %.0f seconds" % (elapsed * (1 - progress) / progress)
+        else:
+            eta = "ETA unknown"
+        LOG.info("Gathered %s pages in %.0f seconds (%.1f pages/sec), %.0f%% "
+                 "done, %s tenants left, %s", self.pages, elapsed, rate,
+                 progress * 100, len(self.frontier.tenants), eta)
+
+    def _report_progress(self):
+        while True:
+            gevent.sleep(self.report_interval)
+            self._log_progress()
+
+    def _gather_zones(self, link, tenant):
         # we want to be careful to retain the 'marker=<uuid>' that's used to
         # grab different pages of a paginated list
         path, params = self.frontier.parse_url(link)
         params['sort_key'] = 'id'
+        if self.page_size:
+            params['limit'] = self.page_size
 
         client = self.designate_client.as_user(tenant)
         resp = client.get(path, name='/v2/zones', params=params)
@@ -63,38 +201,32 @@ class GatherTasks(BaseTaskSet):
             LOG.error("failed to list zones while gathering zones")
             return
 
-        zones = resp.json()['zones']
-        links = resp.json()['links']
-        LOG.info("%s -- fetched %s zones for tenant %s",
-                 resp.request.url, len(zones), tenant)
+        body = resp.json()
+        zones = body['zones']
+        links = body['links']
+        LOG.debug("%s -- fetched %s zones for tenant %s",
+                  resp.request.url, len(zones), tenant)
         if 'next' in links:
             self.frontier.add_zone_link(links['next'], tenant)
         else:
             LOG.debug("no more zone 'next' links to pursue")
         for z in zones:
-            zone = Zone(z['id'], z['name'])
+            self._add_zone(tenant, Zone(z['id'], z['name']))
 
-            # be sure to avoid storing recordsets on zones we're going to delete
-            if len(tenant.data.zones_for_get) <= len(tenant.data.zones_for_delete):
-                tenant.data.zones_for_get.append(zone)
-
-                path, _ = self.frontier.parse_url(z['links']['self'])
-                recordset_link = "{0}/recordsets".format(path)
-                self.frontier.add_recordset_link(zone, recordset_link, tenant)
-            else:
-                tenant.data.zones_for_delete.append(zone)
-
-    def gather_recordsets(self):
-        if self.done():
-            LOG.debug("we're done!")
-            self.done_gathering.fire()
-            return
+    def _add_zone(self, tenant, zone):
+        # be sure to avoid storing recordsets on zones we're going to delete
+        if len(tenant.data.zones_for_get) <= len(tenant.data.zones_for_delete):
+            tenant.data.zones_for_get.append(zone)
+            self.frontier.add_recordset_link(
+                zone, _ZONE_RECORDSETS(zone.id), tenant)
+        else:
+            tenant.data.zones_for_delete.append(zone)
 
-        zone, link, tenant = self.frontier.pop_next_recordset_link()
-        if not link:
-            return
+    def _gather_recordsets(self, zone, link, tenant):
         path, params = self.frontier.parse_url(link)
         params['sort_key'] = 'id'
+        if self.page_size:
+            params['limit'] = self.page_size
 
         client = self.designate_client.as_user(tenant)
         resp = client.get(path, name='/v2/zones/ID/recordsets', params=params)
@@ -102,11 +234,12 @@ class GatherTasks(BaseTaskSet):
             LOG.error("failed to list recordsets while gathering recordsets")
             return
 
-        recordsets = resp.json()['recordsets']
-        links = resp.json()['links']
+        body = resp.json()
+        recordsets = body['recordsets']
+        links = body['links']
 
-        LOG.info("%s -- fetched %s recordsets for tenant %s",
-                resp.request.url, len(recordsets), tenant)
+        LOG.debug("%s -- fetched %s recordsets for tenant %s",
+                  resp.request.url, len(recordsets), tenant)
         if 'next' in links:
             self.frontier.add_recordset_link(zone, links['next'], tenant)
 
@@ -116,9 +249,170 @@ class GatherTasks(BaseTaskSet):
 
             # we're assuming only one record per recordset.
             # this is guaranteed as long we're in control of data creation
-            recordset = Recordset(zone, r['id'], r['records'][0], r['type'])
+            self._add_recordset(
+                tenant, Recordset(zone, r['id'], r['records'][0], r['type']))
 
-            if len(tenant.data.recordsets_for_get) <= len(tenant.data.recordsets_for_delete):
-                tenant.data.recordsets_for_get.append(recordset)
-            else:
-                tenant.data.recordsets_for_delete.append(recordset)
+    def _add_recordset(self, tenant, recordset):
+        if len(tenant.data.recordsets_for_get) <= len(tenant.data.recordsets_for_delete):
+            tenant.data.recordsets_for_get.append(recordset)
+        else:
+            tenant.data.recordsets_for_delete.append(recordset)
+
+
+class Reservoir(object):
+    """A uniform random sample of at most `size` of the items offered, out of
+    any number of items (Vitter's algorithm R)"""
+
+    def __init__(self, size):
+        self.size = size
+        self.items = []
+        self.seen = 0
+
+    def offer(self, item):
+        self.seen += 1
+        if len(self.items) < self.size:
+            self.items.append(item)
+        else:
+            i = random.randrange(self.seen)
+            if i < self.size:
+                self.items[i] = item
+
+    def shuffled(self):
+        items = list(self.items)
+        random.shuffle(items)
+        return items
+
+
+class SamplingGatherDriver(GatherDriver):
+    """Gathers a uniform random sample of each tenant's zones, and of the
+    recordsets in the sampled zones for getting, instead of the zones and
+    recordsets with the lowest ids. Otherwise every test reads the same few
+    zones, which stay hot in Designate's database and caches.
+
+    Each tenant's whole zone list is read, with the largest page size,
+    keeping a reservoir of as many zones as we want. Once the list is done,
+    the sample is split between getting and deleting, and the recordsets of
+    the zones for getting are read the same way.
+
+    Designate only takes the id of an existing item as a pagination marker,
+    so we can't jump to random points in the list instead.
+    """
+
+    page_size = 1000
+
+    def __init__(self, *args, **kwargs):
+        super(SamplingGatherDriver, self).__init__(*args, **kwargs)
+        n_zones = (CONFIG.n_zones_for_get_per_tenant +
+                   CONFIG.n_zones_for_delete_per_tenant)
+        n_recordsets = (CONFIG.n_recordsets_for_get_per_tenant +
+                        CONFIG.n_recordsets_for_delete_per_tenant)
+        self.zone_samples = {}
+        self.recordset_samples = {}
+        for tenant in self.frontier.tenants:
+            self.zone_samples[tenant] = Reservoir(n_zones)
+            self.recordset_samples[tenant] = Reservoir(n_recordsets)
+
+    def _add_zone(self, tenant, zone):
+        self.zone_samples[tenant].offer(zone)
+
+    def _add_recordset(self, tenant, recordset):
+        self.recordset_samples[tenant].offer(recordset)
+
+    def _tenant_page_done(self, tenant):
+        if self.busy[tenant] or self.frontier.has_links(tenant):
+            return
+        # the tenant's last list is done
+        if tenant in self.zone_samples:
+            self._use_zone_sample(tenant)
+        if not self.frontier.has_links(tenant):
+            self._use_recordset_sample(tenant)
+            LOG.info("%s has a sample of %s zones and %s recordsets", tenant,
+                     tenant.data.zone_count(), tenant.data.recordset_count())
+            self.frontier.remove_tenant(tenant)
+
+    def _use_zone_sample(self, tenant):
+        sample = self.zone_samples.pop(tenant)
+        zones = sample.shuffled()
+        n_get = CONFIG.n_zones_for_get_per_tenant
+        for zone in zones[:n_get]:
+            tenant.data.zones_for_get.append(zone)
+            self.frontier.add_recordset_link(
+                zone, _ZONE_RECORDSETS(zone.id), tenant)
+        for zone in zones[n_get:]:
+            tenant.data.zones_for_delete.append(zone)
+
+    def _use_recordset_sample(self, tenant):
+        sample = self.recordset_samples.pop(tenant)
+        recordsets = sample.shuffled()
+        n_get = CONFIG.n_recordsets_for_get_per_tenant
+        for recordset in recordsets[:n_get]:
+            tenant.data.recordsets_for_get.append(recordset)
+        for recordset in recordsets[n_get:]:
+            tenant.data.recordsets_for_delete.append(recordset)
+
+
+def gather_all(designate_client, tenants):
+    """Load what we can from the snapshot, then gather the rest"""
+    gather_snapshot = GatherSnapshot.get()
+    if gather_snapshot is not None:
+        snapshot.spot_check(
+            designate_client, gather_snapshot.load(tenants),
+            is_complete=enough_data,
+            sample_size=CONFIG.gather_snapshot_spot_checks,
+            concurrency=CONFIG.gather_concurrency)
+
+    driver_class = SamplingGatherDriver if CONFIG.gather_sample else GatherDriver
+    driver = driver_class(
+        designate_client, tenants,
+        concurrency=CONFIG.gather_concurrency,
+        report_interval=CONFIG.gather_report_interval)
+    driver.join()
+
+    if gather_snapshot is not None and driver.pages:
+        gather_snapshot.save(tenants)
+
+
+class GatherError(Exception):
+    def __init__(self, msg):
+        super(GatherError, self).__init__(msg)
+
+
+class GatherTasks(BaseTaskSet):
+    """Gathers the data the test needs before it starts. The first locust
+    loads what it can from the snapshot, and starts a GatherDriver to gather
+    the rest for every tenant, or with shard_tenants, fetches this slave's
+    share from the master. All the locusts wait for it to finish. If it
+    fails, the test doesn't start, and the gather task raises a GatherError
+    (which shows up with the locust errors) each time it runs."""
+
+    gathering = None
+
+    def _log_tenants(self):
+        LOG.info("---- tenants -----")
+        for t in self.tenant_list:
+            LOG.info(str(t))
+
+    def on_start(self):
+        LOG.debug("GatherTasks.on_start()")
+        if GatherTasks.gathering is None:
+            self._log_tenants()
+            GatherTasks.gathering = gevent.spawn(self._gather_all)
+
+    def _gather_all(self):
+        if CONFIG.shard_tenants and insight.is_slave():
+            # the master has gathered for everyone
+            auth = None
+            if CONFIG.username and CONFIG.password:
+                auth = (CONFIG.username, CONFIG.password)
+            sharding.fetch_shard(self.tenant_list,
+                                 master_url=CONFIG.shard_master_url, auth=auth)
+        else:
+            gather_all(self.designate_client, self.tenant_list)
+
+    def gather(self):
+        self.gathering.join()
+        if not self.gathering.successful():
+            raise GatherError("Gathering failed: %r"
+                              % self.gathering.exception)
+        LOG.debug("we're done!")
+        self.done_gathering.fire()
@@ -1,13 +1,73 @@
 import urlparse
+from collections import deque
+
+
+class LinkQueues(object):
+    """A queue of links for each tenant. Pops take turns between the tenants
+    that have links, so no tenant's pages starve the others'. Adding, popping
+    and removing a tenant are O(1)."""
+
+    def __init__(self):
+        # {tenant: deque of items}, only for tenants with queued items
+        self.queues = {}
+        # the tenants with queued items, in the order they get a turn
+        self.turns = deque()
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, tenant, item):
+        queue = self.queues.get(tenant)
+        if queue is None:
+            queue = self.queues[tenant] = deque()
+            self.turns.append(tenant)
+        queue.append(item)
+        self.size += 1
+
+    def pop(self):
+        """Return the next item, or None if there are none"""
+        while self.turns:
+            tenant = self.turns.popleft()
+            queue = self.queues.get(tenant)
+            if not queue:
+                # the tenant was removed
+                continue
+            item = queue.popleft()
+            self.size -= 1
+            if queue:
+                self.turns.append(tenant)
+            else:
+                del self.queues[tenant]
+            return item
+        return None
+
+    def has_tenant(self, tenant):
+        return tenant in self.queues
+
+    def remove_tenant(self, tenant):
+        # its place in the turns is skipped when it comes up
+        queue = self.queues.pop(tenant, None)
+        if queue:
+            self.size -= len(queue)
+
 
 class PaginationFrontier(object):
     """This is the frontier of "next" links for exploring paginated lists
     across multiple tenants"""
 
     def __init__(self, tenants):
-        self.tenant_list = list(tenants)
-        self.next_zone_links = [('/v2/zones', t) for t in self.tenant_list]
-        self.next_recordset_links = []
+        self._all_tenants = list(tenants)
+        # the tenants we're still gathering for
+        self.tenants = set(self._all_tenants)
+        self.zone_links = LinkQueues()
+        self.recordset_links = LinkQueues()
+        for tenant in self._all_tenants:
+            self.add_zone_link('/v2/zones', tenant)
+
+    @property
+    def tenant_list(self):
+        return [t for t in self._all_tenants if t in self.tenants]
 
     @classmethod
     def parse_url(cls, link):
@@ -18,28 +78,28 @@ class PaginationFrontier(object):
         return parts.path, params
 
     def add_zone_link(self, link, tenant):
-        self.next_zone_links.append((link, tenant))
+        if tenant in self.tenants:
+            self.zone_links.add(tenant, (link, tenant))
 
     def add_recordset_link(self, zone, link, tenant):
-        self.next_recordset_links.append((zone, link, tenant))
+        if tenant in self.tenants:
+            self.recordset_links.add(tenant, (zone, link, tenant))
 
     def pop_next_zone_link(self):
-        if self.next_zone_links:
-            return self.next_zone_links.pop(0)
-        return None, None
+        return self.zone_links.pop() or (None, None)
 
     def pop_next_recordset_link(self):
-        if self.next_recordset_links:
-            return self.next_recordset_links.pop(0)
-        return None, None, None
+        return self.recordset_links.pop() or (None, None, None)
+
+    def has_links(self, tenant):
+        return (self.zone_links.has_tenant(tenant) or
+                self.recordset_links.has_tenant(tenant))
 
     def remove_tenant(self, tenant):
-        self.tenant_list.remove(tenant)
-        self.next_zone_links = [
-            x for x in self.next_zone_links if x[-1] != tenant]
-        self.next_recordset_links = [
-            x for x in self.next_recordset_links if x[-1] != tenant]
+        self.tenants.discard(tenant)
+        self.zone_links.remove_tenant(tenant)
+        self.recordset_links.remove_tenant(tenant)
 
     def is_empty(self):
-        return (not self.next_zone_links and not self.next_recordset_links) \
-            or not self.tenant_list
+        return (not self.zone_links and not self.recordset_links) \
+            or not self.tenants
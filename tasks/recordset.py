@@ -10,6 +10,7 @@ import gevent
 from base import BaseTaskSet
 import datagen
 from greenlet_manager import GreenletManager
+from poller import RecordsetStatusGroup
 import accurate_config as CONFIG
 from models import Recordset
 
@@ -49,10 +50,7 @@ class RecordsetTasks(BaseTaskSet):
 
     def create_record(self):
         """POST /zones/ID/recordsets"""
-        gevent.spawn(
-            GreenletManager.get().tracked_greenlet,
-            lambda: self._do_create_record(),
-        )
+        GreenletManager.get().spawn('create_record', self._do_create_record)
 
     def _do_create_record(self):
         tenant = self.select_random_tenant()
@@ -64,16 +62,12 @@ class RecordsetTasks(BaseTaskSet):
             LOG.warning("don't know of any zones to create records on")
             return
 
-        record_name = "{0}.{1}".format(datagen.randomize("record"), zone.name)
-        payload = { "name" : record_name,
-                    "type" : "A",
-                    "ttl" : 3600,
-                    "records" : [ datagen.random_ip() ] }
+        record_name, payload = datagen.DataGenerator.get().recordset(zone.name)
 
         start_time = time.time()
         post_resp = client.post_recordset(
             zone.id,
-            data=json.dumps(payload),
+            data=payload,
             name='/v2/zones/ID/recordsets',
         )
 
@@ -95,29 +89,32 @@ class RecordsetTasks(BaseTaskSet):
             else:
                 self.digaas_behaviors.observe_zone_update(get_zone, start_time)
 
+        recordset_id = post_resp.json()['id']
         api_call = lambda: client.get_recordset(
             zone_id=zone.id,
-            recordset_id=post_resp.json()['id'],
+            recordset_id=recordset_id,
             name='/v2/zones/ID/recordsets/ID - status check')
-        self._poll_until_active_or_error(
+        resp = self._poll_until_active_or_error(
             api_call=api_call,
             status_function=lambda r: r.json()['status'],
-            success_function=lambda: self.async_success(
-                post_resp, start_time, '/v2/zones/ID/recordsets - async',
+            success_function=lambda watch: self.async_success(
+                post_resp, start_time, '/v2/zones/ID/recordsets - async', watch,
             ),
             failure_function=lambda msg: self.async_failure(
                 post_resp, start_time, '/v2/zones/ID/recordsets - async', msg
             ),
+            group=RecordsetStatusGroup(client, zone.id),
+            resource_id=recordset_id,
         )
 
         # if we successfully created the recordset, add it to our list
-        resp = api_call()
-        if resp.ok and resp.json()['status'] == 'ACTIVE':
+        if resp is not None:
+            body = resp.json()
             recordset = Recordset(
                 zone = zone,
-                id = resp.json()['id'],
-                data = resp.json()['records'][0],
-                type = resp.json()['type'])
+                id = body['id'],
+                data = body['records'][0],
+                type = body['type'])
 
             # add to the list of things for deleting, to help us not run
             # out of zones to delete
@@ -126,10 +123,7 @@ class RecordsetTasks(BaseTaskSet):
             LOG.info("have %s records", tenant.data.recordset_count())
 
     def modify_record(self):
-        gevent.spawn(
-            GreenletManager.get().tracked_greenlet,
-            lambda: self._do_modify_record(),
-        )
+        GreenletManager.get().spawn('modify_record', self._do_modify_record)
 
     def _do_modify_record(self):
         """PATCH /zones/ID/recordsets/ID"""
@@ -142,13 +136,12 @@ class RecordsetTasks(BaseTaskSet):
             LOG.error("%s has no recordsets for updating", tenant)
             return
 
-        payload = { "records": [ datagen.random_ip() ],
-                    "ttl": random.randint(2400, 7200) }
+        payload = datagen.DataGenerator.get().recordset_update()
         start_time = time.time()
         put_resp = client.put_recordset(
             recordset.zone.id,
             recordset.id,
-            data=json.dumps(payload),
+            data=payload,
             name="/v2/zones/ID/recordsets/ID",
         )
 
@@ -165,27 +158,27 @@ class RecordsetTasks(BaseTaskSet):
             else:
                 self.digaas_behaviors.observe_zone_update(get_zone, start_time)
 
+        put_body = put_resp.json()
         api_call = lambda: client.get_recordset(
-            zone_id=put_resp.json()['zone_id'],
-            recordset_id=put_resp.json()['id'],
+            zone_id=put_body['zone_id'],
+            recordset_id=put_body['id'],
             name='/v2/zones/ID/recordsets/ID - status check')
         self._poll_until_active_or_error(
             api_call=api_call,
             status_function=lambda r: r.json()['status'],
-            success_function=lambda: self.async_success(
-                put_resp, start_time, '/v2/zones/ID/recordsets/ID - async',
+            success_function=lambda watch: self.async_success(
+                put_resp, start_time, '/v2/zones/ID/recordsets/ID - async', watch,
             ),
             failure_function=lambda msg: self.async_failure(
                 put_resp, start_time, '/v2/zones/ID/recordsets/ID - async', msg
             ),
+            group=RecordsetStatusGroup(client, recordset.zone.id),
+            resource_id=recordset.id,
         )
 
     def remove_record(self):
         """DELETE /zones/ID/recordsets/ID"""
-        gevent.spawn(
-            GreenletManager.get().tracked_greenlet,
-            lambda: self._do_remove_record(),
-        )
+        GreenletManager.get().spawn('remove_record', self._do_remove_record)
 
     def _do_remove_record(self):
         tenant = self.select_random_tenant()
@@ -226,10 +219,12 @@ class RecordsetTasks(BaseTaskSet):
 
         self._poll_until_404(
             api_call=api_call,
-            success_function=lambda: self.async_success(
-                del_resp, start_time, '/v2/zones/ID/recordsets/ID - async',
+            success_function=lambda watch: self.async_success(
+                del_resp, start_time, '/v2/zones/ID/recordsets/ID - async', watch,
             ),
             failure_function=lambda msg: self.async_failure(
                 del_resp, start_time, '/v2/zones/ID/recordsets/ID - async', msg
             ),
+            group=RecordsetStatusGroup(client, recordset.zone.id),
+            resource_id=recordset.id,
         )
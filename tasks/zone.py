@@ -10,6 +10,7 @@ from base import BaseTaskSet
 from models import Zone
 from datagen import *
 from greenlet_manager import GreenletManager
+from poller import ZoneStatusGroup
 import accurate_config as CONFIG
 
 LOG = logging.getLogger(__name__)
@@ -58,10 +59,7 @@ class ZoneTasks(BaseTaskSet):
             2. GET /zones/tasks/exports/ID (poll for COMPLETED)
             3. GET /zones/tasks/export (Accept: text/dns)
         """
-        gevent.spawn(
-            GreenletManager.get().tracked_greenlet,
-            lambda: self._do_export_domain(),
-        )
+        GreenletManager.get().spawn('export_domain', self._do_export_domain)
 
 
     def _do_export_domain(self):
@@ -90,93 +88,96 @@ class ZoneTasks(BaseTaskSet):
             name='/v2/zones/tasks/exports/ID',
         )
 
-        self._poll_until_active_or_error(
+        resp = self._poll_until_active_or_error(
             api_call=api_call,
             status_function=lambda r: r.json()['status'],
-            success_function=lambda: self.async_success(
-                post_resp, start_time, '/v2/zones/ID/tasks/export - async',
+            success_function=lambda watch: self.async_success(
+                post_resp, start_time, '/v2/zones/ID/tasks/export - async', watch,
             ),
             failure_function=lambda msg: self.async_failure(
                 post_resp, start_time, '/v2/zones/ID/tasks/export - async', msg
             ),
             expected='COMPLETE',
         )
+        if resp is None:
+            return
 
-        export_resp = client.get_exported_zone_file(
+        # stream the zone file, recording the time to first byte and the
+        # transfer time separately
+        client.get_exported_zone_file(
             export_id=export_id,
             name='/v2/zones/tasks/exports/ID/export',
+            stream=True,
+            chunk_size=CONFIG.export_chunk_size,
         )
 
     def create_domain(self):
         """POST /zones"""
-        gevent.spawn(
-            GreenletManager.get().tracked_greenlet,
-            lambda: self._do_create_domain(),
-        )
+        GreenletManager.get().spawn('create_domain', self._do_create_domain)
 
     def _do_create_domain(self):
         tenant = self.select_random_tenant()
         if not tenant:
             return
         client = self.designate_client.as_user(tenant)
-        zone_name, email = random_zone_email()
-        payload = { "name": zone_name,
-                    "email": email,
-                    "ttl": 7200 }
+        zone_name, payload = DataGenerator.get().zone()
 
         # the with block lets us specify when the request has succeeded.
         # this lets us time how long until an active or error status.
         start_time = time.time()
         post_resp = client.post_zone(
-            data=json.dumps(payload), name='/v2/zones'
+            data=payload, name='/v2/zones'
         )
         if not post_resp.ok:
             return
         if CONFIG.use_digaas:
             self.digaas_behaviors.observe_zone_create(post_resp, start_time)
 
+        zone_id = post_resp.json()['id']
         api_call = lambda: client.get_zone(
-            zone_id=post_resp.json()['id'],
+            zone_id=zone_id,
             name='/v2/zones/ID - status check')
 
-        self._poll_until_active_or_error(
+        resp = self._poll_until_active_or_error(
             api_call=api_call,
             status_function=lambda r: r.json()['status'],
-            success_function=lambda: self.async_success(
-                post_resp, start_time, '/v2/zones - async'
+            success_function=lambda watch: self.async_success(
+                post_resp, start_time, '/v2/zones - async', watch,
             ),
             failure_function=lambda msg: self.async_failure(
                 post_resp, start_time, '/v2/zones - async', msg
             ),
+            group=ZoneStatusGroup(client),
+            resource_id=zone_id,
         )
 
         # if we successfully created the zone, add it to our list
         # todo: add some domains to the delete list
-        resp = api_call()
-        if resp.ok and resp.json()['status'] == 'ACTIVE':
-            zone = Zone(resp.json()['id'], resp.json()['name'])
+        if resp is not None:
+            body = resp.json()
+            zone = Zone(body['id'], body['name'])
             # LOG.info("%s -- Added zone %s", tenant, zone)
             tenant.data.zones_for_delete.append(zone)
 
     def import_zone(self):
         """POST /zones/tasks/import, Content-type: text/dns"""
-        gevent.spawn(
-            GreenletManager.get().tracked_greenlet,
-            lambda: self._do_import_zone(),
-        )
+        GreenletManager.get().spawn('import_zone', self._do_import_zone)
 
     def _do_import_zone(self):
         tenant = self.select_random_tenant()
         if not tenant:
             return
         client = self.designate_client.as_user(tenant)
-        zone_file = random_zone_file()
+        n_records = random_zone_size(CONFIG.import_zone_sizes)
+        zone_file = random_zone_file(
+            n_records=n_records, zone_name=DataGenerator.get().zone_name())
+        # the stats for each size are separate, so that latency can be
+        # plotted against the number of records
+        name = '/v2/zones/tasks/imports [{0} records]'.format(n_records)
         start_time = time.time()
 
-        import_resp = client.import_zone(
-            data=zone_file.get_zone_file_text(),
-            name='/v2/zones/tasks/imports',
-        )
+        # the zone file is generated while it's uploaded
+        import_resp = client.import_zone(data=zone_file, name=name)
 
         if not import_resp.ok:
             return
@@ -185,28 +186,26 @@ class ZoneTasks(BaseTaskSet):
                 import_resp, start_time, name=zone_file.zone_name,
             )
 
+        import_id = import_resp.json()['id']
         api_call = lambda: client.get_zone_import(
-            import_id=import_resp.json()['id'],
+            import_id=import_id,
             name='/v2/zones/ID - status check')
 
         self._poll_until_active_or_error(
             api_call=api_call,
             status_function=lambda r: r.json()['status'],
-            success_function=lambda: self.async_success(
-                import_resp, start_time, '/v2/zones/tasks/imports - async',
+            success_function=lambda watch: self.async_success(
+                import_resp, start_time, name + ' - async', watch,
             ),
             failure_function=lambda msg: self.async_failure(
-                import_resp, start_time, '/v2/zones/tasks/imports - async', msg
+                import_resp, start_time, name + ' - async', msg
             ),
             expected='COMPLETE',
         )
 
     def modify_domain(self):
         """PATCH /zones/ID"""
-        gevent.spawn(
-            GreenletManager.get().tracked_greenlet,
-            lambda: self._do_modify_domain(),
-        )
+        GreenletManager.get().spawn('modify_domain', self._do_modify_domain)
 
     def _do_modify_domain(self):
         tenant = self.select_random_tenant()
@@ -217,13 +216,11 @@ class ZoneTasks(BaseTaskSet):
         if not zone:
             LOG.error("%s has no zones for updating", tenant)
             return
-        payload = { "name": zone.name,
-                    "email": ("update@" + zone.name).strip('.'),
-                    "ttl": random.randint(2400, 7200) }
+        payload = DataGenerator.get().zone_update(zone.name)
         start_time = time.time()
         patch_resp = client.patch_zone(
             zone.id,
-            data=json.dumps(payload),
+            data=payload,
             name='/v2/zones/ID',
         )
         if not patch_resp.ok:
@@ -237,20 +234,19 @@ class ZoneTasks(BaseTaskSet):
         self._poll_until_active_or_error(
             api_call=api_call,
             status_function=lambda r: r.json()['status'],
-            success_function=lambda: self.async_success(
-                patch_resp, start_time, '/v2/zones - async'
+            success_function=lambda watch: self.async_success(
+                patch_resp, start_time, '/v2/zones - async', watch,
             ),
             failure_function=lambda msg: self.async_failure(
                 patch_resp, start_time, '/v2/zones - async', msg
             ),
+            group=ZoneStatusGroup(client),
+            resource_id=zone.id,
         )
 
     def remove_domain(self):
         """DELETE /zones/ID"""
-        gevent.spawn(
-            GreenletManager.get().tracked_greenlet,
-            lambda: self._do_remove_domain(),
-        )
+        GreenletManager.get().spawn('remove_domain', self._do_remove_domain)
 
     def _do_remove_domain(self):
         tenant = self.select_random_tenant()
@@ -276,10 +272,12 @@ class ZoneTasks(BaseTaskSet):
             no_log_request=True)
         self._poll_until_404(
             api_call,
-            success_function=lambda: self.async_success(
-                del_resp, start_time, '/v2/zones - async',
+            success_function=lambda watch: self.async_success(
+                del_resp, start_time, '/v2/zones - async', watch,
             ),
             failure_function=lambda msg: self.async_failure(
                 del_resp, start_time, '/v2/zones - async', msg
             ),
+            group=ZoneStatusGroup(client),
+            resource_id=zone.id,
         )
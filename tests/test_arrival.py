@@ -0,0 +1,60 @@
+import unittest
+
+import gevent
+
+import arrival
+from arrival import ArrivalScheduler
+
+
+class FakeTasks(object):
+
+    def __init__(self, executor):
+        self.executor = executor
+        self.locust = None
+
+    def task(self):
+        self.executor['running'] = True
+        gevent.sleep(0.05)
+        self.executor['running'] = False
+        self.executor['tasks'] += 1
+
+
+class ArrivalSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.executors = []
+
+    def tearDown(self):
+        arrival.lateness.reset()
+
+    def new_executor(self):
+        executor = {'running': False, 'tasks': 0}
+        self.executors.append(executor)
+        return {FakeTasks: FakeTasks(executor)}
+
+    def test_executors_have_their_own_task_sets(self):
+        shared = []
+
+        def task(tasks):
+            # no other task is running on this executor's task set
+            shared.append(tasks.executor['running'])
+            FakeTasks.task(tasks)
+
+        scheduler = ArrivalScheduler.from_weights(
+            [(FakeTasks, {task: 1})], rate=200, executors=5,
+            new_executor=self.new_executor)
+        scheduler.start()
+        gevent.sleep(0.5)
+        scheduler.stop()
+
+        self.assertEqual(5, len(self.executors))
+        self.assertTrue(shared)
+        self.assertFalse(any(shared))
+        # every executor was reused
+        self.assertTrue(all(executor['tasks'] > 1
+                            for executor in self.executors))
+        self.assertEqual(['FakeTasks.task'], arrival.lateness.entries.keys())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import unittest
+
+import locust.events
+from gevent.server import StreamServer
+from locust.clients import HttpSession
+from requests.exceptions import ChunkedEncodingError
+
+from client import DesignateClient
+
+
+class TruncatingServer(object):
+    """Sends the first chunk of a chunked body, then closes the connection"""
+
+    def __init__(self):
+        self.server = StreamServer(('127.0.0.1', 0), self.handle)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%s' % self.server.server_port
+
+    def handle(self, sock, address):
+        data = ''
+        while '\r\n\r\n' not in data:
+            chunk = sock.recv(65536)
+            if not chunk:
+                return
+            data += chunk
+        sock.sendall('HTTP/1.1 200 OK\r\n'
+                     'Content-Type: text/dns\r\n'
+                     'Transfer-Encoding: chunked\r\n\r\n'
+                     '5\r\nhello\r\n')
+
+
+class DownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = TruncatingServer()
+        self.server.server.start()
+        self.events = []
+        locust.events.request_success += self._success
+        locust.events.request_failure += self._failure
+
+    def tearDown(self):
+        locust.events.request_success -= self._success
+        locust.events.request_failure -= self._failure
+        self.server.server.stop()
+
+    def _success(self, request_type, name, response_time, response_length):
+        self.events.append(('success', name, None))
+
+    def _failure(self, request_type, name, response_time, exception):
+        self.events.append(('failure', name, exception))
+
+    def test_truncated_body_is_a_failed_transfer(self):
+        client = DesignateClient(HttpSession(self.server.url))
+        client.get_exported_zone_file('ID', name='/export', stream=True)
+        self.assertEqual([('success', '/export - ttfb'),
+                          ('failure', '/export - transfer')],
+                         [event[:2] for event in self.events])
+        self.assertIsInstance(self.events[1][2], ChunkedEncodingError)
+
+
+if __name__ == '__main__':
+    unittest.main()
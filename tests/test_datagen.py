@@ -0,0 +1,40 @@
+import itertools
+import unittest
+
+import gevent
+
+from datagen import PayloadPool
+
+
+class PayloadPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.counter = itertools.count()
+        self.pool = PayloadPool(lambda: next(self.counter), batch_size=200)
+
+    def test_refill_yields_between_slices(self):
+        sizes = []
+
+        def watch():
+            while True:
+                sizes.append(len(self.pool.items))
+                gevent.sleep(0)
+
+        watcher = gevent.spawn(watch)
+        gevent.sleep(0)
+        self.pool.take()
+        gevent.sleep(0.01)
+        watcher.kill()
+        # the watcher saw the pool fill a slice at a time
+        self.assertEqual([0, 50, 100, 150, 200], sorted(set(sizes)))
+
+    def test_taking_from_an_empty_pool_doesnt_fill_it_twice(self):
+        items = [self.pool.take() for _ in xrange(10)]
+        gevent.sleep(0.01)
+        self.assertEqual(range(10), items)
+        self.assertEqual(200, len(self.pool.items))
+        self.assertEqual(range(10, 210), list(self.pool.items))
+
+
+if __name__ == '__main__':
+    unittest.main()
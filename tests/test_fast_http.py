@@ -0,0 +1,143 @@
+import unittest
+
+import gevent
+import locust.events
+from gevent import socket
+from gevent.server import StreamServer
+from locust.clients import HttpSession
+
+import fast_http
+from client import DesignateClient
+from fast_http import FastHttpSession
+
+
+class FakeDesignate(object):
+    """Answers each request on a connection of its own, then closes it
+    without saying so, like a server closing idle kept-alive connections.
+
+    GET /ok returns 200, GET /error returns 500, a GET of an exported zone file
+    sends the first chunk of a chunked body, and a POST gets 201 once its chunked body
+    has arrived, or no answer at all with drop_uploads.
+    """
+
+    def __init__(self, drop_uploads=False):
+        self.drop_uploads = drop_uploads
+        self.bodies = []
+        self.server = StreamServer(('127.0.0.1', 0), self.handle)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%s' % self.server.server_port
+
+    def handle(self, sock, address):
+        data = self._read_until(sock, '', '\r\n\r\n')
+        if data is None:
+            return
+        head, _, body = data.partition('\r\n\r\n')
+        if head.startswith('POST'):
+            body = self._read_until(sock, body, '0\r\n\r\n')
+            self.bodies.append(body)
+            if not self.drop_uploads:
+                self._respond(sock, '201 Created', '{}')
+        elif head.startswith('GET /ok'):
+            self._respond(sock, '200 OK', 'ok')
+        elif head.startswith('GET /error'):
+            self._respond(sock, '500 Internal Server Error', 'error')
+        elif head.startswith('GET /v2/zones/tasks/exports/'):
+            sock.sendall('HTTP/1.1 200 OK\r\n'
+                         'Transfer-Encoding: chunked\r\n\r\n'
+                         '5\r\nhello\r\n')
+
+    def _read_until(self, sock, data, end):
+        while end not in data:
+            try:
+                chunk = sock.recv(65536)
+            except socket.error:
+                return None
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def _respond(self, sock, status, body):
+        sock.sendall('HTTP/1.1 {0}\r\nContent-Length: {1}\r\n\r\n{2}'
+                     .format(status, len(body), body))
+
+
+class FastHttpTest(unittest.TestCase):
+
+    def setUp(self):
+        self.events = []
+        locust.events.request_success += self._success
+        locust.events.request_failure += self._failure
+
+    def tearDown(self):
+        locust.events.request_success -= self._success
+        locust.events.request_failure -= self._failure
+        fast_http.pools.clear()
+
+    def _success(self, request_type, name, response_time, response_length):
+        self.events.append(('success', request_type, name, None))
+
+    def _failure(self, request_type, name, response_time, exception):
+        self.events.append(('failure', request_type, name, type(exception)))
+
+    def start_server(self, **kwargs):
+        server = FakeDesignate(**kwargs)
+        server.server.start()
+        self.addCleanup(server.server.stop)
+        return server
+
+    def test_streamed_body_is_not_resent(self):
+        server = self.start_server(drop_uploads=True)
+        session = FastHttpSession(server.url, timeout=5)
+        response = session.post('/v2/zones/tasks/imports',
+                                data=iter(['a' * 100, 'b' * 100]))
+        gevent.sleep(0.1)
+        self.assertFalse(response.ok)
+        # the server got the whole body, once
+        self.assertEqual(1, len(server.bodies))
+        self.assertIn('a' * 100, server.bodies[0])
+        self.assertIn('b' * 100, server.bodies[0])
+
+    def test_streamed_body_is_sent_after_idle_connections_close(self):
+        server = self.start_server()
+        session = FastHttpSession(server.url, pool_size=1, timeout=5)
+        self.assertTrue(session.get('/ok').ok)
+        # the server has closed the pooled connection
+        gevent.sleep(0.05)
+        response = session.post('/v2/zones/tasks/imports',
+                                data=iter(['a' * 100]))
+        self.assertEqual(201, response.status_code)
+        self.assertEqual(1, len(server.bodies))
+
+    def _events(self, session):
+        """Make the same requests with the session, and return the events"""
+        self.events = []
+        session.get('/ok', params={'limit': 5})
+        session.get('/ok', name='/ok named')
+        session.get('/error')
+        session.post('/v2/zones/tasks/imports', data=iter(['a' * 100]))
+        DesignateClient(session).get_exported_zone_file(
+            'ID', name='/export', stream=True)
+        return self.events
+
+    def test_events_match_http_session(self):
+        server = self.start_server()
+        self.assertEqual(
+            self._events(HttpSession(server.url)),
+            self._events(FastHttpSession(server.url, timeout=5)))
+
+    def test_connection_errors_match_http_session(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        url = 'http://127.0.0.1:%s' % sock.getsockname()[1]
+        sock.close()
+        for session in (HttpSession(url), FastHttpSession(url, timeout=5)):
+            session.get('/ok')
+        self.assertEqual(self.events[:1], self.events[1:])
+        self.assertEqual('failure', self.events[0][0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,201 @@
+import cPickle as pickle
+import struct
+import time
+import unittest
+
+import gevent
+from gevent import socket
+from gevent.server import StreamServer
+
+import metrics
+from graphite_client import GraphiteSink, PICKLE, PLAINTEXT
+from metrics import Metric
+
+
+class FakeCarbon(object):
+    """A carbon listener that keeps what it receives on each connection.
+    drop_connections() and stop() shut the connections down, so the
+    handlers see the end of the stream and return."""
+
+    def __init__(self, port=0):
+        self.received = []
+        self.connections = []
+        self.server = StreamServer(('127.0.0.1', port), self.handle)
+
+    @property
+    def port(self):
+        return self.server.server_port
+
+    def handle(self, sock, address):
+        self.connections.append(sock)
+        self.received.append('')
+        i = len(self.received) - 1
+        while True:
+            try:
+                data = sock.recv(65536)
+            except socket.error:
+                # the sink reset the connection
+                break
+            if not data:
+                break
+            self.received[i] += data
+        if sock in self.connections:
+            self.connections.remove(sock)
+
+    def drop_connections(self):
+        for sock in list(self.connections):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                # already closed by the sink
+                pass
+        # let the handlers see it, and return
+        gevent.sleep(0)
+
+    def stop(self):
+        self.drop_connections()
+        self.server.stop()
+
+    def metrics(self, protocol):
+        """Return the (path, value, timestamp) received on each connection"""
+        result = []
+        for data in self.received:
+            if protocol == PLAINTEXT:
+                entries = [line.split(' ') for line in data.splitlines()]
+                result.append([(path, float(value), int(timestamp))
+                               for path, value, timestamp in entries])
+                continue
+            entries = []
+            while data:
+                size, = struct.unpack('!L', data[:4])
+                entries.extend((path, float(value), int(timestamp))
+                               for path, (timestamp, value)
+                               in pickle.loads(data[4:4 + size]))
+                data = data[4 + size:]
+            result.append(entries)
+        return result
+
+
+def make_metrics(first, count):
+    return [Metric('reqs_per_sec', 'GET zone', 'slave', float(i), 1000 + i)
+            for i in xrange(first, first + count)]
+
+
+def expected(batch):
+    return [('locust.GET_zone.reqs_per_sec.slave', m.value, m.timestamp)
+            for m in batch]
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError("Timed out")
+        gevent.sleep(0.01)
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class GraphiteSinkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.greenlets = []
+        self.carbon = None
+
+    def tearDown(self):
+        gevent.killall(self.greenlets)
+        if self.carbon is not None:
+            self.carbon.stop()
+
+    def start_carbon(self, port=0):
+        self.carbon = FakeCarbon(port)
+        self.carbon.server.start()
+        return self.carbon
+
+    def start_sink(self, sink):
+        self.greenlets.append(sink.start())
+        return sink
+
+    def make_sink(self, port, protocol=PICKLE, **kwargs):
+        return GraphiteSink('127.0.0.1', port, protocol=protocol,
+                            min_backoff=0.01, max_backoff=0.01, **kwargs)
+
+    def _test_reconnect(self, protocol):
+        carbon = self.start_carbon()
+        sink = self.start_sink(self.make_sink(carbon.port, protocol))
+        first, second = make_metrics(0, 3), make_metrics(3, 3)
+
+        sink.send(first)
+        wait_for(lambda: sink.sent == 3)
+        carbon.drop_connections()
+        wait_for(lambda: len(carbon.received) == 1 and
+                 not carbon.connections)
+        sink.send(second)
+        wait_for(lambda: sink.sent == 6)
+        wait_for(lambda: len(carbon.received) == 2 and
+                 len(carbon.metrics(protocol)[1]) == 3)
+
+        self.assertEqual([expected(first), expected(second)],
+                         carbon.metrics(protocol))
+        self.assertEqual(2, sink.connects)
+        self.assertEqual(0, sink.dropped)
+
+    def test_pickle_batches_are_resent_after_reconnecting(self):
+        self._test_reconnect(PICKLE)
+
+    def test_plaintext_batches_are_resent_after_reconnecting(self):
+        self._test_reconnect(PLAINTEXT)
+
+    def test_batch_is_kept_until_carbon_is_up(self):
+        port = free_port()
+        sink = self.start_sink(self.make_sink(port, max_retries=100))
+        batch = make_metrics(0, 5)
+        sink.send(batch)
+        wait_for(lambda: sink.send_errors >= 2)
+        self.assertEqual(0, sink.sent)
+
+        carbon = self.start_carbon(port)
+        wait_for(lambda: sink.sent == 5)
+        wait_for(lambda: len(carbon.metrics(PICKLE)[0]) == 5)
+        self.assertEqual([expected(batch)], carbon.metrics(PICKLE))
+        self.assertEqual(1, sink.connects)
+
+    def _fill_queue(self, drop_policy):
+        """Send 5 metrics to a sink with room for 3, then start it"""
+        carbon = self.start_carbon()
+        sink = self.make_sink(carbon.port, queue_size=3,
+                              drop_policy=drop_policy)
+        batch = make_metrics(0, 5)
+        producer = gevent.spawn(sink.send, batch)
+        self.greenlets.append(producer)
+        gevent.sleep(0.05)
+        self.start_sink(sink)
+        producer.join(timeout=5)
+        wait_for(lambda: sink.sent + sink.dropped == 5)
+        wait_for(lambda: sum(map(len, carbon.metrics(PICKLE))) == sink.sent)
+        return batch, sink, sum(carbon.metrics(PICKLE), [])
+
+    def test_drop_oldest(self):
+        batch, sink, received = self._fill_queue(metrics.DROP_OLDEST)
+        self.assertEqual(2, sink.dropped)
+        self.assertEqual(expected(batch[2:]), received)
+
+    def test_drop_newest(self):
+        batch, sink, received = self._fill_queue(metrics.DROP_NEWEST)
+        self.assertEqual(2, sink.dropped)
+        self.assertEqual(expected(batch[:3]), received)
+
+    def test_block(self):
+        batch, sink, received = self._fill_queue(metrics.BLOCK)
+        self.assertEqual(0, sink.dropped)
+        self.assertEqual(expected(batch), received)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import errno
+import unittest
+
+import gevent
+from gevent import socket
+
+from metrics import BufferedSink, ClusterAggregator, Metric, StatsdSink
+
+
+def make_metrics(count):
+    return [Metric('reqs_per_sec', 'GET zone', 'slave', float(i), 1000 + i)
+            for i in xrange(count)]
+
+
+class FailingSink(BufferedSink):
+    """Fails to write any batch with a metric whose value is poison"""
+
+    name = 'failing'
+
+    def __init__(self, poison, **kwargs):
+        super(FailingSink, self).__init__(min_backoff=0.01, max_backoff=0.01,
+                                          **kwargs)
+        self.poison = poison
+        self.written = []
+
+    def write(self, batch):
+        if any(metric.value == self.poison for metric in batch):
+            raise ValueError("Poison")
+        self.written.extend(batch)
+
+
+class BufferedSinkTest(unittest.TestCase):
+
+    def test_batch_is_dropped_after_max_retries(self):
+        sink = FailingSink(poison=0.0, batch_size=2, max_retries=3)
+        batch = make_metrics(6)
+        sink.send(batch)
+        worker = sink.start()
+        gevent.sleep(0.2)
+        worker.kill()
+        self.assertEqual(4, sink.send_errors)
+        self.assertEqual(2, sink.dropped)
+        self.assertEqual(4, sink.sent)
+        self.assertEqual(batch[2:], sink.written)
+
+
+class FullSocket(object):
+
+    def sendto(self, data, address):
+        raise socket.error(errno.EAGAIN, "Resource temporarily unavailable")
+
+
+class StatsdSinkTest(unittest.TestCase):
+
+    def test_sends_dont_wait(self):
+        sink = StatsdSink('127.0.0.1', 8125)
+        self.assertEqual(0.0, sink.sock.gettimeout())
+
+    def test_metrics_are_dropped_when_the_socket_is_full(self):
+        sink = StatsdSink('127.0.0.1', 8125)
+        sink.sock = FullSocket()
+        sink.send(make_metrics(3))
+        self.assertEqual({'sent': 0, 'dropped': 3}, sink.counters())
+
+
+def report(reqs_per_sec, async_ops=None):
+    data = {'stats': [{'method': 'GET', 'name': ' zone',
+                       'response_times': {},
+                       'num_reqs_per_sec': reqs_per_sec}]}
+    if async_ops is not None:
+        data['async_ops'] = async_ops
+    return data
+
+
+def values(result, name, request):
+    return dict((m.timestamp, m.value) for m in result
+                if m.name == name and m.request == request)
+
+
+class ClusterAggregatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.aggregator = ClusterAggregator(interval=3, settle_time=6,
+                                            stale_after=15)
+
+    def test_late_seconds_are_not_published_again(self):
+        self.aggregator.add_report('a', report({1000: 5}), now=1001)
+        result = self.aggregator.flush(now=1010)
+        self.assertEqual({1000: 5}, values(result, 'reqs_per_sec', 'all'))
+
+        # a slow slave reports the same second after it was published
+        self.aggregator.add_report('b', report({1000: 3, 1005: 2}), now=1011)
+        result = self.aggregator.flush(now=1013)
+        self.assertEqual({1005: 2}, values(result, 'reqs_per_sec', 'all'))
+        self.assertEqual({1005: 2},
+                         values(result, 'reqs_per_sec', 'GET zone'))
+
+    def test_slaves_that_stop_reporting_are_forgotten(self):
+        ops = {'create_zone': {'in_flight': 4}}
+        self.aggregator.add_report('a', report({}, ops), now=1000)
+        self.aggregator.add_report('b', report({}, ops), now=1000)
+        result = self.aggregator.flush(now=1003)
+        self.assertEqual({1003: 8},
+                         values(result, 'async_ops.in_flight', 'create_zone'))
+
+        # b has gone away
+        self.aggregator.add_report('a', report({}, ops), now=1014)
+        result = self.aggregator.flush(now=1016)
+        self.assertEqual({1016: 4},
+                         values(result, 'async_ops.in_flight', 'create_zone'))
+        self.assertEqual(['a'], self.aggregator.async_ops.keys())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import json
+import unittest
+
+import gevent
+import locust.events
+import locust.runners
+from locust.stats import RequestStats
+
+import sharding
+from models import Tenant, TenantData
+
+
+class FakeRunner(object):
+
+    def __init__(self, client_ids):
+        self.clients = dict((client_id, None) for client_id in client_ids)
+        self.stats = RequestStats()
+
+
+class ShardAssignmentTest(unittest.TestCase):
+
+    def setUp(self):
+        self.real_runner = locust.runners.locust_runner
+        self.runner = locust.runners.locust_runner = FakeRunner(['a', 'b'])
+        tenants = [Tenant('user%s' % i, 'key', Tenant.SMALL)
+                   for i in xrange(6)]
+        for tenant in tenants:
+            tenant.data = TenantData()
+        sharding.start_gathering(None, tenants, lambda client, tenants: None)
+        sharding.gathering.join()
+
+    def tearDown(self):
+        locust.events.master_start_hatching -= sharding.assign_shards
+        sharding.gathering = None
+        sharding.all_tenants = []
+        sharding.assignment = None
+        locust.runners.locust_runner = self.real_runner
+
+    def _shard(self, client_id):
+        status, body = sharding.serve_shard(client_id)
+        self.assertEqual(200, status, body)
+        return [tenant['id'] for tenant in json.loads(body)['tenants']]
+
+    def test_shards_wait_for_the_test_to_start(self):
+        self.assertEqual(503, sharding.serve_shard('a')[0])
+        locust.events.master_start_hatching.fire()
+        self.assertEqual(['user0', 'user2', 'user4'], self._shard('a'))
+        self.assertEqual(['user1', 'user3', 'user5'], self._shard('b'))
+
+    def test_split_is_kept_when_slaves_come_and_go(self):
+        locust.events.master_start_hatching.fire()
+        first = self._shard('b')
+        self.runner.clients['0-late'] = None
+        del self.runner.clients['a']
+        # restarting the test doesn't split the tenants again
+        locust.events.master_start_hatching.fire()
+        self.assertEqual(first, self._shard('b'))
+        self.assertEqual(409, sharding.serve_shard('0-late')[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,174 @@
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import gevent
+
+import models
+from models import Tenant
+from token_manager import TokenCache, TokenManager
+
+
+class FakeResponse(object):
+
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.reason = 'OK' if self.ok else 'Unauthorized'
+        self.content = json.dumps(body)
+        self.text = self.content
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class FakeAuthService(object):
+    """Issues tokens that expire in 24 hours. With same_until_revoked, a
+    tenant gets its current token back until it's revoked, like the real
+    auth service. Each call takes `latency` seconds."""
+
+    def __init__(self, same_until_revoked, latency=0.05):
+        self.same_until_revoked = same_until_revoked
+        self.latency = latency
+        self.count = 0
+        self.gets = 0
+        # {username: token}
+        self.current = {}
+        self.revoked = set()
+
+    def get_token(self, username, api_key):
+        gevent.sleep(self.latency)
+        self.gets += 1
+        token = self.current.get(username)
+        if token is None or not self.same_until_revoked:
+            self.count += 1
+            token = self.current[username] = 'token-%s' % self.count
+        expires = datetime.datetime.utcnow() + datetime.timedelta(hours=24)
+        return FakeResponse(200, {'access': {'token': {
+            'id': token,
+            'expires': expires.strftime(Tenant.TIME_FORMAT),
+            'tenant': {'id': 'tenant-id'},
+        }}})
+
+    def revoke_token(self, token):
+        gevent.sleep(self.latency)
+        self.revoked.add(token)
+        for username, current in self.current.items():
+            if current == token:
+                del self.current[username]
+        return FakeResponse(204)
+
+    def client(self, endpoint=None):
+        return self
+
+
+class TokenRenewalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.real_auth_client = models.AuthClient
+
+    def tearDown(self):
+        models.AuthClient = self.real_auth_client
+
+    def _renew_during_requests(self, service):
+        models.AuthClient = service.client
+        manager = TokenManager(check_interval=3600)
+        tenant = Tenant('user', 'key', Tenant.SMALL)
+        # a token that's due for renewal, but hasn't expired
+        expiry = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        tenant._token = service.get_token('user', 'key').json()[
+            'access']['token']['id']
+        tenant._set_expiry(expiry)
+        old_token = tenant._token
+
+        seen = []
+
+        def make_requests():
+            for _ in xrange(50):
+                token = manager.get_token(tenant)
+                # the request reaches the server a moment later
+                gevent.sleep(0.005)
+                seen.append((token, token in service.revoked))
+
+        gevent.joinall([gevent.spawn(make_requests) for _ in xrange(10)])
+        return old_token, tenant._token, seen
+
+    def test_new_token_is_used_before_the_old_one_is_revoked(self):
+        service = FakeAuthService(same_until_revoked=False)
+        old_token, new_token, seen = self._renew_during_requests(service)
+        self.assertNotEqual(old_token, new_token)
+        self.assertIn(old_token, service.revoked)
+        self.assertEqual([], [s for s in seen if s[1]])
+        self.assertEqual(500, len(seen))
+
+    def test_callers_wait_while_the_same_token_is_revoked(self):
+        service = FakeAuthService(same_until_revoked=True)
+        old_token, new_token, seen = self._renew_during_requests(service)
+        self.assertNotEqual(old_token, new_token)
+        self.assertIn(old_token, service.revoked)
+        self.assertEqual([], [s for s in seen if s[0] is None or s[1]])
+        self.assertEqual(500, len(seen))
+
+
+class SharedTokenCacheTest(unittest.TestCase):
+    """Two TokenManagers with their own TokenCache on the same file stand in
+    for two locust processes on a box"""
+
+    def setUp(self):
+        self.real_auth_client = models.AuthClient
+        self.service = FakeAuthService(same_until_revoked=True)
+        models.AuthClient = self.service.client
+        self.dir = tempfile.mkdtemp()
+        path = os.path.join(self.dir, 'tokens.json')
+        self.managers = [TokenManager(check_interval=3600,
+                                      cache=TokenCache(path))
+                         for _ in xrange(2)]
+        # each process has its own Tenant objects
+        self.tenants = [Tenant('user', 'key', Tenant.SMALL)
+                        for _ in self.managers]
+
+    def tearDown(self):
+        models.AuthClient = self.real_auth_client
+        shutil.rmtree(self.dir)
+
+    def test_one_process_authenticates_a_tenant(self):
+        gevent.joinall([
+            gevent.spawn(manager.authenticate_all, [tenant])
+            for manager, tenant in zip(self.managers, self.tenants)])
+        self.assertEqual(1, self.service.gets)
+        self.assertEqual(self.tenants[0]._token, self.tenants[1]._token)
+
+    def test_shared_tokens_are_never_revoked(self):
+        token = self.service.get_token('user', 'key').json()[
+            'access']['token']['id']
+        # due for renewal, but not expired
+        expiry = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        for tenant in self.tenants:
+            tenant._token = token
+            tenant._set_expiry(expiry)
+
+        seen = []
+
+        def make_requests(manager, tenant):
+            for _ in xrange(20):
+                token = manager.get_token(tenant)
+                gevent.sleep(0.005)
+                seen.append((token, token in self.service.revoked))
+
+        gevent.joinall([
+            gevent.spawn(make_requests, manager, tenant)
+            for manager, tenant in zip(self.managers, self.tenants)
+            for _ in xrange(5)])
+        self.assertEqual(set(), self.service.revoked)
+        self.assertEqual([], [s for s in seen if s[0] is None or s[1]])
+        self.assertEqual(200, len(seen))
+        # the token is kept until it expires, rather than renewed again
+        for tenant in self.tenants:
+            self.assertFalse(tenant.is_expired())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,260 @@
+"""
+Keeps tenants' auth tokens fresh.
+
+A tenant's token is renewed in the background once it's within the renewal
+margin of its expiry (see Tenant.is_expired), so that requests don't wait on
+the auth service. A request only waits when its tenant has no token, or the
+token has actually expired, or while the old token is revoked because the auth
+service won't issue a new one otherwise (see Tenant.renew_token). Renewals are
+single-flight: callers that need the same tenant's token at the same time
+share one renewal.
+
+Each renewal is recorded as an 'AUTH' request in the stats, rather than
+being hidden inside the response time of whichever request needed the token.
+
+Tokens can be saved to a TokenCache file, shared by the locust processes on a
+box. At startup, authenticate_all() takes valid tokens from the cache and
+authenticates the rest of the tenants concurrently. Only one process renews a
+tenant's token at a time: it holds the tenant's lock file while it checks the
+cache, renews the token and saves it, and the other processes wait for the
+lock and then use the saved token. A token from the cache is never revoked,
+since other processes may still be using it. If the auth service won't issue
+a new token without revoking the old one, we keep the old one until it
+actually expires.
+"""
+import errno
+import fcntl
+import json
+import os
+import re
+import time
+import logging
+from contextlib import contextmanager
+
+import gevent
+import gevent.pool
+import locust.events
+
+LOG = logging.getLogger(__name__)
+
+
+class AuthError(Exception):
+    def __init__(self, msg):
+        super(AuthError, self).__init__(msg)
+
+
+def _flock(fd, operation):
+    """Take a flock, letting other greenlets run while we wait for it"""
+    while True:
+        try:
+            fcntl.flock(fd, operation | fcntl.LOCK_NB)
+            return
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            gevent.sleep(0.01)
+
+
+class TokenCache(object):
+    """A json file of {tenant id: [token, expires, tenant_id]}. Reads take a
+    shared lock, and writes an exclusive lock, on a separate lock file. Writes
+    replace the file, so a reader never sees a partial file.
+
+    Each tenant also has a lock file in <path>.locks/, held while its token
+    is renewed (see renewing()).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock_path = path + '.lock'
+        self.renewal_lock_dir = path + '.locks'
+
+    @contextmanager
+    def _locked(self, operation, lock_path=None):
+        fd = os.open(lock_path or self.lock_path, os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            _flock(fd, operation)
+            yield
+        finally:
+            os.close(fd)
+
+    def renewing(self, tenant_id):
+        """Return a context manager that holds the tenant's renewal lock"""
+        if not os.path.isdir(self.renewal_lock_dir):
+            try:
+                os.makedirs(self.renewal_lock_dir, 0700)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        filename = re.sub(r'[^A-Za-z0-9.-]+', '_', tenant_id) + '.lock'
+        return self._locked(fcntl.LOCK_EX,
+                            os.path.join(self.renewal_lock_dir, filename))
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except IOError:
+            return {}
+        except ValueError:
+            LOG.warning("Ignoring a corrupt token cache %s", self.path)
+            return {}
+
+    def load(self):
+        with self._locked(fcntl.LOCK_SH):
+            return self._read()
+
+    def store(self, tenants):
+        """Save the tokens of the given tenants, keeping everything else"""
+        with self._locked(fcntl.LOCK_EX):
+            entries = self._read()
+            for tenant in tenants:
+                entries[tenant.id] = tenant.token_entry()
+            tmp_path = '%s.%s' % (self.path, os.getpid())
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entries, f)
+            os.rename(tmp_path, self.path)
+
+
+class TokenManager(object):
+
+    @classmethod
+    def get(cls, _instance=[]):
+        if not _instance:
+            # prepare-tenant.py runs without an accurate_config
+            try:
+                import accurate_config as CONFIG
+                cache = None
+                if CONFIG.token_cache_file:
+                    cache = TokenCache(CONFIG.token_cache_file)
+                _instance.append(TokenManager(
+                    check_interval=CONFIG.token_refresh_interval,
+                    concurrency=CONFIG.token_auth_concurrency,
+                    cache=cache))
+            except ImportError:
+                _instance.append(TokenManager())
+        return _instance[0]
+
+    def __init__(self, check_interval=60, concurrency=10, cache=None):
+        """
+        :param check_interval: how often (in seconds) the background greenlet
+            looks for tokens that are due for renewal
+        :param concurrency: the max number of renewals in flight at once
+        :param cache: optional, a TokenCache shared with other processes
+        """
+        self.check_interval = check_interval
+        self.pool = gevent.pool.Pool(concurrency)
+        self.cache = cache
+        # {tenant id: tenant} for every tenant we've handed out a token for
+        self.tenants = {}
+        # {tenant id: greenlet} for each renewal in flight
+        self.renewals = {}
+        self.refresher = None
+
+    def authenticate_all(self, tenants):
+        """Make sure every tenant has a token that isn't due for renewal,
+        using the cache where possible and authenticating the rest
+        concurrently. Tenants without an api key (noauth mode) are skipped."""
+        start = time.time()
+        tenants = [t for t in tenants if t.api_key]
+        cached = self.cache.load() if self.cache else {}
+        for tenant in tenants:
+            self._register(tenant)
+            if tenant.id in cached:
+                tenant.set_token_entry(cached[tenant.id])
+
+        stale = [t for t in tenants if not t.has_valid_token() or t.is_expired()]
+        gevent.joinall([self.renew(tenant) for tenant in stale])
+        LOG.info("Authenticated %s tenants (%s from the token cache) in "
+                 "%.1f seconds", len(tenants), len(tenants) - len(stale),
+                 time.time() - start)
+
+    def get_token(self, tenant):
+        """Return the tenant's token, renewing it first only if there is no
+        usable token. A token that's due for renewal is renewed in the
+        background."""
+        if tenant.id not in self.tenants:
+            self._register(tenant)
+
+        if not tenant.has_valid_token():
+            self.renew(tenant).join()
+        elif tenant.is_expired():
+            self.renew(tenant)
+        return tenant._token
+
+    def _register(self, tenant):
+        """Keep the tenant's token fresh in the background"""
+        self.tenants[tenant.id] = tenant
+        if self.refresher is None or self.refresher.dead:
+            self.refresher = gevent.spawn(self._run)
+
+    def renew(self, tenant):
+        """Renew the tenant's token, unless a renewal is already in flight.
+        Return the greenlet doing the renewal."""
+        greenlet = self.renewals.get(tenant.id)
+        if greenlet is None:
+            greenlet = self.pool.spawn(self._renew, tenant)
+            self.renewals[tenant.id] = greenlet
+
+            def _done(_):
+                if self.renewals.get(tenant.id) is greenlet:
+                    del self.renewals[tenant.id]
+            greenlet.rawlink(_done)
+        return greenlet
+
+    def _adopt_cached_token(self, tenant):
+        """Use the cached token if another process has already renewed it.
+        Return True if the tenant's token is no longer due for renewal."""
+        entry = self.cache.load().get(tenant.id)
+        if entry and entry[0] != tenant._token:
+            tenant.set_token_entry(entry)
+        return tenant.has_valid_token() and not tenant.is_expired()
+
+    def _renew(self, tenant):
+        if self.cache is None:
+            self._renew_token(tenant, revoke=True)
+            return
+        # hold the tenant's lock until the new token is saved, so another
+        # process renewing it waits, and then uses our token
+        with self.cache.renewing(tenant.id):
+            if not self._adopt_cached_token(tenant):
+                self._renew_token(tenant, revoke=False)
+
+    def _renew_token(self, tenant, revoke):
+        start = time.time()
+        try:
+            resp = tenant.renew_token(revoke=revoke)
+        except Exception as e:
+            LOG.exception("Failed to auth %s", tenant)
+            self._record(start, exception=e)
+            return
+        if resp.ok:
+            self._record(start, response_length=len(resp.content))
+            if self.cache:
+                self.cache.store([tenant])
+        else:
+            self._record(start, exception=AuthError(
+                "Failed to auth - %s %s" % (resp.status_code, resp.reason)))
+
+    def _record(self, start, response_length=0, exception=None):
+        kwargs = dict(
+            request_type='AUTH',
+            name='/tokens - renew',
+            response_time=int((time.time() - start) * 1000),
+        )
+        if exception is None:
+            locust.events.request_success.fire(
+                response_length=response_length, **kwargs)
+        else:
+            locust.events.request_failure.fire(exception=exception, **kwargs)
+
+    def _run(self):
+        while True:
+            gevent.sleep(self.check_interval)
+            for tenant in self.tenants.values():
+                if tenant._token and tenant.is_expired():
+                    try:
+                        self.renew(tenant)
+                    except Exception:
+                        LOG.exception("Failed to start renewing %s", tenant)
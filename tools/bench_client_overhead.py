@@ -0,0 +1,134 @@
+"""
+Measures the CPU overhead DesignateClient adds to each request, in requests
+per second on one core. The http client is a stub that returns immediately,
+so this is only the cost of building the request: headers, the token, the
+url, and as_user().
+
+    python tools/bench_client_overhead.py --requests 200000
+"""
+import argparse
+import datetime
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import client
+from models import Tenant
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Benchmark DesignateClient overhead")
+    p.add_argument("-n", "--requests", type=int, default=200000,
+        help="The number of requests to make with each client (default: 200000)")
+    p.add_argument("-t", "--tenants", type=int, default=100,
+        help="The number of tenants to spread the requests across")
+    return p.parse_args()
+
+
+class OldDesignateClient(client.DesignateClient):
+    """The old implementation, kept here for comparison"""
+
+    _HEADERS = {
+        "Content-Type": "application/json",
+        "Accept": "application/json",
+    }
+
+    def as_user(self, tenant):
+        return OldDesignateClient(
+            client=self.client,
+            tenant=tenant,
+            use_project_id=self.use_project_id,
+            tenant_id_in_url=self.tenant_id_in_url,
+        )
+
+    def _request(self, method, url, *args, **kwargs):
+        no_log_request = kwargs.get('no_log_request', False)
+        if 'no_log_request' in kwargs:
+            del kwargs['no_log_request']
+        self._prepare_headers(kwargs)
+
+        if self.tenant and self.tenant_id_in_url:
+            if self.tenant.tenant_id not in url:
+                url = url.replace("v2", "v2/{0}".format(self.tenant.tenant_id))
+
+        resp = method(url, *args, **kwargs)
+        if not no_log_request:
+            self._log_if_bad_request(resp)
+        return resp
+
+    _request_v2 = None
+
+    def _prepare_headers(self, kwargs):
+        new_headers = dict(self._HEADERS)
+        if self.tenant and self.use_project_id:
+            new_headers[client.PROJECT_ID_HEADER] = self.tenant.id
+        if self.tenant and self.tenant.api_key:
+            new_headers[client.TOKEN_HEADER] = self.tenant.get_token()
+        new_headers.update(kwargs.get('headers') or {})
+        kwargs['headers'] = new_headers
+
+    def get_zone(self, zone_id, *args, **kwargs):
+        url = "/v2/zones/{0}".format(zone_id)
+        return self._request(self.client.get, url, *args, **kwargs)
+
+    def get_recordset(self, zone_id, recordset_id, *args, **kwargs):
+        url = "/v2/zones/{0}/recordsets/{1}".format(zone_id, recordset_id)
+        return self._request(self.client.get, url, *args, **kwargs)
+
+
+class StubResponse(object):
+    ok = True
+
+
+class StubHttpClient(object):
+    """Stands in for locust's HttpSession"""
+
+    def get(self, url, **kwargs):
+        return StubResponse()
+
+
+def make_tenants(n):
+    expires = datetime.datetime.utcnow() + datetime.timedelta(hours=24)
+    tenants = []
+    for i in xrange(n):
+        tenant = Tenant('user%s' % i, 'api-key', Tenant.SMALL)
+        tenant.set_token_entry([
+            'token%s' % i, expires.strftime(Tenant.TIME_FORMAT), str(100000 + i)])
+        tenants.append(tenant)
+    return tenants
+
+
+def run(designate_client, tenants, n_requests):
+    """Make requests the way the tasks do: as_user(), then a request"""
+    n_tenants = len(tenants)
+    start = time.clock()
+    for i in xrange(n_requests):
+        user = designate_client.as_user(tenants[i % n_tenants])
+        if i & 1:
+            user.get_zone('zone-id', name='/v2/zones/ID')
+        else:
+            user.get_recordset('zone-id', 'recordset-id',
+                               name='/v2/zones/ID/recordsets/ID - status check',
+                               catch_response=True, no_log_request=True)
+    return n_requests / (time.clock() - start)
+
+
+def main():
+    args = parse_args()
+    tenants = make_tenants(args.tenants)
+    stub = StubHttpClient()
+    old = OldDesignateClient(stub, use_project_id=False, tenant_id_in_url=True)
+    new = client.DesignateClient(stub, use_project_id=False, tenant_id_in_url=True)
+
+    old_rps = run(old, tenants, args.requests)
+    new_rps = run(new, tenants, args.requests)
+    print "%s requests across %s tenants" % (args.requests, args.tenants)
+    print "old client: %10.0f requests/sec/core" % old_rps
+    print "new client: %10.0f requests/sec/core" % new_rps
+    print "speedup: %.1fx" % (new_rps / old_rps)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""
+Checks that the master can merge reports from many slaves into cluster-wide
+metrics well within the slave report interval.
+
+    python tools/bench_cluster_merge.py --slaves 50 --requests 20000
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import metrics
+from bench_graphite import make_report
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Benchmark cluster metric merging")
+    p.add_argument("-s", "--slaves", type=int, default=50,
+        help="The number of simulated slaves (default: 50)")
+    p.add_argument("-n", "--requests", type=int, default=20000,
+        help="The number of requests in each slave's report")
+    p.add_argument("-e", "--endpoints", type=int, default=13,
+        help="The number of stats entries the requests are spread across")
+    p.add_argument("-i", "--interval", type=float, default=3,
+        help="The slave report interval, in seconds (default: 3)")
+    p.add_argument("-r", "--rounds", type=int, default=10,
+        help="The number of report intervals to simulate")
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+    # slaves send different data, but building 50 distinct reports dominates
+    # the runtime of this script without changing the merge cost much
+    reports = [make_report(args.requests, args.endpoints) for _ in xrange(5)]
+
+    aggregator = metrics.ClusterAggregator(interval=args.interval, settle_time=0)
+    merge_times = []
+    n_metrics = 0
+    for _ in xrange(args.rounds):
+        start = time.clock()
+        for i in xrange(args.slaves):
+            aggregator.add_report('slave%s' % i, reports[i % len(reports)])
+        n_metrics = len(aggregator.flush(now=time.time() + 1))
+        merge_times.append(time.clock() - start)
+
+    merge_times.sort()
+    worst = merge_times[-1]
+    print "%s slaves x %s requests across %s endpoints per interval" % (
+        args.slaves, args.requests, args.endpoints)
+    print "cluster metrics per interval: %s" % n_metrics
+    print "merge+summarize cpu per interval: median %.1f ms, max %.1f ms" % (
+        merge_times[len(merge_times) / 2] * 1000, worst * 1000)
+    print "max uses %.2f%% of the %ss report interval" % (
+        100 * worst / args.interval, args.interval)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+Compares the size and CPU cost of the graphite messages the master produces
+for a single slave report: the old one-line-per-request expansion of the
+response time histogram versus the per-interval summary metrics.
+
+    python tools/bench_graphite.py --requests 100000 --endpoints 13
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import graphite_client
+import histogram
+import metrics
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Benchmark graphite messages")
+    p.add_argument("-n", "--requests", type=int, default=100000,
+        help="The number of requests in the report (default: 100000)")
+    p.add_argument("-e", "--endpoints", type=int, default=13,
+        help="The number of stats entries the requests are spread across")
+    p.add_argument("-r", "--repeat", type=int, default=5,
+        help="The number of times to build each message")
+    return p.parse_args()
+
+
+def make_report(n_requests, n_endpoints):
+    stats = []
+    now = time.time()
+    for i in xrange(n_endpoints):
+        response_times = {}
+        for _ in xrange(n_requests / n_endpoints):
+            t = int(random.lognormvariate(4.5, 0.8))
+            t = histogram.round_response_time(t)
+            response_times[t] = response_times.get(t, 0) + 1
+        stats.append({
+            'method': 'GET',
+            'name': '/v2/zones/ID/{0}'.format(i),
+            'start_time': now,
+            'response_times': response_times,
+            'num_reqs_per_sec': {int(now): n_requests / n_endpoints},
+        })
+    return {'stats': stats}
+
+
+def expanded_response_time_message(stat, client_id):
+    """The old implementation, kept here for comparison"""
+    request = stat['method'] + stat['name'].replace('/', '-')
+    request = graphite_client._escape_metric_name(request)
+
+    graphite_key = "locust.{0}.response_time.{1}".format(request, client_id)
+    epoch_time = int(stat['start_time'])
+
+    response_times = []
+    for t, count in stat['response_times'].iteritems():
+        for _ in xrange(count):
+            response_times.append(t)
+
+    return "".join(
+        "{0} {1} {2}\n".format(graphite_key, response_time, epoch_time)
+        for response_time in response_times)
+
+
+def summary_response_time_message(stat, client_id):
+    """The summary datapoints, formatted as plaintext"""
+    sink = graphite_client.GraphiteSink(
+        None, None, protocol=graphite_client.PLAINTEXT)
+    return sink.serialize(metrics.response_time_metrics(stat, client_id))
+
+
+def measure(f, report, repeat):
+    """Return (bytes, cpu seconds) per report"""
+    size = 0
+    start = time.clock()
+    for _ in xrange(repeat):
+        size = sum(len(f(stat, 'slave1')) for stat in report['stats'])
+    return size, (time.clock() - start) / repeat
+
+
+def main():
+    args = parse_args()
+    report = make_report(args.requests, args.endpoints)
+
+    print "%s requests across %s endpoints per report" % (
+        args.requests, args.endpoints)
+    print "%-10s %14s %14s" % ("", "bytes/report", "cpu ms/report")
+    results = [
+        ("expanded", measure(expanded_response_time_message, report, args.repeat)),
+        ("summary", measure(summary_response_time_message, report,
+                            args.repeat)),
+    ]
+    for label, (size, cpu) in results:
+        print "%-10s %14d %14.3f" % (label, size, cpu * 1000)
+
+    (old_size, old_cpu), (new_size, new_cpu) = [r for _, r in results]
+    print "reduction: %.0fx bytes, %.0fx cpu" % (
+        float(old_size) / max(new_size, 1), old_cpu / max(new_cpu, 1e-9))
+
+
+if __name__ == '__main__':
+    main()
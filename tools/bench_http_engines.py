@@ -0,0 +1,112 @@
+"""
+Compares the http engines DesignateClient can use, against a local stub
+Designate that answers every request with a small zone. The stub runs in a
+separate process, so the numbers are for the client side only.
+
+    python tools/bench_http_engines.py --requests 20000 --concurrency 10
+
+Requests per cpu-second is the throughput one slave core could produce if
+the engine were the only thing using it.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+# locust monkey patches the standard library when it's imported
+from locust.clients import HttpSession
+import locust.events
+import gevent
+
+from client import DesignateClient
+from fast_http import FastHttpSession
+
+ZONE = '{"id": "a86dba58-0043-4cc6-a1bb-69d5e86f3ca3", "name": "example.com.", ' \
+       '"status": "ACTIVE", "serial": 1432754553, "ttl": 3600}'
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Benchmark the http engines")
+    p.add_argument("-n", "--requests", type=int, default=20000,
+        help="The number of requests to make with each engine (default: 20000)")
+    p.add_argument("-c", "--concurrency", type=int, default=10,
+        help="The number of greenlets making requests (default: 10)")
+    p.add_argument("-p", "--port", type=int, default=8765,
+        help="The port for the stub server (default: 8765)")
+    p.add_argument("--serve", action="store_true",
+        help="Run the stub server (used internally)")
+    return p.parse_args()
+
+
+def serve(port):
+    from gevent.pywsgi import WSGIServer
+
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'application/json'),
+                                  ('Content-Length', str(len(ZONE)))])
+        return [ZONE]
+
+    WSGIServer(('127.0.0.1', port), app, log=None).serve_forever()
+
+
+def run(session, n_requests, concurrency):
+    designate_client = DesignateClient(session, tenant_id_in_url=False)
+    counts = {'success': 0, 'failure': 0}
+
+    def on_success(**kwargs):
+        counts['success'] += 1
+
+    def on_failure(**kwargs):
+        counts['failure'] += 1
+
+    locust.events.request_success += on_success
+    locust.events.request_failure += on_failure
+
+    def worker(n):
+        for _ in xrange(n):
+            designate_client.get_zone('a86dba58', name='/v2/zones/ID')
+
+    # warm up the connections
+    worker(concurrency)
+    counts['success'] = 0
+
+    start_cpu, start_wall = time.clock(), time.time()
+    gevent.joinall([gevent.spawn(worker, n_requests / concurrency)
+                    for _ in xrange(concurrency)])
+    cpu, wall = time.clock() - start_cpu, time.time() - start_wall
+
+    locust.events.request_success -= on_success
+    locust.events.request_failure -= on_failure
+    return counts, cpu, wall
+
+
+def main():
+    args = parse_args()
+    if args.serve:
+        serve(args.port)
+        return
+
+    server = subprocess.Popen([sys.executable, __file__, '--serve',
+                               '--port', str(args.port)])
+    try:
+        time.sleep(1)
+        base_url = 'http://127.0.0.1:%s' % args.port
+        engines = [
+            ('requests', HttpSession(base_url)),
+            ('fast', FastHttpSession(base_url, pool_size=args.concurrency)),
+        ]
+        print "%s requests, %s concurrent" % (args.requests, args.concurrency)
+        for engine, session in engines:
+            counts, cpu, wall = run(session, args.requests, args.concurrency)
+            print "%-8s  %6.0f requests/sec  %6.0f requests/cpu-sec  " \
+                  "(%s ok, %s failed)" % (engine, counts['success'] / wall,
+                  counts['success'] / cpu, counts['success'], counts['failure'])
+    finally:
+        server.kill()
+
+
+if __name__ == '__main__':
+    main()
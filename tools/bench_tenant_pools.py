@@ -0,0 +1,120 @@
+"""
+Compares the memory and speed of the recordset pools in TenantData with the
+plain lists they replaced. Each case runs in its own process, so its memory
+is the growth in that process's resident size.
+
+    python tools/bench_tenant_pools.py --sizes 1000000,10000000
+
+The lists need several GB at 10M entries. A case that runs out of memory is
+reported as failed.
+"""
+import argparse
+import os
+import random
+import subprocess
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from pools import Zone, Recordset, RecordsetPool
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Benchmark the tenant data pools")
+    p.add_argument("-s", "--sizes", default="1000000,10000000",
+        help="Comma separated numbers of recordsets (default: 1000000,10000000)")
+    p.add_argument("-z", "--zones", type=int, default=1000,
+        help="The number of zones the recordsets are spread across")
+    p.add_argument("-o", "--ops", type=int, default=100000,
+        help="The number of selects and deletes to time (default: 100000)")
+    p.add_argument("--run", nargs=2, metavar=("IMPL", "SIZE"),
+        help="Run a single case (used internally)")
+    return p.parse_args()
+
+
+class OldRecordsets(list):
+    """The old implementation, kept here for comparison"""
+
+    def select_random(self):
+        if self:
+            return random.choice(self)
+
+    def pop_random(self):
+        if self:
+            return self.pop(random.randrange(0, len(self)))
+
+
+IMPLEMENTATIONS = {
+    'list': OldRecordsets,
+    'pool': RecordsetPool,
+}
+
+
+def rss_bytes():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def random_ip():
+    return "%s.%s.%s.%s" % tuple(random.randint(0, 255) for _ in range(4))
+
+
+def run_case(impl, size, n_zones, n_ops):
+    # ids and data as they come out of the json decoder
+    zones = [Zone(unicode(uuid.uuid4()), u'zone%s.com.' % i)
+             for i in xrange(n_zones)]
+    type_a = u'A'
+    start_rss = rss_bytes()
+
+    start = time.time()
+    recordsets = IMPLEMENTATIONS[impl]()
+    for i in xrange(size):
+        recordsets.append(Recordset(zones[i % n_zones], unicode(uuid.uuid4()),
+                                    unicode(random_ip()), type_a))
+    fill_time = time.time() - start
+    memory = rss_bytes() - start_rss
+
+    start = time.time()
+    for _ in xrange(n_ops):
+        recordsets.select_random()
+    select_time = time.time() - start
+
+    start = time.time()
+    for _ in xrange(n_ops):
+        recordsets.pop_random()
+    delete_time = time.time() - start
+
+    print "%s %s %s %s %s" % (memory, fill_time, select_time, delete_time,
+                              n_ops)
+
+
+def main():
+    args = parse_args()
+    if args.run:
+        run_case(args.run[0], int(args.run[1]), args.zones, args.ops)
+        return
+
+    print "%-5s %10s  %10s  %8s  %12s  %12s" % (
+        'impl', 'entries', 'memory', 'bytes/rs', 'selects/sec', 'deletes/sec')
+    for size in [int(x) for x in args.sizes.split(',')]:
+        for impl in sorted(IMPLEMENTATIONS):
+            proc = subprocess.Popen(
+                [sys.executable, __file__, '--run', impl, str(size),
+                 '--zones', str(args.zones), '--ops', str(args.ops)],
+                stdout=subprocess.PIPE)
+            out, _ = proc.communicate()
+            if proc.returncode != 0:
+                print "%-5s %10s  failed (exit code %s)" % (
+                    impl, size, proc.returncode)
+                continue
+            memory, _, select_time, delete_time, n_ops = out.split()
+            memory, n_ops = int(memory), int(n_ops)
+            print "%-5s %10s  %7.0f MB  %8.0f  %12.0f  %12.0f" % (
+                impl, size, memory / 1e6, float(memory) / size,
+                n_ops / float(select_time), n_ops / float(delete_time))
+
+
+if __name__ == '__main__':
+    main()
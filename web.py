@@ -12,7 +12,10 @@ import flask
 from flask import request
 from flask.ext.httpauth import HTTPBasicAuth
 
+import exchange_log
+import metrics
 import persistence
+import sharding
 
 LOG = logging.getLogger(__name__)
 
@@ -120,3 +123,25 @@ def report(name):
 def status():
     result = {"status": locust.runners.locust_runner.state}
     return flask.Response(json.dumps(result), mimetype='application/json')
+
+@web.app.route('/failures')
+def failures():
+    """Return the latest failed exchanges (from every slave), newest first"""
+    limit = request.args.get('limit', 100, type=int)
+    dump = exchange_log.failed_exchanges.dump(limit) or "No failed exchanges"
+    return flask.Response(dump, mimetype='text/plain')
+
+@web.app.route('/shard/<client_id>')
+def shard(client_id):
+    """Return a slave's share of the tenants, with their gathered data"""
+    status, body = sharding.serve_shard(client_id)
+    mimetype = 'application/json' if status == 200 else 'text/plain'
+    return flask.Response(body, status=status, mimetype=mimetype)
+
+@web.app.route('/metrics')
+def prometheus_metrics():
+    """Expose the latest metrics from the slave reports to Prometheus"""
+    if metrics.prometheus_sink is None:
+        return flask.abort(404)
+    return flask.Response(metrics.prometheus_sink.render(),
+                          mimetype='text/plain; version=0.0.4')